@@ -0,0 +1,80 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import chess
+import chess.polyglot
+
+class CacheEntry:
+    def __init__(self, depth: int, lines: List[Dict[str, Any]]):
+        self.depth = depth
+        self.lines = lines
+
+    @property
+    def score(self):
+        return self.lines[0]["score"]
+
+    @property
+    def pv(self):
+        return self.lines[0]["pv"]
+
+class AnalysisCache:
+    """
+    LRU cache of engine analysis keyed by the Zobrist hash of the position, so
+    transpositions share entries. Each entry keeps the deepest result seen along
+    with all of its multipv lines.
+    """
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[int, CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(board: chess.Board) -> int:
+        return chess.polyglot.zobrist_hash(board)
+
+    def get(self, board: chess.Board, depth: int, multipv: int = 1) -> Optional[List[Dict[str, Any]]]:
+        """Return the cached lines if they were searched to at least depth with at least multipv lines."""
+        key = self.key(board)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.depth < depth or len(entry.lines) < multipv:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.lines[:multipv]
+
+    def contains(self, board: chess.Board, depth: int, multipv: int = 1) -> bool:
+        """Whether get() would return lines, without counting a hit or miss or refreshing the entry."""
+        with self._lock:
+            entry = self._entries.get(self.key(board))
+            return entry is not None and entry.depth >= depth and len(entry.lines) >= multipv
+
+    def put(self, board: chess.Board, depth: int, lines: List[Dict[str, Any]]):
+        if not lines:
+            return
+        key = self.key(board)
+        stored = [{"score": line["score"], "pv": list(line.get("pv", [])), "depth": line.get("depth", depth)}
+                  for line in lines]
+        with self._lock:
+            entry = self._entries.get(key)
+            # Never replace a deeper search, or the same depth with more lines, by a shallower one
+            if entry is not None and (entry.depth > depth or (entry.depth == depth and len(entry.lines) > len(stored))):
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = CacheEntry(depth, stored)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
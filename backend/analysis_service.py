@@ -0,0 +1,328 @@
+"""
+Configuration, shared state and helpers of the analysis API.
+
+main.py (Flask, threads) and asgi.py (Quart, asyncio) both serve the API from
+this module. Only the code that waits on engines differs between them: what
+a request means, what gets cached and stored, and what a response looks like
+is decided here once.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence
+
+import chess
+import chess.engine
+import numpy as np
+
+import metrics
+from analysis_cache import AnalysisCache
+from analysis_store import AnalysisStore
+from best_line import BestLine
+from chess_engines import share_engine_options
+from fast_path import FastPathResolver
+from game_analysis import GameAnalysisPool
+from jobs import Job, JobStore, QueueFullError
+from sharpness import SharpnessTable
+
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Stockfish configuration
+stockfish_path = os.environ.get('STOCKFISH_PATH', r'K:\github\stockfish-windows-x86-64\stockfish\stockfish-windows-x86-64.exe')
+# Threads and Hash are the machine-wide budget, shared by the request pool and game analysis below
+stockfish_options = {'Threads': '10', 'Hash': '4096'}
+stockfish_pool_size = int(os.environ.get('STOCKFISH_POOL_SIZE', '2'))
+
+# Stockfish engines pinned to client game sessions; the rest of the pool serves one-off requests.
+# Sessions never take the whole pool, so with a single engine they are off and session ids are ignored.
+max_engine_sessions = max(min(int(os.environ.get('ENGINE_SESSIONS', str(stockfish_pool_size - 1))),
+                              stockfish_pool_size - 1), 0)
+session_idle_timeout = float(os.environ.get('SESSION_IDLE_SECONDS', '300'))
+
+# Leela Chess Zero configuration
+leela_path = os.environ.get('LEELA_PATH', r'K:\leela\lc0-v0.30.0-windows-gpu-nvidia-cudnn\lc0.exe')
+weights_path = os.environ.get('LEELA_WEIGHTS_PATH', r'K:\leela\lc0-v0.30.0-windows-gpu-nvidia-cudnn\791556.pb.gz')
+leela_options = {'WeightsFile': weights_path, 'UCI_ShowWDL': 'true'}
+leela_pool_size = int(os.environ.get('LEELA_POOL_SIZE', '1'))
+
+# Whole-game analysis runs in separate worker processes, each with its own engines
+game_analysis_workers = int(os.environ.get('GAME_ANALYSIS_WORKERS', '2'))
+game_analysis_sharpness = os.environ.get('GAME_ANALYSIS_SHARPNESS', 'false').lower() == 'true'
+
+# Each Stockfish engine of either gets the same share of the budget, so the two never oversubscribe the machine
+stockfish_engines = stockfish_pool_size + game_analysis_workers
+pool_stockfish_options = share_engine_options(stockfish_options, stockfish_pool_size, stockfish_engines)
+game_stockfish_options = share_engine_options(stockfish_options, game_analysis_workers, stockfish_engines)
+
+job_workers = int(os.environ.get('JOB_WORKERS', str(stockfish_pool_size + leela_pool_size)))
+job_queue_size = int(os.environ.get('JOB_QUEUE_SIZE', '1000'))
+
+# Interactive requests aim to finish within this many seconds unless they ask for something else
+latency_target = float(os.environ.get('LATENCY_TARGET_MS', '3000')) / 1000
+# Leela's per-search time for root move scoring, before it is scaled down under load
+leela_search_time = 1.0
+# Sharpness needs only Leela's WDL: a few nodes, refined to LEELA_WDL_REFINE_NODES where both sides have winning chances
+leela_wdl_nodes = int(os.environ.get('LEELA_WDL_NODES', '1'))
+leela_wdl_refine_nodes = int(os.environ.get('LEELA_WDL_REFINE_NODES', '0'))
+# Largest list of WDLs or FENs one /sharpness-batch request may send
+sharpness_batch_max = int(os.environ.get('SHARPNESS_BATCH_MAX', '10000'))
+# Leela scores a few more root moves than Stockfish returns, so every Stockfish candidate is likely among them
+LEELA_EXTRA_ROOT_LINES = 2
+
+job_store = JobStore(max_jobs=int(os.environ.get('JOB_STORE_SIZE', '10000')),
+                     ttl=float(os.environ.get('JOB_TTL_SECONDS', '600')))
+
+analysis_cache = AnalysisCache(max_entries=int(os.environ.get('ANALYSIS_CACHE_SIZE', '100000')))
+
+# Results that survive restarts and are shared by every worker process pointing at the same file.
+# Flushes run on the store's own thread, so neither job threads nor the event loop wait on the disk.
+analysis_store = AnalysisStore(os.environ.get('ANALYSIS_STORE_PATH', os.path.join(BACKEND_DIR, 'analysis_store.bin')),
+                               background_flush=True)
+atexit.register(analysis_store.close)
+
+# sharpnessLC0 for every integer WDL Leela reports, built once and shared through the file by every server process
+sharpness_table = SharpnessTable.load_or_build(os.environ.get('SHARPNESS_TABLE_PATH',
+                                                              os.path.join(BACKEND_DIR, 'sharpness_table.npy')))
+
+# Book moves and tablebase results are answered straight away instead of queueing a search
+fast_path = FastPathResolver(os.environ.get('BOOK_PATH'), os.environ.get('SYZYGY_PATH'))
+atexit.register(fast_path.close)
+
+# Most recent job per kind, only used by the legacy *-result endpoints when no job_id is given
+_latest_job_ids: Dict[str, str] = {}
+_latest_job_ids_lock = threading.Lock()
+
+metrics.CACHE_LOOKUPS.labels("memory", "hit").set_function(lambda: analysis_cache.hits)
+metrics.CACHE_LOOKUPS.labels("memory", "miss").set_function(lambda: analysis_cache.misses)
+metrics.CACHE_LOOKUPS.labels("store", "hit").set_function(lambda: analysis_store.hits)
+metrics.CACHE_LOOKUPS.labels("store", "miss").set_function(lambda: analysis_store.misses)
+
+def record_search(engine: str, lines: list, depth: Optional[int] = None):
+    if depth is not None:
+        metrics.SEARCH_DEPTH.observe(depth)
+    nps = lines[0].get("nps") if lines else None
+    if nps:
+        metrics.ENGINE_NPS.labels(engine).set(nps)
+
+def supersede_key(kind: str, data: dict):
+    """Requests of one kind from the same client supersede each other; the session id identifies clients that send no client_id."""
+    client_id = data.get('client_id') or data.get('session_id')
+    return (client_id, kind) if client_id else None
+
+def evaluate_params(data: dict) -> dict:
+    return {"fen": data.get('fen'), "depth": data.get('depth', 20), "latency_ms": data.get('latency_ms'),
+            "session_id": data.get('session_id')}
+
+def best_lines_params(data: dict) -> dict:
+    return {"current_fen": data.get('current_fen'), "number_of_lines": data.get('number_of_lines', 1),
+            "depth": data.get('depth', 20), "latency_ms": data.get('latency_ms'), "session_id": data.get('session_id')}
+
+def stream_params(args) -> dict:
+    """The query parameters of /analysis-stream."""
+    return {"fen": args.get('fen'), "depth": args.get('depth', 20, type=int), "multipv": args.get('multipv', 1, type=int),
+            "sharpness": args.get('sharpness', 'false').lower() == 'true',
+            "latency_ms": args.get('latency_ms', type=int), "session_id": args.get('session_id')}
+
+def remember_job(job: Job):
+    with _latest_job_ids_lock:
+        _latest_job_ids[job.kind] = job.id
+
+def find_result_job(kind: str, job_id: Optional[str] = None) -> Optional[Job]:
+    if job_id is None:
+        with _latest_job_ids_lock:
+            job_id = _latest_job_ids.get(kind)
+    if job_id is None:
+        return None
+    job = job_store.get(job_id)
+    if job is None or job.kind != kind:
+        return None
+    return job
+
+def legacy_result(kind: str, field: str, job_id: Optional[str] = None) -> dict:
+    job = find_result_job(kind, job_id)
+    if job is not None and job.is_finished() and job.result is not None:
+        return {"status": "completed", field: job.result[field]}
+    else:
+        return {"status": "in_progress"}
+
+def fast_path_answer(kind: str, message: str, lookup: Callable[[chess.Board], Optional[dict]], fen: str,
+                     params: dict, supersede: Optional[Hashable], scheduler) -> Optional[dict]:
+    """The body of a completed response when the book or tablebases know the position, otherwise None."""
+    return fast_path_response(kind, message, fast_path_lookup(lookup, fen), fen, params, supersede, scheduler)
+
+def fast_path_lookup(lookup: Callable[[chess.Board], Optional[dict]], fen: str) -> Optional[dict]:
+    """What lookup knows about the position; blocks on book and tablebase reads."""
+    try:
+        board = chess.Board(fen)
+    except ValueError:
+        # Left to the job, which reports an invalid FEN like any other failure
+        return None
+    return lookup(board)
+
+def fast_path_response(kind: str, message: str, result: Optional[dict], fen: str, params: dict,
+                       supersede: Optional[Hashable], scheduler) -> Optional[dict]:
+    """fast_path_answer for a result already looked up, so the lookup can run off the event loop."""
+    if result is None:
+        return None
+    metrics.FAST_PATH_ANSWERS.labels(result["source"]).inc()
+    logger.info(f"Answered {kind} request from {result['source']}: FEN={fen}")
+    if supersede is not None:
+        scheduler.supersede(supersede, params)
+    response = {"message": message, "status": "completed", "result": result}
+    try:
+        job = job_store.record(kind, result, **params)
+    except QueueFullError as e:
+        # The answer is already known, so a full job store only costs the job id
+        logger.warning(f"Not recording {kind} job: {str(e)}")
+        return response
+    remember_job(job)
+    response["job_id"] = job.id
+    return response
+
+class BatchTooLargeError(ValueError):
+    """A batch request names more positions than sharpness_batch_max."""
+
+def check_batch_size(items: list) -> None:
+    if len(items) > sharpness_batch_max:
+        raise BatchTooLargeError(f"at most {sharpness_batch_max} entries per request, got {len(items)}")
+
+def wdl_sharpnesses(wdls) -> List[float]:
+    """
+    Sharpness of each [win, draw, loss] triple. Raises BatchTooLargeError for more than
+    sharpness_batch_max triples and ValueError for anything that is not finite, non-negative triples.
+    """
+    if isinstance(wdls, list):
+        check_batch_size(wdls)
+    try:
+        wdl_array = np.asarray(wdls, dtype=np.float64)
+    except (TypeError, ValueError):
+        wdl_array = None
+    if wdl_array is None or wdl_array.ndim != 2 or wdl_array.shape[1] != 3:
+        raise ValueError("wdls must be a list of [win, draw, loss] triples")
+    if not np.isfinite(wdl_array).all() or (wdl_array < 0).any():
+        raise ValueError("WDL values must be finite and non-negative")
+    return sharpness_table.lookup(wdl_array).tolist()
+
+def known_sharpness(board: chess.Board) -> Optional[float]:
+    """Sharpness from the tablebases or the analysis store, without a search."""
+    resolved = fast_path.sharpness(board)
+    if resolved is not None:
+        return resolved["sharpness"]
+    stored = analysis_store.get_wdl(board)
+    if stored is not None:
+        return stored[1]
+    return None
+
+def store_sharpness(board: chess.Board, result: dict) -> float:
+    wdl = result.get("wdl")
+    if wdl is None:
+        raise ValueError("Engine did not report WDL")
+    sharpness = sharpness_table.sharpness(wdl)
+    analysis_store.put_wdl(board, wdl, sharpness)
+    return sharpness
+
+def wdl_batches(pending: List[int], engines: int) -> List[List[int]]:
+    """Split positions into one WDL batch per Leela engine, so every engine's network stays busy."""
+    batch_count = min(engines, len(pending))
+    return [pending[start::batch_count] for start in range(batch_count)]
+
+def store_batch_sharpnesses(boards: Sequence[chess.Board], sharpnesses: list, batches: List[List[int]], results: list):
+    for batch, infos in zip(batches, results):
+        record_search("leela", infos[-1:])
+        for i, info in zip(batch, infos):
+            sharpnesses[i] = store_sharpness(boards[i], info)
+
+def child_boards(board: chess.Board, moves: Sequence[chess.Move]) -> List[chess.Board]:
+    children = []
+    for move in moves:
+        board.push(move)
+        children.append(chess.Board(board.fen()))
+        board.pop()
+    return children
+
+def root_wdls_by_move(infos: List[Dict[str, Any]]) -> Dict[chess.Move, chess.engine.PovWdl]:
+    record_search("leela", infos)
+    return {info['pv'][0]: info['wdl'] for info in infos if info.get('pv') and 'wdl' in info}
+
+def apply_root_wdls(moves: Sequence[chess.Move], children: List[chess.Board], sharpnesses: list, wdls: dict):
+    """Score the candidates that Leela's root search covered."""
+    for i, move in enumerate(moves):
+        if sharpnesses[i] is None and move in wdls:
+            # The root side's wins are the losses of the side to move in the child position
+            wdl = wdls[move]
+            child_wdl = (wdl[2], wdl[1], wdl[0])
+            sharpnesses[i] = sharpness_table.sharpness(child_wdl)
+            analysis_store.put_wdl(children[i], child_wdl, sharpnesses[i])
+
+def store_search(board: chess.Board, lines: list, depth: int, satisfied_depth: Optional[int] = None):
+    """
+    Keep a search's lines. The in-memory cache serves them for requests up to
+    satisfied_depth, which a search stopped for stability reaches without
+    searching it; the persistent store only ever records the depth searched.
+    """
+    analysis_cache.put(board, max(depth, satisfied_depth or 0), lines)
+    analysis_store.put_score(board, lines[0]["score"], depth)
+
+def best_lines_result(board: chess.Board, info: list, sharpnesses: list) -> dict:
+    best_lines = []
+    for i, (line_info, sharpness) in enumerate(zip(info, sharpnesses)):
+        moves = line_info['pv']
+        move_sans = board.variation_san(moves)
+        score = line_info['score'].relative.score()
+        logger.info(f"Line {i+1}: Moves: {move_sans}, Score: {score}, Sharpness: {sharpness}")
+        best_lines.append(BestLine(move_sans, score, sharpness).to_dict())
+    logger.info("Best lines calculation complete")
+    return {"best_lines": best_lines}
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def format_line(board: chess.Board, info) -> dict:
+    moves = info.get('pv', [])
+    return {
+        "moves": board.variation_san(moves),
+        "pv": [move.uci() for move in moves],
+        "score": info['score'].relative.score(mate_score=100000),
+    }
+
+def analysis_event(board: chess.Board, fen: str, depth: int, lines: list) -> str:
+    return sse_event("analysis", {"fen": fen, "depth": depth, "lines": [format_line(board, line) for line in lines]})
+
+def sharpness_event(fen: str, sharpness: float, line_sharpnesses: list) -> str:
+    """The sharpness of a streamed position and of the position after each line's first move."""
+    return sse_event("sharpness", {"fen": fen, "sharpness": sharpness, "lines": line_sharpnesses})
+
+def evaluation_event(fen: str, evaluation: int, depth: Optional[int], source: str) -> str:
+    """An evaluation known without searching, which comes with no lines."""
+    return sse_event("evaluation", {"fen": fen, "depth": depth, "evaluation": evaluation, "source": source})
+
+def known_lines_event(fen: str, known: dict) -> str:
+    """The book or tablebase moves fast_path.best_lines found, as /best-lines reports them."""
+    metrics.FAST_PATH_ANSWERS.labels(known["source"]).inc()
+    logger.info(f"Streaming best lines from {known['source']}: FEN={fen}")
+    return sse_event("best_lines", {"fen": fen, "source": known["source"], "lines": known["best_lines"]})
+
+def tablebase_events(board: chess.Board, fen: str, known: dict, with_sharpness: bool) -> List[str]:
+    """The rest of a stream for a tablebase position, which needs no search; blocks on tablebase reads."""
+    events = [evaluation_event(fen, fast_path.evaluate(board)["evaluation"], None, "tablebase")]
+    if with_sharpness:
+        events.append(sharpness_event(fen, fast_path.sharpness(board)["sharpness"],
+                                      [line["sharpness"] for line in known["best_lines"]]))
+    events.append(sse_event("done", {"fen": fen, "depth": None}))
+    return events
+
+def stream_candidates(board: chess.Board, known: Optional[dict], lines: list) -> list:
+    """The first move of each line a stream sent, which came from the book if known is given."""
+    if known is not None:
+        return [board.parse_san(line["moves"]) for line in known["best_lines"]]
+    return [line['pv'][0] for line in lines]
+
+def create_game_analysis_pool() -> GameAnalysisPool:
+    pool = GameAnalysisPool(game_analysis_workers, stockfish_path, game_stockfish_options,
+                            leela_path if game_analysis_sharpness else None, leela_options, sharpness_table)
+    logger.info(f"Game analysis pool initialized with {game_analysis_workers} workers")
+    return pool
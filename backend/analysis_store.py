@@ -0,0 +1,312 @@
+import logging
+import mmap
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import chess
+import chess.engine
+import chess.polyglot
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"OCAS"
+VERSION = 1
+HEADER_SIZE = 16
+
+HAS_SCORE = 1
+HAS_MATE = 2
+HAS_WDL = 4
+
+# One fixed-size little-endian record per stored result; 32 bytes each
+RECORD_DTYPE = np.dtype([
+    ("key", "<u8"),
+    ("score", "<i4"),
+    ("depth", "<i2"),
+    ("flags", "<u2"),
+    ("mate", "<i2"),
+    ("wdl", "<u2", (3,)),
+    ("sharpness", "<f8"),
+])
+
+def _header() -> bytes:
+    return MAGIC + np.array([VERSION, RECORD_DTYPE.itemsize, 0], dtype="<u4").tobytes()
+
+Index = Tuple[np.ndarray, np.ndarray]
+
+def _empty_index() -> Index:
+    return np.zeros(0, dtype="<u8"), np.zeros(0, dtype=np.int64)
+
+def _index_segment(records: np.ndarray, start: int, flag: int, depths: Optional[np.ndarray] = None) -> Index:
+    """Sorted unique keys of the records from start on with flag set, each with its latest row, or deepest if depths."""
+    rows = np.flatnonzero(records["flags"][start:] & flag) + start
+    keys = records["key"][rows]
+    order = np.lexsort((rows, depths[rows], keys) if depths is not None else (rows, keys))
+    keys, rows = keys[order], rows[order]
+    last = np.append(keys[1:] != keys[:-1], True)[:len(keys)]
+    return keys[last], rows[last]
+
+def _merge_index(index: Index, segment: Index, replaces: Optional[Callable[[np.ndarray, np.ndarray], np.ndarray]]) -> Index:
+    """
+    Merge a segment into an index. Keys already indexed take the segment's row
+    where replaces(old_rows, new_rows) holds, or always if replaces is None.
+    Costs one pass over the index, not a rebuild from every record.
+    """
+    keys, rows = index
+    new_keys, new_rows = segment
+    at = np.searchsorted(keys, new_keys)
+    found = at < len(keys)
+    found[found] = keys[at[found]] == new_keys[found]
+    replace = found.copy()
+    if replaces is not None:
+        replace[found] = replaces(rows[at[found]], new_rows[found])
+    rows = rows.copy()
+    rows[at[replace]] = new_rows[replace]
+    added = ~found
+    return np.insert(keys, at[added], new_keys[added]), np.insert(rows, at[added], new_rows[added])
+
+def _lookup(index: Index, key: int) -> Optional[int]:
+    keys, rows = index
+    at = int(np.searchsorted(keys, np.uint64(key)))
+    if at < len(keys) and keys[at] == key:
+        return int(rows[at])
+    return None
+
+class AnalysisStore:
+    """
+    Append-only binary file of analysis results indexed by Zobrist hash.
+
+    Lookups read from a memory map of the file; writes are buffered and
+    appended in bulk. Several processes may share one file: each appends whole
+    records and remaps when it notices the file has grown. With
+    background_flush, puts never write to the file themselves; a flusher
+    thread does, so callers on an event loop are not held up by disk writes.
+    """
+
+    def __init__(self, path: str, flush_size: int = 256, flush_interval: float = 5.0,
+                 refresh_interval: float = 1.0, background_flush: bool = False):
+        self.path = path
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        self._pending: List[np.ndarray] = []
+        self._pending_scores: Dict[int, Tuple[int, int]] = {}
+        self._pending_wdls: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._mmap: Optional[mmap.mmap] = None
+        self._records = np.zeros(0, dtype=RECORD_DTYPE)
+        self._mapped_size = 0
+        # Sorted unique keys and the record row that answers for each; rows from
+        # _indexed on have not been merged in yet
+        self._score_index = _empty_index()
+        self._wdl_index = _empty_index()
+        self._indexed = 0
+        self._last_flush = time.monotonic()
+        self._last_refresh = 0.0
+        self.hits = 0
+        self.misses = 0
+        self._ensure_file()
+        self._remap()
+        self._closed = False
+        self._flush_wanted: Optional[threading.Event] = None
+        if background_flush:
+            self._flush_wanted = threading.Event()
+            threading.Thread(target=self._flush_loop, name="analysis-store-flush", daemon=True).start()
+
+    def _ensure_file(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            with open(self.path, "wb") as f:
+                f.write(_header())
+            return
+        with open(self.path, "rb") as f:
+            header = f.read(HEADER_SIZE)
+        version, record_size, _ = np.frombuffer(header[4:], dtype="<u4")
+        if header[:4] != MAGIC or version != VERSION or record_size != RECORD_DTYPE.itemsize:
+            raise ValueError(f"{self.path} is not a version {VERSION} analysis store")
+
+    def _remap(self):
+        size = os.path.getsize(self.path)
+        count = (size - HEADER_SIZE) // RECORD_DTYPE.itemsize
+        if self._mmap is not None:
+            self._records = np.zeros(0, dtype=RECORD_DTYPE)
+            self._mmap.close()
+            self._mmap = None
+        if count > 0:
+            with open(self.path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), HEADER_SIZE + count * RECORD_DTYPE.itemsize, access=mmap.ACCESS_READ)
+            self._records = np.frombuffer(self._mmap, dtype=RECORD_DTYPE, count=count, offset=HEADER_SIZE)
+        self._mapped_size = size
+        self._build_index()
+
+    def _build_index(self):
+        """Merge the records appended since the last call into the indexes."""
+        records = self._records
+        if len(records) < self._indexed:
+            # The file was replaced by a shorter one
+            self._score_index = _empty_index()
+            self._wdl_index = _empty_index()
+            self._indexed = 0
+        if len(records) == self._indexed:
+            return
+        depths = records["depth"]
+        # For scores the deepest record per key wins, later records winning ties
+        self._score_index = _merge_index(self._score_index, _index_segment(records, self._indexed, HAS_SCORE, depths),
+                                         lambda old, new: depths[new] >= depths[old])
+        # For WDL the most recent record per key wins
+        self._wdl_index = _merge_index(self._wdl_index, _index_segment(records, self._indexed, HAS_WDL), None)
+        self._indexed = len(records)
+
+    def _maybe_refresh(self):
+        now = time.monotonic()
+        if now - self._last_refresh < self.refresh_interval:
+            return
+        self._last_refresh = now
+        if os.path.getsize(self.path) != self._mapped_size:
+            self._remap()
+
+    @staticmethod
+    def key(board: chess.Board) -> int:
+        return chess.polyglot.zobrist_hash(board)
+
+    def get_score(self, board: chess.Board, depth: int) -> Optional[Tuple[chess.engine.PovScore, int]]:
+        """Return (score, depth) if a search of at least depth is stored for the position."""
+        return self._count(self._get_score(board, depth))
+
+    def get_wdl(self, board: chess.Board) -> Optional[Tuple[Tuple[int, int, int], float]]:
+        """Return (wdl, sharpness) for the position from the side to move's point of view."""
+        return self._count(self._get_wdl(board))
+
+    def _count(self, result):
+        # Unlocked increments may lose the odd count under contention, which is fine for statistics
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def _get_score(self, board: chess.Board, depth: int) -> Optional[Tuple[chess.engine.PovScore, int]]:
+        key = self.key(board)
+        with self._lock:
+            self._maybe_refresh()
+            candidates = []
+            if key in self._pending_scores:
+                candidates.append(self._pending[self._pending_scores[key][1]][0])
+            row = _lookup(self._score_index, key)
+            if row is not None:
+                candidates.append(self._records[row])
+            if not candidates:
+                return None
+            record = max(candidates, key=lambda candidate: int(candidate["depth"]))
+            stored_depth, flags = int(record["depth"]), int(record["flags"])
+            score, mate = int(record["score"]), int(record["mate"])
+        if stored_depth < depth:
+            return None
+        pov = chess.engine.Mate(mate) if flags & HAS_MATE else chess.engine.Cp(score)
+        return chess.engine.PovScore(pov, board.turn), stored_depth
+
+    def _get_wdl(self, board: chess.Board) -> Optional[Tuple[Tuple[int, int, int], float]]:
+        key = self.key(board)
+        with self._lock:
+            if key in self._pending_wdls:
+                record = self._pending[self._pending_wdls[key]][0]
+            else:
+                self._maybe_refresh()
+                row = _lookup(self._wdl_index, key)
+                if row is None:
+                    return None
+                record = self._records[row]
+            wdl = tuple(int(value) for value in record["wdl"])
+            return wdl, float(record["sharpness"])
+
+    def put_score(self, board: chess.Board, score: chess.engine.PovScore, depth: int):
+        record = np.zeros(1, dtype=RECORD_DTYPE)
+        record["key"] = self.key(board)
+        record["depth"] = depth
+        relative = score.relative
+        if relative.is_mate():
+            record["flags"] = HAS_SCORE | HAS_MATE
+            record["mate"] = relative.mate()
+        else:
+            record["flags"] = HAS_SCORE
+            record["score"] = relative.score()
+        self._append(record)
+
+    def put_wdl(self, board: chess.Board, wdl: Sequence[int], sharpness: float):
+        record = np.zeros(1, dtype=RECORD_DTYPE)
+        record["key"] = self.key(board)
+        record["flags"] = HAS_WDL
+        record["wdl"] = [wdl[0], wdl[1], wdl[2]]
+        record["sharpness"] = sharpness
+        self._append(record)
+
+    def _append(self, record: np.ndarray):
+        key = int(record["key"][0])
+        with self._lock:
+            self._pending.append(record)
+            row = len(self._pending) - 1
+            if record["flags"][0] & HAS_SCORE:
+                depth = int(record["depth"][0])
+                if key not in self._pending_scores or self._pending_scores[key][0] <= depth:
+                    self._pending_scores[key] = (depth, row)
+            if record["flags"][0] & HAS_WDL:
+                self._pending_wdls[key] = row
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+            if len(self._pending) >= self.flush_size or due:
+                if self._flush_wanted is not None:
+                    self._flush_wanted.set()
+                else:
+                    self._flush_locked()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_loop(self):
+        while True:
+            self._flush_wanted.wait()
+            self._flush_wanted.clear()
+            if self._closed:
+                return
+            try:
+                self.flush()
+            except OSError as e:
+                # The records stay pending and the next flush retries them
+                logger.error(f"Could not append to analysis store {self.path}: {str(e)}")
+
+    def _flush_locked(self):
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        data = np.concatenate(self._pending).tobytes()
+        # A single append-mode write keeps concurrent writers from interleaving partial records
+        with open(self.path, "ab") as f:
+            f.write(data)
+        logger.info(f"Appended {len(self._pending)} records to analysis store {self.path}")
+        self._pending = []
+        self._pending_scores = {}
+        self._pending_wdls = {}
+        self._remap()
+
+    def keys(self) -> np.ndarray:
+        """Unique position hashes that have at least one stored result."""
+        with self._lock:
+            pending = [record["key"] for record in self._pending]
+            # Every record has a score or a WDL, so the two indexes hold every stored key
+            return np.unique(np.concatenate([self._score_index[0], self._wdl_index[0]] + pending))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._records) + len(self._pending)
+
+    def close(self):
+        self._closed = True
+        if self._flush_wanted is not None:
+            self._flush_wanted.set()
+        with self._lock:
+            self._flush_locked()
+            if self._mmap is not None:
+                self._records = np.zeros(0, dtype=RECORD_DTYPE)
+                self._mmap.close()
+                self._mmap = None
@@ -0,0 +1,535 @@
+"""
+The API of main.py as an ASGI application on asyncio engines.
+
+Every request, job and engine search is a task on one event loop, so open
+connections and queued jobs do not each hold a thread. Run it with an ASGI
+server, e.g. ``hypercorn asgi:app --bind 0.0.0.0:5000``.
+
+Configuration, caches and response formats come from analysis_service, as in
+main.py; only the code that waits on engines is written for asyncio here.
+"""
+from quart import Quart, request, jsonify, Response, g
+from quart_cors import cors
+import chess
+from typing import Optional
+import traceback
+import logging
+import asyncio
+import time
+import metrics
+from async_engines import AsyncEnginePool
+from jobs import AsyncJobScheduler, QueueFullError
+from game_analysis import GameAnalysisPool
+from search_budget import DepthCallback, plan_search, leela_limit, run_budgeted_async
+from engine_sessions import AsyncSessionManager
+from cancellation import CancelToken, Cancelled
+from analysis_service import (analysis_cache, analysis_store, apply_root_wdls, BatchTooLargeError, best_lines_params,
+                              best_lines_result, check_batch_size, child_boards, create_game_analysis_pool,
+                              evaluate_params, fast_path, fast_path_lookup, fast_path_response, job_queue_size, job_store, job_workers,
+                              known_sharpness, latency_target, leela_options, leela_path, leela_pool_size,
+                              leela_search_time, leela_wdl_nodes, leela_wdl_refine_nodes, legacy_result,
+                              LEELA_EXTRA_ROOT_LINES, max_engine_sessions, record_search, remember_job,
+                              root_wdls_by_move, session_idle_timeout, sharpness_event, sse_event,
+                              pool_stockfish_options, stockfish_path, stockfish_pool_size, store_batch_sharpnesses,
+                              store_search, store_sharpness, analysis_event, supersede_key, wdl_batches,
+                              wdl_sharpnesses, evaluation_event, known_lines_event, stream_candidates, stream_params,
+                              tablebase_events)
+
+app = Quart(__name__)
+app = cors(app, allow_origin="http://localhost:3000")
+
+# Configure logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Global variables, set up in startup()
+sf_pool: Optional[AsyncEnginePool] = None
+leela_pool: Optional[AsyncEnginePool] = None
+session_manager: Optional[AsyncSessionManager] = None
+game_analysis_pool: Optional[GameAnalysisPool] = None
+
+# Job workers only wait on engines, so there is no reason to keep them as few as the engines
+job_scheduler = AsyncJobScheduler(job_store, workers=job_workers, max_queued=job_queue_size)
+
+metrics.JOB_QUEUE_DEPTH.set_function(job_scheduler.queue_depth)
+
+@app.before_serving
+async def startup():
+    global sf_pool, leela_pool, session_manager
+    sf_pool = AsyncEnginePool("stockfish", stockfish_path, pool_stockfish_options, size=stockfish_pool_size)
+    leela_pool = AsyncEnginePool("leela", leela_path, leela_options, size=leela_pool_size)
+    await asyncio.gather(sf_pool.start(), leela_pool.start())
+    logger.info(f"Engine pools started: {stockfish_pool_size} Stockfish, {leela_pool_size} Leela Chess Zero")
+    if max_engine_sessions > 0:
+        session_manager = AsyncSessionManager(sf_pool, max_engine_sessions, idle_timeout=session_idle_timeout)
+
+@app.after_serving
+async def shutdown():
+    await job_scheduler.close()
+    if session_manager is not None:
+        await session_manager.close()
+    await asyncio.gather(sf_pool.close(), leela_pool.close())
+    if game_analysis_pool is not None:
+        await asyncio.to_thread(game_analysis_pool.close)
+    # The final flush writes to disk, so it is kept off the event loop
+    await asyncio.to_thread(analysis_store.flush)
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+async def record_request_time(response):
+    # Streamed responses are timed until their headers are sent
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.REQUEST_SECONDS.labels(endpoint, request.method, response.status_code).observe(
+        time.perf_counter() - g.request_started)
+    return response
+
+async def read_json():
+    """The request's JSON body, or an error response to return instead."""
+    if not request.is_json:
+        logger.warning("Request Content-Type is not application/json")
+        return None, (jsonify({"error": "Content-Type must be application/json"}), 415)
+    data = await request.get_json(silent=True)
+    if data is None:
+        logger.warning("Failed to parse JSON data")
+        return None, (jsonify({"error": "Invalid JSON data"}), 400)
+    return data, None
+
+def submit_job(kind: str, message: str, supersede=None, **params):
+    try:
+        job = job_scheduler.submit(kind, supersede=supersede, **params)
+    except QueueFullError as e:
+        logger.warning(f"Rejecting {kind} request: {str(e)}")
+        return jsonify({"error": "Server is busy, try again later"}), 503
+    remember_job(job)
+    return jsonify({"message": message, "job_id": job.id}), 202
+
+async def answer_from_fast_path(kind: str, message: str, lookup, fen: str, params: dict, supersede=None):
+    """A completed response when the book or tablebases know the position, otherwise None."""
+    # Book and tablebase probes read files, so they run off the event loop
+    result = await asyncio.to_thread(fast_path_lookup, lookup, fen)
+    answer = fast_path_response(kind, message, result, fen, params, supersede, job_scheduler)
+    return (jsonify(answer), 200) if answer is not None else None
+
+def legacy_result_response(kind: str, field: str):
+    return jsonify(legacy_result(kind, field, request.args.get('job_id')))
+
+async def search_lines(board: chess.Board, depth: int, multipv: int = 1, latency_ms: Optional[int] = None,
+                       session_id: Optional[str] = None, on_depth: Optional[DepthCallback] = None):
+    budget = plan_search(board, depth, latency_ms / 1000 if latency_ms else latency_target,
+                         job_scheduler.queue_depth(), job_scheduler.workers)
+    logger.info(f"Searching with {budget}")
+    with metrics.STAGE_SECONDS.labels("stockfish_search").time():
+        if session_id is not None and session_manager is not None:
+            lines, reached_depth, satisfied_depth = await session_manager.analyse(session_id, board.fen(), budget,
+                                                                                  multipv=multipv, on_depth=on_depth)
+        else:
+            async with sf_pool.checkout() as sf:
+                lines, reached_depth, satisfied_depth = await run_budgeted_async(sf, board, budget, multipv=multipv,
+                                                                                 on_depth=on_depth)
+    record_search("stockfish", lines, reached_depth)
+    return lines, reached_depth, satisfied_depth
+
+async def evaluate_position_job(fen: str, depth: int, latency_ms: Optional[int] = None, session_id: Optional[str] = None):
+    board = chess.Board(fen)
+    lines = analysis_cache.get(board, depth)
+    if lines is not None:
+        logger.info(f"Serving evaluation from cache: FEN={fen}, depth={depth}")
+        score = lines[0]["score"]
+    else:
+        stored = await asyncio.to_thread(analysis_store.get_score, board, depth)
+        if stored is not None:
+            logger.info(f"Serving evaluation from analysis store: FEN={fen}, depth={stored[1]}")
+            score = stored[0]
+        else:
+            lines, reached_depth, satisfied_depth = await search_lines(board, depth, latency_ms=latency_ms,
+                                                                       session_id=session_id)
+            store_search(board, lines, reached_depth, satisfied_depth)
+            score = lines[0]["score"]
+    evaluation = score.relative.score(mate_score=100000)
+    logger.info(f"Analysis complete. Evaluation: {evaluation}")
+    return {"evaluation": evaluation}
+
+@app.route('/evaluate', methods=['POST'])
+async def evaluate_position():
+    data, error = await read_json()
+    if error is not None:
+        return error
+
+    params = evaluate_params(data)
+    fen = params["fen"]
+
+    if not fen:
+        logger.warning("FEN string not provided in request")
+        return jsonify({"error": "FEN string is required"}), 400
+
+    logger.info(f"Evaluating position: FEN={fen}, depth={params['depth']}")
+
+    supersede = supersede_key("evaluate", data)
+    answered = await answer_from_fast_path("evaluate", "Evaluation answered from tablebases", fast_path.evaluate,
+                                           fen, params, supersede)
+    if answered is not None:
+        return answered
+
+    return submit_job("evaluate", "Evaluation request received", supersede, **params)
+
+@app.route('/evaluation-result', methods=['GET'])
+async def get_evaluation_result():
+    return legacy_result_response("evaluate", "evaluation")
+
+async def known_sharpnesses(boards: list) -> list:
+    """known_sharpness of each board, looked up off the event loop as it reads the tablebases and the store."""
+    return await asyncio.to_thread(lambda: [known_sharpness(board) for board in boards])
+
+async def leela_sharpness(board: chess.Board) -> float:
+    known = await asyncio.to_thread(known_sharpness, board)
+    if known is not None:
+        return known
+
+    with metrics.STAGE_SECONDS.labels("leela_wdl").time():
+        async with leela_pool.checkout() as leela:
+            result = await leela.analyse_wdl(board, leela_wdl_nodes, leela_wdl_refine_nodes)
+    record_search("leela", [result])
+    return store_sharpness(board, result)
+
+async def leela_sharpnesses(boards: list) -> list:
+    """leela_sharpness for many positions, with the unknown ones sent as one WDL batch per Leela engine."""
+    sharpnesses = await known_sharpnesses(boards)
+    pending = [i for i, sharpness in enumerate(sharpnesses) if sharpness is None]
+    if not pending:
+        return sharpnesses
+
+    async def run(batch):
+        async with leela_pool.checkout() as leela:
+            return await leela.analyse_wdls([boards[i] for i in batch], leela_wdl_nodes, leela_wdl_refine_nodes)
+    batches = wdl_batches(pending, leela_pool.size)
+    with metrics.STAGE_SECONDS.labels("leela_wdl").time():
+        results = await asyncio.gather(*(run(batch) for batch in batches))
+    store_batch_sharpnesses(boards, sharpnesses, batches, results)
+    return sharpnesses
+
+async def sharpness_calculation_job(fen: str):
+    sharpness = await leela_sharpness(chess.Board(fen))
+    logger.info(f"Sharpness calculation complete. Sharpness: {sharpness}")
+    return {"sharpness": sharpness}
+
+@app.route('/sharpness', methods=['POST'])
+async def calculate_sharpness():
+    data, error = await read_json()
+    if error is not None:
+        return error
+
+    fen = data.get('fen')
+
+    if not fen:
+        logger.warning("FEN string not provided in request")
+        return jsonify({"error": "FEN string is required"}), 400
+
+    logger.info(f"Calculating sharpness for position: FEN={fen}")
+
+    supersede = supersede_key("sharpness", data)
+    answered = await answer_from_fast_path("sharpness", "Sharpness answered from tablebases", fast_path.sharpness,
+                                           fen, {"fen": fen}, supersede)
+    if answered is not None:
+        return answered
+
+    return submit_job("sharpness", "Sharpness calculation request received", supersede, fen=fen)
+
+@app.route('/sharpness-result', methods=['GET'])
+async def get_sharpness_result():
+    return legacy_result_response("sharpness", "sharpness")
+
+async def sharpness_batch_calculation_job(fens: list):
+    sharpnesses = await leela_sharpnesses([chess.Board(fen) for fen in fens])
+    logger.info(f"Batch sharpness calculation complete for {len(fens)} positions")
+    return {"sharpness": sharpnesses}
+
+@app.route('/sharpness-batch', methods=['POST'])
+async def calculate_sharpness_batch():
+    data, error = await read_json()
+    if error is not None:
+        return error
+
+    wdls = data.get('wdls')
+    fens = data.get('fens')
+
+    if wdls is not None:
+        try:
+            sharpnesses = wdl_sharpnesses(wdls)
+        except BatchTooLargeError as e:
+            logger.warning("Too many WDLs in batch sharpness request")
+            return jsonify({"error": str(e)}), 413
+        except ValueError as e:
+            logger.warning("Invalid WDL list in batch sharpness request")
+            return jsonify({"error": str(e)}), 400
+        logger.info(f"Batch sharpness calculated for {len(sharpnesses)} WDLs")
+        return jsonify({"status": "completed", "sharpness": sharpnesses})
+
+    if not fens or not isinstance(fens, list):
+        logger.warning("Neither WDLs nor FEN strings provided in request")
+        return jsonify({"error": "Either wdls or a list of FEN strings is required"}), 400
+    try:
+        check_batch_size(fens)
+    except BatchTooLargeError as e:
+        logger.warning("Too many FENs in batch sharpness request")
+        return jsonify({"error": str(e)}), 413
+
+    logger.info(f"Calculating batch sharpness for {len(fens)} positions")
+
+    return submit_job("sharpness_batch", "Batch sharpness calculation request received", fens=fens)
+
+async def leela_root_wdls(board: chess.Board, multipv: int) -> dict:
+    with metrics.STAGE_SECONDS.labels("leela_wdl").time():
+        async with leela_pool.checkout() as leela:
+            infos = await leela.analyse_with_multipv(board, leela_limit(leela_search_time, job_scheduler.queue_depth(), job_scheduler.workers),
+                                                     multipv=multipv)
+    return root_wdls_by_move(infos)
+
+async def score_candidates(board: chess.Board, moves: list, root_wdls: Optional[asyncio.Task] = None) -> list:
+    """score_candidates of main.py, with the Leela searches as tasks instead of executor threads."""
+    children = child_boards(board, moves)
+    sharpnesses = await known_sharpnesses(children)
+
+    if root_wdls is not None and None in sharpnesses:
+        try:
+            wdls = await root_wdls
+        except Exception as e:
+            logger.error(f"Leela root move scoring failed, scoring candidates one by one: {str(e)}")
+            wdls = {}
+        apply_root_wdls(moves, children, sharpnesses, wdls)
+    elif root_wdls is not None:
+        root_wdls.cancel()
+
+    pending = [i for i in range(len(moves)) if sharpnesses[i] is None]
+    for i, sharpness in zip(pending, await leela_sharpnesses([children[i] for i in pending])):
+        sharpnesses[i] = sharpness
+    return sharpnesses
+
+async def best_lines_calculation_job(current_fen: str, number_of_lines: int, depth: int, latency_ms: Optional[int] = None,
+                                     session_id: Optional[str] = None):
+    board = chess.Board(current_fen)
+    info = analysis_cache.get(board, depth, multipv=number_of_lines)
+    root_wdls = None
+    if info is None:
+        leela_lines = min(number_of_lines + LEELA_EXTRA_ROOT_LINES, board.legal_moves.count())
+        if leela_lines > 0:
+            root_wdls = asyncio.create_task(leela_root_wdls(board.copy(), leela_lines))
+        try:
+            info, reached_depth, satisfied_depth = await search_lines(board, depth, number_of_lines, latency_ms,
+                                                                      session_id)
+        except BaseException:
+            if root_wdls is not None:
+                root_wdls.cancel()
+            raise
+        store_search(board, info, reached_depth, satisfied_depth)
+    else:
+        logger.info(f"Serving best lines from cache: FEN={current_fen}, depth={depth}")
+
+    with metrics.STAGE_SECONDS.labels("sharpness").time():
+        sharpnesses = await score_candidates(board, [line_info['pv'][0] for line_info in info], root_wdls)
+    return best_lines_result(board, info, sharpnesses)
+
+@app.route('/best-lines', methods=['POST'])
+async def get_best_lines():
+    data, error = await read_json()
+    if error is not None:
+        return error
+
+    params = best_lines_params(data)
+    current_fen, number_of_lines = params["current_fen"], params["number_of_lines"]
+
+    if not current_fen:
+        logger.warning("FEN string not provided in request")
+        return jsonify({"error": "FEN string is required"}), 400
+
+    logger.info(f"Getting best lines: FEN={current_fen}, number_of_lines={number_of_lines}, depth={params['depth']}")
+
+    supersede = supersede_key("best_lines", data)
+    answered = await answer_from_fast_path("best_lines", "Best lines answered without a search",
+                                           lambda board: fast_path.best_lines(board, number_of_lines), current_fen,
+                                           params, supersede)
+    if answered is not None:
+        return answered
+
+    return submit_job("best_lines", "Best lines calculation request received", supersede, **params)
+
+@app.route('/best-lines-result', methods=['GET'])
+async def get_best_lines_result():
+    return legacy_result_response("best_lines", "best_lines")
+
+def sse_response(events) -> Response:
+    response = Response(events, mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Streams last as long as the analysis does
+    response.timeout = None
+    return response
+
+async def analysis_stream(board: chess.Board, params: dict, supersede):
+    """The events of one stream, run as a job of its own as in main.py."""
+    job = job_scheduler.start("analysis_stream", supersede, **params)
+    error = None
+    try:
+        async for event in analysis_events(board, cancel=job.cancel_token, **params):
+            yield event
+    except Cancelled as e:
+        logger.info(f"Stopping superseded analysis stream: FEN={params['fen']}")
+        error = e
+        yield sse_event("superseded", {"fen": params["fen"]})
+    except (GeneratorExit, asyncio.CancelledError) as e:
+        # The client closed the connection; leaving the with-blocks stops the search
+        job.cancel_token.cancel()
+        error = e
+        raise
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        job_scheduler.finish(job, error=error)
+
+async def analysis_events(board: chess.Board, fen: str, depth: int, multipv: int, sharpness: bool,
+                          latency_ms: Optional[int], session_id: Optional[str], cancel: CancelToken):
+    """analysis_events of main.py, with the book, tablebase and store reads off the event loop."""
+    known = await asyncio.to_thread(fast_path_lookup, lambda position: fast_path.best_lines(position, multipv), fen)
+    if known is not None:
+        yield known_lines_event(fen, known)
+        if known["source"] == "tablebase":
+            for event in await asyncio.to_thread(tablebase_events, board, fen, known, sharpness):
+                yield event
+            return
+        multipv = 1
+    lines = analysis_cache.get(board, depth, multipv=multipv)
+    stored = None
+    if lines is None and multipv == 1:
+        # Stored scores carry no moves, which one line or book lines do without
+        stored = await asyncio.to_thread(analysis_store.get_score, board, depth)
+    if lines is not None:
+        logger.info(f"Streaming analysis from cache: FEN={fen}, depth={depth}")
+        yield analysis_event(board, fen, depth, lines)
+        reached_depth = depth
+    elif stored is not None:
+        logger.info(f"Streaming evaluation from analysis store: FEN={fen}, depth={stored[1]}")
+        yield evaluation_event(fen, stored[0].relative.score(mate_score=100000), stored[1], "store")
+        lines, reached_depth = [], stored[1]
+    else:
+        updates = asyncio.Queue()
+        search = asyncio.ensure_future(search_lines(board, depth, multipv, latency_ms, session_id,
+                                                    on_depth=lambda lines, reached: updates.put_nowait((lines, reached))))
+        search.add_done_callback(lambda _: updates.put_nowait(None))
+        reported = 0
+        try:
+            # Superseding the stream cancels the search task, which stops the engine
+            with cancel.stopping(search.cancel):
+                while (update := await updates.get()) is not None:
+                    lines, reported = update
+                    yield analysis_event(board, fen, reported, lines)
+        finally:
+            search.cancel()
+        if search.cancelled():
+            raise Cancelled("Superseded by a newer request")
+        lines, reached_depth, satisfied_depth = search.result()
+        if reached_depth > reported:
+            yield analysis_event(board, fen, reached_depth, lines)
+        store_search(board, lines, reached_depth, satisfied_depth)
+    if sharpness:
+        cancel.check()
+        try:
+            with metrics.STAGE_SECONDS.labels("sharpness").time():
+                position, candidates = await asyncio.gather(
+                    leela_sharpness(board), score_candidates(board, stream_candidates(board, known, lines)))
+            yield sharpness_event(fen, position, candidates)
+        except Exception as e:
+            logger.error(f"Error scoring streamed position: {str(e)}")
+            logger.error(traceback.format_exc())
+    yield sse_event("done", {"fen": fen, "depth": reached_depth})
+
+@app.route('/analysis-stream', methods=['GET'])
+async def stream_analysis():
+    params = stream_params(request.args)
+    fen = params["fen"]
+
+    if not fen:
+        logger.warning("FEN string not provided in request")
+        return jsonify({"error": "FEN string is required"}), 400
+
+    try:
+        board = chess.Board(fen)
+    except ValueError:
+        logger.warning(f"Invalid FEN string: {fen}")
+        return jsonify({"error": "Invalid FEN string"}), 400
+
+    logger.info(f"Streaming analysis: FEN={fen}, depth={params['depth']}, multipv={params['multipv']}, "
+                f"sharpness={params['sharpness']}, session_id={params['session_id']}")
+
+    return sse_response(analysis_stream(board, params, supersede_key("analysis_stream", request.args)))
+
+def get_game_analysis_pool() -> GameAnalysisPool:
+    global game_analysis_pool
+    if game_analysis_pool is None:
+        game_analysis_pool = create_game_analysis_pool()
+    return game_analysis_pool
+
+async def game_analysis_events(pgn: str, depth: int):
+    # The game analysis pool is process based; only waiting for its next result is moved off the event loop
+    try:
+        plies = get_game_analysis_pool().analyse_game(pgn, depth=depth)
+        while True:
+            ply = await asyncio.to_thread(next, plies, None)
+            if ply is None:
+                break
+            yield sse_event("ply", ply)
+    except ValueError as e:
+        logger.warning(f"Invalid PGN in game analysis request: {str(e)}")
+        yield sse_event("error", {"error": str(e)})
+        return
+    except Exception as e:
+        logger.error(f"Error during game analysis: {str(e)}")
+        logger.error(traceback.format_exc())
+        yield sse_event("error", {"error": "Game analysis failed"})
+        return
+    yield sse_event("done", {})
+
+@app.route('/analyse-pgn', methods=['POST'])
+async def analyse_pgn():
+    data, error = await read_json()
+    if error is not None:
+        return error
+
+    pgn = data.get('pgn')
+    depth = data.get('depth', 16)
+
+    if not pgn:
+        logger.warning("PGN not provided in request")
+        return jsonify({"error": "PGN is required"}), 400
+
+    logger.info(f"Analysing game: {len(pgn)} characters of PGN, depth={depth}")
+
+    return sse_response(game_analysis_events(pgn, depth))
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+async def get_job(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/metrics', methods=['GET'])
+async def get_metrics():
+    return Response(metrics.REGISTRY.exposition(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+async def close_session(session_id):
+    if session_manager is None or not await session_manager.close_session(session_id):
+        return jsonify({"error": "Session not found"}), 404
+    return jsonify({"message": "Session closed"})
+
+job_scheduler.register("evaluate", evaluate_position_job)
+job_scheduler.register("sharpness", sharpness_calculation_job)
+job_scheduler.register("best_lines", best_lines_calculation_job)
+job_scheduler.register("sharpness_batch", sharpness_batch_calculation_job)
+
+
+if __name__ == '__main__':
+    logger.info("Starting Quart application")
+    app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import traceback
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Sequence
+
+import chess
+import chess.engine
+
+from chess_engines import WDL_NODES, engine_command, engine_failed, needs_refinement, split_engine_options
+from metrics import ENGINE_CRASHES, ENGINE_START_FAILURES, ENGINE_STARTS
+
+logger = logging.getLogger(__name__)
+
+ENGINE_TYPES = ("stockfish", "leela")
+
+# How long ping and quit may take before the engine is treated as hung
+ENGINE_COMMAND_TIMEOUT = 10.0
+
+class AsyncChessEngine:
+    """
+    An engine process driven by python-chess's asyncio UCI protocol. Unlike
+    ChessEngine there is no background thread per engine; every call is a
+    coroutine on the caller's event loop.
+    """
+
+    def __init__(self, transport: asyncio.SubprocessTransport, protocol: chess.engine.UciProtocol):
+        self.transport = transport
+        self.protocol = protocol
+
+    @classmethod
+    async def open(cls, engine_path: str, options: Dict[str, str]) -> "AsyncChessEngine":
+        transport, protocol = await chess.engine.popen_uci(engine_command(engine_path))
+        try:
+            await protocol.configure(options)
+        except Exception:
+            transport.close()
+            raise
+        return cls(transport, protocol)
+
+    async def analyse(self, board: chess.Board, limit: chess.engine.Limit, game: object = None):
+        return await self.protocol.analyse(board, limit, game=game)
+
+    async def analyse_with_multipv(self, board: chess.Board, limit: chess.engine.Limit, multipv: int, game: object = None):
+        return await self.protocol.analyse(board, limit, multipv=multipv, game=game)
+
+    async def analyse_wdl(self, board: chess.Board, nodes: int = WDL_NODES, refine_nodes: int = 0, game: object = None):
+        """LeelaEngine.analyse_wdl: a node-limited WDL search, refined where both sides have winning chances."""
+        info = await self.analyse(board, chess.engine.Limit(nodes=nodes), game=game)
+        if needs_refinement(info, nodes, refine_nodes):
+            info = await self.analyse(board, chess.engine.Limit(nodes=refine_nodes), game=game)
+        return info
+
+    async def analyse_wdls(self, boards: Sequence[chess.Board], nodes: int = WDL_NODES,
+                           refine_nodes: int = 0) -> List[Dict[str, Any]]:
+        return [await self.analyse_wdl(board, nodes, refine_nodes) for board in boards]
+
+    async def analysis(self, board: chess.Board, limit: Optional[chess.engine.Limit] = None,
+                       multipv: Optional[int] = None, game: object = None) -> chess.engine.AnalysisResult:
+        """Start a search and return a handle that yields info dicts with async for."""
+        return await self.protocol.analysis(board, limit, multipv=multipv, game=game)
+
+    async def ping(self):
+        await asyncio.wait_for(self.protocol.ping(), ENGINE_COMMAND_TIMEOUT)
+
+    async def quit(self):
+        try:
+            await asyncio.wait_for(self.protocol.quit(), ENGINE_COMMAND_TIMEOUT)
+        finally:
+            self.transport.close()
+
+async def create_async_engine(engine_type: str, engine_path: str, options: Dict[str, str]) -> AsyncChessEngine:
+    if engine_type not in ENGINE_TYPES:
+        raise ValueError(f"Unsupported engine type: {engine_type}")
+    return await AsyncChessEngine.open(engine_path, options)
+
+class AsyncEnginePool:
+    """
+    EnginePool for AsyncChessEngine. Waiting for an engine suspends the
+    calling task instead of blocking a thread, so any number of requests can
+    wait on a handful of engine processes.
+
+    Engines are started by start(), which must run on the event loop the pool
+    is used from.
+    """
+
+    def __init__(self, engine_type: str, engine_path: str, options: Dict[str, str],
+                 size: int = 1, health_check_interval: float = 30.0):
+        if size < 1:
+            raise ValueError(f"Engine pool size must be at least 1, got {size}")
+        self.engine_type = engine_type
+        self.engine_path = engine_path
+        self.size = size
+        self.member_options = split_engine_options(options, size)
+        self.health_check_interval = health_check_interval
+        # Idle slots hold either a live engine or None for a process that still needs spawning
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._health_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    async def start(self):
+        engines = await asyncio.gather(*(self._try_spawn() for _ in range(self.size)))
+        for engine in engines:
+            self._idle.put_nowait(engine)
+        self._health_task = asyncio.create_task(self._health_check_loop())
+
+    async def _spawn(self) -> AsyncChessEngine:
+        try:
+            engine = await create_async_engine(self.engine_type, self.engine_path, self.member_options)
+        except Exception:
+            ENGINE_START_FAILURES.labels(self.engine_type).inc()
+            raise
+        ENGINE_STARTS.labels(self.engine_type).inc()
+        logger.info(f"Started {self.engine_type} engine process with options {self.member_options}")
+        return engine
+
+    async def _try_spawn(self) -> Optional[AsyncChessEngine]:
+        try:
+            return await self._spawn()
+        except Exception as e:
+            logger.error(f"Failed to start {self.engine_type} engine: {str(e)}")
+            logger.error(traceback.format_exc())
+            return None
+
+    async def _discard(self, engine: Optional[AsyncChessEngine]):
+        if engine is None:
+            return
+        try:
+            await engine.quit()
+        except Exception as e:
+            logger.error(f"Error shutting down {self.engine_type} engine: {str(e)}")
+
+    async def acquire(self, timeout: Optional[float] = None) -> AsyncChessEngine:
+        """Take an engine out of the pool until release() is called. Prefer checkout() for short use."""
+        try:
+            engine = await asyncio.wait_for(self._idle.get(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"No {self.engine_type} engine available within {timeout} seconds")
+        if engine is None:
+            try:
+                engine = await self._spawn()
+            except Exception:
+                self._idle.put_nowait(None)
+                raise
+        return engine
+
+    async def release(self, engine: AsyncChessEngine, healthy: bool = True):
+        if not healthy:
+            # Treat the process as suspect; the health check or the next checkout replaces it
+            ENGINE_CRASHES.labels(self.engine_type).inc()
+            await self._discard(engine)
+            engine = None
+        self._idle.put_nowait(engine)
+
+    @asynccontextmanager
+    async def checkout(self, timeout: Optional[float] = None):
+        """Borrow an engine for the duration of an async with-block, waiting up to timeout seconds."""
+        engine = await self.acquire(timeout)
+        healthy = True
+        try:
+            yield engine
+        except Exception as e:
+            healthy = not engine_failed(e)
+            raise
+        finally:
+            # A cancelled caller has already stopped its search on the way out, so the engine goes back as it is
+            await asyncio.shield(self.release(engine, healthy))
+
+    async def _health_check_loop(self):
+        while not self._closed:
+            await asyncio.sleep(self.health_check_interval)
+            await self.health_check()
+
+    async def health_check(self):
+        """Ping the idle engines and respawn the ones that are dead, taking one at a time so callers are not starved."""
+        for _ in range(self._idle.qsize()):
+            if self._idle.empty():
+                break
+            engine = self._idle.get_nowait()
+            if engine is not None:
+                try:
+                    await engine.ping()
+                except Exception as e:
+                    logger.warning(f"{self.engine_type} engine failed health check: {str(e)}")
+                    ENGINE_CRASHES.labels(self.engine_type).inc()
+                    await self._discard(engine)
+                    engine = None
+            if engine is None and not self._closed:
+                engine = await self._try_spawn()
+            self._idle.put_nowait(engine)
+
+    async def close(self):
+        self._closed = True
+        if self._health_task is not None:
+            self._health_task.cancel()
+        for _ in range(self.size):
+            await self._discard(await self._idle.get())
@@ -0,0 +1,205 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import chess
+import chess.engine
+import chess.pgn
+import chess.polyglot
+
+from analysis_store import AnalysisStore
+from chess_engines import split_engine_options
+from game_analysis import init_worker, worker_engines
+from sharpness import SharpnessTable
+
+logger = logging.getLogger(__name__)
+
+def analyse_position(task: Tuple[str, int, int]) -> Dict:
+    """Runs in a worker process: score one position, plus its WDL when Leela is enabled."""
+    fen, depth, leela_nodes = task
+    stockfish_pool, leela_pool = worker_engines()
+    board = chess.Board(fen)
+    with stockfish_pool.checkout() as stockfish:
+        info = stockfish.analyse(board, chess.engine.Limit(depth=depth))
+    result = {"fen": fen, "score": info["score"], "depth": depth, "wdl": None}
+    if leela_pool is not None:
+        with leela_pool.checkout() as leela:
+            wdl = leela.analyse(board, chess.engine.Limit(nodes=leela_nodes)).get("wdl")
+        if wdl is not None:
+            result["wdl"] = (wdl[0], wdl[1], wdl[2])
+    return result
+
+def read_items(path: str, skip: int) -> Iterator[List[chess.Board]]:
+    """
+    Stream the positions of a PGN or EPD file one item (game or EPD line) at a
+    time, without loading the file into memory. The first skip items are
+    passed over without being parsed into positions.
+    """
+    if path.lower().endswith(".epd"):
+        with open(path, encoding="utf-8-sig") as f:
+            for number, line in enumerate(f):
+                if number < skip:
+                    continue
+                line = line.strip()
+                if not line:
+                    yield []
+                    continue
+                try:
+                    board, _ = chess.Board.from_epd(line)
+                except ValueError as e:
+                    logger.warning(f"Skipping invalid EPD line {number + 1} in {path}: {str(e)}")
+                    yield []
+                    continue
+                yield [board]
+        return
+
+    with open(path, encoding="utf-8-sig", errors="replace") as f:
+        for _ in range(skip):
+            if not chess.pgn.skip_game(f):
+                return
+        while True:
+            game = chess.pgn.read_game(f)
+            if game is None:
+                return
+            board = game.board()
+            boards = [board.copy(stack=False)]
+            for move in game.mainline_moves():
+                board.push(move)
+                boards.append(board.copy(stack=False))
+            yield boards
+
+class Checkpoint:
+    """Progress through the input files, written only once a chunk's results are on disk."""
+
+    def __init__(self, path: str, inputs: List[str]):
+        self.path = path
+        self.inputs = inputs
+        self.file_index = 0
+        self.items_done = 0
+        self.positions_written = 0
+
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, encoding="utf-8") as f:
+            state = json.load(f)
+        if state["inputs"] != self.inputs:
+            raise ValueError(f"Checkpoint {self.path} belongs to different inputs: {state['inputs']}")
+        self.file_index = state["file_index"]
+        self.items_done = state["items_done"]
+        self.positions_written = state["positions_written"]
+        return True
+
+    def save(self):
+        state = {"inputs": self.inputs, "file_index": self.file_index, "items_done": self.items_done,
+                 "positions_written": self.positions_written}
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        # Atomic replace, so an interrupted write leaves the previous checkpoint intact
+        os.replace(temp_path, self.path)
+
+class BatchAnalyser:
+    def __init__(self, inputs: List[str], output: str, pool, depth: int, leela_nodes: int,
+                 max_ply: Optional[int] = None, chunk_size: int = 5000, sharpness_table: Optional[SharpnessTable] = None):
+        self.inputs = [os.path.abspath(path) for path in inputs]
+        self.store = AnalysisStore(output, flush_size=chunk_size * 2)
+        self.checkpoint = Checkpoint(output + ".checkpoint.json", self.inputs)
+        self.pool = pool
+        self.depth = depth
+        self.leela_nodes = leela_nodes
+        self.max_ply = max_ply
+        self.chunk_size = chunk_size
+        self.sharpness_table = sharpness_table if sharpness_table is not None else SharpnessTable.build()
+        # Positions already in the output, so a resumed run never repeats work
+        self.seen: Set[int] = set(self.store.keys().tolist())
+
+    def chunks(self) -> Iterator[Tuple[List[str], int, int]]:
+        """Yield (fens, file_index, items_done) with at least chunk_size new positions each."""
+        for file_index in range(self.checkpoint.file_index, len(self.inputs)):
+            items_done = self.checkpoint.items_done if file_index == self.checkpoint.file_index else 0
+            fens: List[str] = []
+            for boards in read_items(self.inputs[file_index], items_done):
+                items_done += 1
+                for ply, board in enumerate(boards):
+                    if self.max_ply is not None and ply > self.max_ply:
+                        break
+                    if board.is_game_over():
+                        continue
+                    key = chess.polyglot.zobrist_hash(board)
+                    if key in self.seen:
+                        continue
+                    self.seen.add(key)
+                    fens.append(board.fen())
+                if len(fens) >= self.chunk_size:
+                    yield fens, file_index, items_done
+                    fens = []
+            yield fens, file_index + 1, 0
+
+    def run(self):
+        if self.checkpoint.load():
+            logger.info(f"Resuming from {self.inputs[min(self.checkpoint.file_index, len(self.inputs) - 1)]}, "
+                        f"item {self.checkpoint.items_done}, {self.checkpoint.positions_written} positions written")
+        started = time.monotonic()
+        for fens, file_index, items_done in self.chunks():
+            tasks = [(fen, self.depth, self.leela_nodes) for fen in fens]
+            results = list(self.pool.imap_unordered(analyse_position, tasks, chunksize=8))
+            # Sharpness for the whole chunk in one table gather
+            wdl_results = [result for result in results if result["wdl"] is not None]
+            sharpnesses = self.sharpness_table.lookup([result["wdl"] for result in wdl_results]) if wdl_results else []
+            for result in results:
+                self.store.put_score(chess.Board(result["fen"]), result["score"], result["depth"])
+            for result, sharpness in zip(wdl_results, sharpnesses):
+                self.store.put_wdl(chess.Board(result["fen"]), result["wdl"], sharpness)
+            self.store.flush()
+            self.checkpoint.file_index = file_index
+            self.checkpoint.items_done = items_done
+            self.checkpoint.positions_written += len(fens)
+            self.checkpoint.save()
+            elapsed = time.monotonic() - started
+            logger.info(f"Checkpoint: {self.checkpoint.positions_written} positions written, "
+                        f"{len(self.seen)} unique positions seen, {elapsed:.0f}s elapsed")
+        self.store.close()
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Precompute evaluations and sharpness for large PGN/EPD corpora.")
+    parser.add_argument("inputs", nargs="+", help="PGN or EPD (.epd) files")
+    parser.add_argument("--output", required=True, help="Analysis store file; also readable via ANALYSIS_STORE_PATH")
+    parser.add_argument("--workers", type=int, default=max((os.cpu_count() or 2) // 2, 1))
+    parser.add_argument("--depth", type=int, default=16)
+    parser.add_argument("--max-ply", type=int, default=None, help="Only analyse the first plies of each game")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="Positions per checkpoint")
+    parser.add_argument("--stockfish", default=os.environ.get("STOCKFISH_PATH", "stockfish"))
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1, help="Stockfish threads shared by all workers")
+    parser.add_argument("--hash", type=int, default=1024, help="Stockfish hash in MB shared by all workers")
+    parser.add_argument("--leela", default=os.environ.get("LEELA_PATH"), help="lc0 executable; enables WDL and sharpness")
+    parser.add_argument("--weights", default=os.environ.get("LEELA_WEIGHTS_PATH"))
+    parser.add_argument("--leela-nodes", type=int, default=400)
+    parser.add_argument("--sharpness-table", default=os.environ.get("SHARPNESS_TABLE_PATH"),
+                        help="Sharpness lookup table (.npy), built there if missing")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    leela_options = {'UCI_ShowWDL': 'true'}
+    if args.weights:
+        leela_options['WeightsFile'] = args.weights
+    stockfish_options = split_engine_options({'Threads': str(args.threads), 'Hash': str(args.hash)}, args.workers)
+    pool = multiprocessing.get_context("spawn").Pool(
+        processes=args.workers, initializer=init_worker,
+        initargs=(args.stockfish, stockfish_options, args.leela, leela_options))
+    try:
+        BatchAnalyser(args.inputs, args.output, pool, args.depth, args.leela_nodes,
+                      max_ply=args.max_ply, chunk_size=args.chunk_size,
+                      sharpness_table=SharpnessTable.load_or_build(args.sharpness_table)).run()
+    finally:
+        pool.close()
+        pool.join()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,53 @@
+import threading
+from contextlib import contextmanager
+from typing import Callable, List
+
+class Cancelled(Exception):
+    """Raised in a job whose request was superseded by a newer one."""
+
+class CancelToken:
+    """
+    Cancellation flag for one request. Engine searches register their stop
+    function while they run, so cancel() ends them straight away instead of
+    leaving the engine busy with a position nobody is waiting for.
+    """
+
+    def __init__(self):
+        self._cancelled = False
+        self._stops: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def cancel(self) -> bool:
+        """Cancel and stop every registered search; False if already cancelled."""
+        with self._lock:
+            if self._cancelled:
+                return False
+            self._cancelled = True
+            stops = list(self._stops)
+        for stop in stops:
+            stop()
+        return True
+
+    def check(self):
+        if self._cancelled:
+            raise Cancelled("Superseded by a newer request")
+
+    @contextmanager
+    def stopping(self, stop: Callable[[], None]):
+        """Call stop on cancellation while the with-block runs, or at once if already cancelled."""
+        with self._lock:
+            cancelled = self._cancelled
+            if not cancelled:
+                self._stops.append(stop)
+        if cancelled:
+            stop()
+        try:
+            yield
+        finally:
+            if not cancelled:
+                with self._lock:
+                    self._stops.remove(stop)
@@ -1,19 +1,49 @@
 import chess
 import chess.engine
-from typing import Dict
+import logging
+import queue
+import sys
+import threading
+import traceback
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+from metrics import ENGINE_CRASHES, ENGINE_START_FAILURES, ENGINE_STARTS
+
+logger = logging.getLogger(__name__)
+
+def engine_command(engine_path: str) -> Union[str, List[str]]:
+    """Python scripts, such as the fake engine used by the benchmarks, run under the current interpreter."""
+    if engine_path.endswith(".py"):
+        return [sys.executable, engine_path]
+    return engine_path
+
+def engine_failed(error: BaseException) -> bool:
+    """Whether error leaves the engine process suspect, rather than being about the request it was serving."""
+    return isinstance(error, (chess.engine.EngineError, chess.engine.EngineTerminatedError, TimeoutError))
 
 class ChessEngine:
+    # Whether a game session may keep a background search running on the engine between requests
+    can_ponder = True
+
     def __init__(self, engine_path: str, options: Dict[str, str]):
-        self.engine = chess.engine.SimpleEngine.popen_uci(engine_path)
+        self.engine = chess.engine.SimpleEngine.popen_uci(engine_command(engine_path))
         self.engine.configure(options)
 
-    def analyse(self, board: chess.Board, limit: chess.engine.Limit):
-        return self.engine.analyse(board, limit)
-    
-    def analyse_with_multipv(self, board: chess.Board, limit: chess.engine.Limit, multipv: int):
-        return self.engine.analyse(board, limit, multipv=multipv)
-    
-    
+    def analyse(self, board: chess.Board, limit: chess.engine.Limit, game: object = None):
+        return self.engine.analyse(board, limit, game=game)
+
+    def analyse_with_multipv(self, board: chess.Board, limit: chess.engine.Limit, multipv: int, game: object = None):
+        return self.engine.analyse(board, limit, multipv=multipv, game=game)
+
+    def analysis(self, board: chess.Board, limit: Optional[chess.engine.Limit] = None, multipv: Optional[int] = None,
+                 game: object = None):
+        """Start a search and return a handle that yields info dicts as the engine reports them."""
+        return self.engine.analysis(board, limit, multipv=multipv, game=game)
+
+    def ping(self):
+        self.engine.ping()
+
     def quit(self):
         self.engine.quit()
 
@@ -21,14 +51,242 @@ class StockfishEngine(ChessEngine):
     def __init__(self, engine_path: str, options: Dict[str, str]):
         super().__init__(engine_path, options)
 
+# A one-node search is a single network evaluation of the root, which is all sharpness needs
+WDL_NODES = 1
+# Refining only pays off where sharpness depends on the WDL: both sides keep this many permille of winning chances
+WDL_REFINE_MIN_CHANCE = 50
+
+def needs_refinement(info: Dict[str, Any], nodes: int, refine_nodes: int) -> bool:
+    wdl = info.get("wdl")
+    return refine_nodes > nodes and wdl is not None and min(wdl[0], wdl[2]) >= WDL_REFINE_MIN_CHANCE
+
 class LeelaEngine(ChessEngine):
     def __init__(self, engine_path: str, options: Dict[str, str]):
         super().__init__(engine_path, options)
 
+    def analyse_wdl(self, board: chess.Board, nodes: int = WDL_NODES, refine_nodes: int = 0, game: object = None):
+        """
+        A node-limited search for the WDL only, taking milliseconds instead of a timed search.
+        With refine_nodes, positions where both sides have real winning chances are searched
+        on to that many nodes; lc0 keeps its tree, so the first search is not wasted.
+        """
+        info = self.analyse(board, chess.engine.Limit(nodes=nodes), game=game)
+        if needs_refinement(info, nodes, refine_nodes):
+            info = self.analyse(board, chess.engine.Limit(nodes=refine_nodes), game=game)
+        return info
+
+    def analyse_wdls(self, boards: Sequence[chess.Board], nodes: int = WDL_NODES, refine_nodes: int = 0) -> List[Dict[str, Any]]:
+        """analyse_wdl for a batch of positions, sent back to back so the network never waits for a checkout."""
+        return [self.analyse_wdl(board, nodes, refine_nodes) for board in boards]
+
 def create_engine(engine_type: str, engine_path: str, options: Dict[str, str]) -> ChessEngine:
+    if engine_path.startswith("tcp://"):
+        # Engine workers on other machines; they are configured where they run, so options do not apply.
+        # Imported here because remote_engines builds on the classes above
+        from remote_engines import create_remote_engine
+        return create_remote_engine(engine_type, engine_path)
     if engine_type == "stockfish":
         return StockfishEngine(engine_path, options)
     elif engine_type == "leela":
         return LeelaEngine(engine_path, options)
     else:
-        raise ValueError(f"Unsupported engine type: {engine_type}")
\ No newline at end of file
+        raise ValueError(f"Unsupported engine type: {engine_type}")
+
+# Options that describe a machine-wide resource budget rather than a per-process setting
+BUDGET_OPTIONS = ('Threads', 'Hash')
+
+def split_engine_options(options: Dict[str, str], size: int) -> Dict[str, str]:
+    """Divide the Threads/Hash budget in options evenly across size engine processes."""
+    member_options = dict(options)
+    for name in BUDGET_OPTIONS:
+        if name in member_options:
+            member_options[name] = str(max(int(member_options[name]) // size, 1))
+    return member_options
+
+def share_engine_options(options: Dict[str, str], engines: int, total: int) -> Dict[str, str]:
+    """The part of the Threads/Hash budget in options that engines of total engine processes get."""
+    shared = dict(options)
+    for name in BUDGET_OPTIONS:
+        if name in shared:
+            shared[name] = str(max(int(shared[name]) * engines // total, engines))
+    return shared
+
+class EnginePool:
+    """
+    A fixed number of engine processes of one type that callers check out one at a time.
+
+    Dead engines are replaced by a background health check, so a crashed process
+    costs at most one failed request.
+    """
+
+    def __init__(self, engine_type: str, engine_path: str, options: Dict[str, str],
+                 size: int = 1, health_check_interval: float = 30.0):
+        if size < 1:
+            raise ValueError(f"Engine pool size must be at least 1, got {size}")
+        self.engine_type = engine_type
+        self.engine_path = engine_path
+        self.size = size
+        self.member_options = split_engine_options(options, size)
+        self.health_check_interval = health_check_interval
+        # Idle slots hold either a live engine or None for a process that still needs spawning
+        self._idle: queue.Queue = queue.Queue()
+        self._closed = threading.Event()
+        # Callers blocked in acquire(), and the stop callbacks of low-priority holders that give way to them
+        self._waiting = 0
+        self._preemptible: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+        for _ in range(size):
+            self._idle.put(self._try_spawn())
+        self._health_thread = threading.Thread(target=self._health_check_loop, daemon=True)
+        self._health_thread.start()
+
+    def _spawn(self) -> ChessEngine:
+        try:
+            engine = create_engine(self.engine_type, self.engine_path, self.member_options)
+        except Exception:
+            ENGINE_START_FAILURES.labels(self.engine_type).inc()
+            raise
+        ENGINE_STARTS.labels(self.engine_type).inc()
+        logger.info(f"Started {self.engine_type} engine process with options {self.member_options}")
+        return engine
+
+    def _try_spawn(self) -> Optional[ChessEngine]:
+        try:
+            return self._spawn()
+        except Exception as e:
+            logger.error(f"Failed to start {self.engine_type} engine: {str(e)}")
+            logger.error(traceback.format_exc())
+            return None
+
+    def _discard(self, engine: Optional[ChessEngine]):
+        if engine is None:
+            return
+        try:
+            engine.quit()
+        except Exception as e:
+            logger.error(f"Error shutting down {self.engine_type} engine: {str(e)}")
+
+    def acquire(self, timeout: Optional[float] = None) -> ChessEngine:
+        """Take an engine out of the pool until release() is called. Prefer checkout() for short use."""
+        try:
+            engine = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                self._waiting += 1
+                preempt = list(self._preemptible)
+            for stop in preempt:
+                stop()
+            try:
+                engine = self._idle.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError(f"No {self.engine_type} engine available within {timeout} seconds")
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+        if engine is None:
+            try:
+                engine = self._spawn()
+            except Exception:
+                self._idle.put(None)
+                raise
+        return engine
+
+    def release(self, engine: ChessEngine, healthy: bool = True):
+        if not healthy:
+            # Treat the process as suspect; the health check or the next checkout replaces it
+            ENGINE_CRASHES.labels(self.engine_type).inc()
+            self._discard(engine)
+            engine = None
+        self._idle.put(engine)
+
+    def grow(self, size: int):
+        """Add engines up to size; each is started by the first checkout that takes its slot."""
+        with self._lock:
+            added = size - self.size
+            if added <= 0 or self._closed.is_set():
+                return
+            self.size = size
+        for _ in range(added):
+            self._idle.put(None)
+
+    @contextmanager
+    def checkout(self, timeout: Optional[float] = None):
+        """Borrow an engine for the duration of a with-block, waiting up to timeout seconds."""
+        engine = self.acquire(timeout)
+        healthy = True
+        try:
+            yield engine
+        except Exception as e:
+            healthy = not engine_failed(e)
+            raise
+        finally:
+            self.release(engine, healthy)
+
+    @contextmanager
+    def checkout_preemptible(self, preempt: Callable[[], None]):
+        """
+        Borrow an idle engine for low-priority work, yielding None instead of waiting when
+        no engine is idle or anyone else is waiting for one. preempt is called as soon as a
+        regular acquire() has to wait; the holder should then stop and leave the with-block.
+        """
+        taken = False
+        with self._lock:
+            if not self._waiting:
+                try:
+                    engine = self._idle.get_nowait()
+                    taken = True
+                    # Registered under the lock, so any acquire() that finds the pool empty from now on preempts us
+                    self._preemptible.append(preempt)
+                except queue.Empty:
+                    pass
+        if not taken:
+            yield None
+            return
+        if engine is None:
+            engine = self._try_spawn()
+            if engine is None:
+                self._remove_preemptible(preempt)
+                self._idle.put(None)
+                yield None
+                return
+        healthy = True
+        try:
+            yield engine
+        except Exception as e:
+            healthy = not engine_failed(e)
+            raise
+        finally:
+            self._remove_preemptible(preempt)
+            self.release(engine, healthy)
+
+    def _remove_preemptible(self, preempt: Callable[[], None]):
+        with self._lock:
+            self._preemptible.remove(preempt)
+
+    def _health_check_loop(self):
+        while not self._closed.wait(self.health_check_interval):
+            self.health_check()
+
+    def health_check(self):
+        """Ping the idle engines and respawn the ones that are dead, taking one at a time so callers are not starved."""
+        for _ in range(self._idle.qsize()):
+            try:
+                engine = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if engine is not None:
+                try:
+                    engine.ping()
+                except Exception as e:
+                    logger.warning(f"{self.engine_type} engine failed health check: {str(e)}")
+                    ENGINE_CRASHES.labels(self.engine_type).inc()
+                    self._discard(engine)
+                    engine = None
+            if engine is None and not self._closed.is_set():
+                engine = self._try_spawn()
+            self._idle.put(engine)
+
+    def close(self):
+        self._closed.set()
+        for _ in range(self.size):
+            self._discard(self._idle.get())
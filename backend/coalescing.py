@@ -0,0 +1,300 @@
+import logging
+import queue
+import threading
+import time
+import traceback
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+import chess
+import chess.engine
+
+from cancellation import CancelToken, Cancelled
+from chess_engines import ChessEngine
+from metrics import SEARCHES_COALESCED
+from search_budget import DepthCallback, SearchBudget, SearchProgress
+
+logger = logging.getLogger(__name__)
+
+class InFlightSearch:
+    """
+    One running Stockfish search that several requests share. Its budget only
+    grows: a request that attaches with a deeper depth or a later deadline
+    extends the search instead of starting another one. Once every request
+    has left, for instance because newer ones superseded them, it is stopped.
+    The time budget counts from when the engine starts searching, so time
+    spent waiting for a search thread or an engine is not taken out of it.
+    """
+
+    def __init__(self, budget: SearchBudget):
+        self.budget = SearchBudget(budget.max_depth, budget.time_limit, budget.min_depth,
+                                   budget.stable_iterations, budget.stable_margin)
+        # Both set by start()
+        self.started: Optional[float] = None
+        self.deadline: Optional[float] = None
+        self.lines: List[Dict[str, Any]] = []
+        self.completed_depth = 0
+        # Stopped early because more depth would not change the answer
+        self.stable = False
+        self.followers = 0
+        # Requests still waiting for the result, including the one that started the search
+        self.waiting = 1
+        self.stopping = False
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self._condition = threading.Condition()
+        self._timer: Optional[threading.Timer] = None
+        self._stop: Optional[Callable[[], None]] = None
+
+    def attach(self, budget: SearchBudget) -> bool:
+        """Join the search, extending its budget to cover this request. False once it is stopping."""
+        with self._condition:
+            if self.stopping or self.finished:
+                return False
+            self.followers += 1
+            self.waiting += 1
+            if self.completed_depth >= budget.max_depth:
+                return True
+            self.budget.max_depth = max(self.budget.max_depth, budget.max_depth)
+            self.budget.min_depth = max(self.budget.min_depth, budget.min_depth)
+            if self.started is None:
+                # Not searching yet: the clock starts with the search
+                self.budget.time_limit = max(self.budget.time_limit, budget.time_limit)
+                return True
+            deadline = time.monotonic() + budget.time_limit
+            if deadline > self.deadline:
+                self.deadline = deadline
+                self.budget.time_limit = deadline - self.started
+                self._schedule_stop()
+            return True
+
+    def wait(self, depth: int, cancel: Optional[CancelToken] = None,
+             on_depth: Optional[DepthCallback] = None) -> Tuple[List[Dict[str, Any]], int, int]:
+        """
+        Wait until the search completes depth, or ends, and return its lines at that point,
+        with their depth and the depth they satisfy, as run_budgeted does. on_depth is called
+        on the waiting thread with the lines of the depths completed on the way; under load,
+        it may only see the latest of several.
+        The request leaves the search however it returns; a cancelled one raises Cancelled.
+        """
+        reported = 0
+        try:
+            with cancel.stopping(self._wake) if cancel is not None else nullcontext():
+                while True:
+                    with self._condition:
+                        self._condition.wait_for(lambda: self.finished or self.completed_depth >= depth
+                                                 or (cancel is not None and cancel.cancelled)
+                                                 or (on_depth is not None and self.completed_depth > reported))
+                        if self.finished or self.completed_depth >= depth:
+                            if not self.lines and self.error is not None:
+                                raise self.error
+                            satisfied = self.budget.max_depth if self.stable else self.completed_depth
+                            return list(self.lines), self.completed_depth, satisfied
+                        if cancel is not None and cancel.cancelled:
+                            break
+                        lines, reported = list(self.lines), self.completed_depth
+                    on_depth(lines, reported)
+            raise Cancelled("Superseded by a newer request")
+        finally:
+            self.leave()
+
+    def leave(self):
+        """A request is done waiting for the result; once none is left, the search is stopped."""
+        with self._condition:
+            self.waiting -= 1
+            if self.waiting > 0 or self.finished:
+                return
+            self.stopping = True
+            stop = self._stop
+        if stop is not None:
+            logger.info(f"Stopping search at depth {self.completed_depth}: no request is waiting for it")
+            stop()
+
+    def _wake(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def start(self, stop: Callable[[], None]):
+        """Called once the engine is searching, which starts the clock; stop ends the search early."""
+        with self._condition:
+            self._stop = stop
+            self.started = time.monotonic()
+            self.deadline = self.started + self.budget.time_limit
+            abandoned = self.stopping
+            self._schedule_stop()
+        if abandoned:
+            stop()
+
+    def publish(self, lines: List[Dict[str, Any]], depth: int, stable: bool) -> bool:
+        """Record a completed depth; True when the search should stop."""
+        with self._condition:
+            self.lines = lines
+            self.completed_depth = depth
+            self.stable = stable
+            self._condition.notify_all()
+            if stable or depth >= self.budget.max_depth:
+                self.stopping = True
+            return self.stopping
+
+    def finish(self, lines: List[Dict[str, Any]], depth: int, error: Optional[BaseException] = None):
+        with self._condition:
+            if self._timer is not None:
+                self._timer.cancel()
+            if lines:
+                self.lines = lines
+                self.completed_depth = depth
+            self.error = error
+            self.stopping = True
+            self.finished = True
+            self._condition.notify_all()
+
+    def _schedule_stop(self):
+        # Called with the condition held
+        if self._stop is None:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(self.deadline - time.monotonic(), 0), self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _expire(self):
+        with self._condition:
+            if self.finished or time.monotonic() < self.deadline:
+                return
+            self.stopping = True
+            stop = self._stop
+        stop()
+
+def run_in_flight(engine: ChessEngine, board: chess.Board, search: InFlightSearch,
+                  multipv: int = 1) -> Tuple[List[Dict[str, Any]], int, int]:
+    """
+    run_budgeted for a shared search. The engine searches without a limit and
+    is stopped here, since attached requests may raise the depth or push back
+    the deadline while it runs.
+    """
+    progress = SearchProgress(board, search.budget, multipv)
+    if search.stopping:
+        # Every request left while this one waited for an engine
+        return [], 0, 0
+    with engine.analysis(board, multipv=multipv) as analysis:
+        search.start(analysis.stop)
+        for info in analysis:
+            depth = progress.completed_depth
+            stable = progress.update(info, analysis.multipv)
+            if progress.completed_depth > depth and search.publish(progress.lines, progress.completed_depth, stable):
+                break
+        if not progress.lines:
+            analysis.wait()
+        return progress.result(analysis.multipv)
+
+class SearchCoalescer:
+    """
+    Runs at most one search per key at a time. Requests for a key that is
+    already being searched attach to that search and return as soon as it
+    has completed their depth. Searches run on up to max_searches threads,
+    as many as there are engines to run them on; the rest wait their turn.
+    """
+
+    def __init__(self, max_searches: int = 4):
+        self._searches: Dict[Hashable, InFlightSearch] = {}
+        self._lock = threading.Lock()
+        self._queue: queue.Queue = queue.Queue()
+        self._threads: List[threading.Thread] = []
+        self._thread_count = max_searches
+        self._start_lock = threading.Lock()
+
+    def search(self, key: Hashable, budget: SearchBudget,
+               run: Callable[[InFlightSearch], Tuple[List[Dict[str, Any]], int, int]],
+               cancel: Optional[CancelToken] = None,
+               on_depth: Optional[DepthCallback] = None) -> Tuple[List[Dict[str, Any]], int, int]:
+        with self._lock:
+            search = self._searches.get(key)
+            if search is not None and search.attach(budget):
+                SEARCHES_COALESCED.inc()
+                logger.info(f"Attached to running search for depth {budget.max_depth} ({search.followers} attached)")
+            else:
+                search = InFlightSearch(budget)
+                self._searches[key] = search
+                # The search runs on a thread of its own so that every request, including the one that
+                # started it, returns as soon as its own depth is done, even if others extended it
+                self._ensure_started()
+                self._queue.put((key, search, run))
+        return search.wait(budget.max_depth, cancel, on_depth)
+
+    def grow(self, max_searches: int):
+        """Run up to max_searches searches at once from now on."""
+        with self._start_lock:
+            self._thread_count = max(self._thread_count, max_searches)
+        self._ensure_started()
+
+    def _ensure_started(self):
+        with self._start_lock:
+            while len(self._threads) < self._thread_count:
+                thread = threading.Thread(target=self._worker_loop, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _worker_loop(self):
+        while True:
+            self._run(*self._queue.get())
+
+    def _run(self, key: Hashable, search: InFlightSearch,
+             run: Callable[[InFlightSearch], Tuple[List[Dict[str, Any]], int, int]]):
+        lines: List[Dict[str, Any]] = []
+        depth = 0
+        error: Optional[BaseException] = None
+        try:
+            lines, depth, _ = run(search)
+        except Exception as e:
+            logger.error(f"Shared search failed: {str(e)}")
+            logger.error(traceback.format_exc())
+            error = e
+        finally:
+            with self._lock:
+                if self._searches.get(key) is search:
+                    del self._searches[key]
+            search.finish(lines, depth, error)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._searches)
+
+class SharedCalls:
+    """
+    Deduplicates concurrent calls with the same key: the first caller runs the
+    function and everyone who arrives while it runs gets the same result or error.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, "_Call"] = {}
+        self._lock = threading.Lock()
+
+    def call(self, key: Hashable, function: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            SEARCHES_COALESCED.inc()
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
@@ -0,0 +1,331 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import chess
+import chess.engine
+
+from async_engines import AsyncChessEngine, AsyncEnginePool
+from cancellation import CancelToken
+from chess_engines import ChessEngine, EnginePool, engine_failed
+from search_budget import DepthCallback, SearchBudget, run_budgeted, run_budgeted_async
+
+logger = logging.getLogger(__name__)
+
+class GameSession:
+    """
+    One client's game: the root position plus the moves played from it, and the
+    engine pinned to it. Sending the whole move stack with the same game id lets
+    the engine keep its hash table between consecutive positions.
+    """
+
+    def __init__(self, session_id: str, engine: ChessEngine):
+        self.session_id = session_id
+        self.engine = engine
+        self.board = chess.Board()
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+        self.closed = False
+        self._ponder = None
+        self._ponder_board: Optional[chess.Board] = None
+
+    def update_position(self, fen: str):
+        """
+        Move the session to fen. A move forward, or a step back to any earlier
+        position in the game, keeps the move stack; anything else starts a new root.
+        """
+        target = chess.Board(fen).epd()
+        if self.board.epd() == target:
+            return
+        for move in self.board.legal_moves:
+            self.board.push(move)
+            if self.board.epd() == target:
+                return
+            self.board.pop()
+        earlier = self.board.copy()
+        while earlier.move_stack:
+            earlier.pop()
+            if earlier.epd() == target:
+                self.board = earlier
+                return
+        self.board = chess.Board(fen)
+
+    def start_pondering(self, move: chess.Move):
+        """Keep searching the position after move, the most likely next request, until stopped."""
+        board = self.board.copy()
+        board.push(move)
+        self._ponder_board = board
+        self._ponder = self.engine.analysis(board, game=self.session_id)
+
+    def stop_pondering(self) -> Optional[Dict[str, Any]]:
+        """Stop the background search and return its main line if it was for the current position."""
+        if self._ponder is None:
+            return None
+        ponder, ponder_board = self._ponder, self._ponder_board
+        self._ponder = None
+        self._ponder_board = None
+        ponder.stop()
+        ponder.wait()
+        if ponder_board.epd() != self.board.epd():
+            return None
+        line = ponder.multipv[0] if ponder.multipv else None
+        if line is None or "pv" not in line or "score" not in line:
+            return None
+        return dict(line)
+
+class SessionManager:
+    """
+    Pins engines from a pool to client sessions. At most max_sessions engines
+    are pinned at once; the least recently used session gives its engine back
+    when a new one needs it, and idle sessions are closed after idle_timeout.
+    """
+
+    def __init__(self, pool: EnginePool, max_sessions: int, idle_timeout: float = 300.0):
+        self.pool = pool
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._sessions: "OrderedDict[str, GameSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._reaper = threading.Thread(target=self._reap_loop, daemon=True)
+        self._reaper.start()
+
+    def analyse(self, session_id: str, fen: str, budget: SearchBudget, multipv: int = 1,
+                cancel: Optional[CancelToken] = None,
+                on_depth: Optional[DepthCallback] = None) -> Tuple[List[Dict[str, Any]], int, int]:
+        """
+        Search fen on the session's engine, returning what run_budgeted does; on_depth sees the
+        depths the search completes. A cancelled request stops its search and raises Cancelled.
+        """
+        while True:
+            session = self._get_or_open(session_id)
+            with session.lock:
+                if session.closed:
+                    # Evicted between lookup and lock; open a fresh session
+                    continue
+                if cancel is not None:
+                    # Superseded while waiting for the session's previous search
+                    cancel.check()
+                session.last_used = time.monotonic()
+                session.update_position(fen)
+                healthy = True
+                try:
+                    pondered = session.stop_pondering()
+                    if multipv == 1 and pondered is not None and pondered.get("depth", 0) >= budget.max_depth:
+                        logger.info(f"Session {session_id}: serving depth {pondered['depth']} from background search")
+                        lines, depth, satisfied = [pondered], pondered["depth"], pondered["depth"]
+                    else:
+                        lines, depth, satisfied = run_budgeted(session.engine, session.board, budget, multipv=multipv,
+                                                    game=session.session_id, cancel=cancel, on_depth=on_depth)
+                    if cancel is not None:
+                        # The engine was stopped, not broken; the next request for the session needs it
+                        cancel.check()
+                    if lines and lines[0].get("pv") and session.engine.can_ponder:
+                        session.start_pondering(lines[0]["pv"][0])
+                    return lines, depth, satisfied
+                except Exception as e:
+                    healthy = not engine_failed(e)
+                    raise
+                finally:
+                    if not healthy:
+                        self._close_locked(session, healthy=False)
+
+    def _get_or_open(self, session_id: str) -> GameSession:
+        evicted = None
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+                return session
+            if len(self._sessions) >= self.max_sessions:
+                _, evicted = self._sessions.popitem(last=False)
+        if evicted is not None:
+            logger.info(f"Closing least recently used session {evicted.session_id}")
+            self._close(evicted)
+        engine = self.pool.acquire()
+        session = GameSession(session_id, engine)
+        with self._lock:
+            existing = self._sessions.get(session_id)
+            if existing is not None:
+                # Another request opened the same session meanwhile
+                self.pool.release(engine)
+                return existing
+            self._sessions[session_id] = session
+        logger.info(f"Opened engine session {session_id}")
+        return session
+
+    def close_session(self, session_id: str) -> bool:
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        self._close(session)
+        return True
+
+    def _close(self, session: GameSession):
+        with session.lock:
+            self._close_locked(session)
+
+    def _close_locked(self, session: GameSession, healthy: bool = True):
+        if session.closed:
+            return
+        session.closed = True
+        with self._lock:
+            if self._sessions.get(session.session_id) is session:
+                del self._sessions[session.session_id]
+        if healthy:
+            try:
+                session.stop_pondering()
+            except Exception as e:
+                logger.error(f"Error stopping background search for session {session.session_id}: {str(e)}")
+                healthy = False
+        self.pool.release(session.engine, healthy)
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(max(self.idle_timeout / 4, 1.0))
+            now = time.monotonic()
+            with self._lock:
+                idle = [session for session in self._sessions.values() if now - session.last_used > self.idle_timeout]
+            for session in idle:
+                logger.info(f"Closing idle session {session.session_id}")
+                self._close(session)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+class AsyncGameSession(GameSession):
+    """GameSession for an AsyncChessEngine."""
+
+    def __init__(self, session_id: str, engine: AsyncChessEngine):
+        super().__init__(session_id, engine)
+        self.lock = asyncio.Lock()
+
+    async def start_pondering(self, move: chess.Move):
+        board = self.board.copy()
+        board.push(move)
+        self._ponder_board = board
+        self._ponder = await self.engine.analysis(board, game=self.session_id)
+
+    async def stop_pondering(self) -> Optional[Dict[str, Any]]:
+        if self._ponder is None:
+            return None
+        ponder, ponder_board = self._ponder, self._ponder_board
+        self._ponder = None
+        self._ponder_board = None
+        ponder.stop()
+        await ponder.wait()
+        if ponder_board.epd() != self.board.epd():
+            return None
+        line = ponder.multipv[0] if ponder.multipv else None
+        if line is None or "pv" not in line or "score" not in line:
+            return None
+        return dict(line)
+
+class AsyncSessionManager:
+    """SessionManager for an AsyncEnginePool; idle sessions are reaped by a task on the pool's event loop."""
+
+    def __init__(self, pool: AsyncEnginePool, max_sessions: int, idle_timeout: float = 300.0):
+        self.pool = pool
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._sessions: "OrderedDict[str, AsyncGameSession]" = OrderedDict()
+        self._reaper: Optional[asyncio.Task] = None
+
+    async def analyse(self, session_id: str, fen: str, budget: SearchBudget, multipv: int = 1,
+                      on_depth: Optional[DepthCallback] = None) -> Tuple[List[Dict[str, Any]], int, int]:
+        while True:
+            session = await self._get_or_open(session_id)
+            async with session.lock:
+                if session.closed:
+                    # Evicted between lookup and lock; open a fresh session
+                    continue
+                session.last_used = time.monotonic()
+                session.update_position(fen)
+                healthy = True
+                try:
+                    pondered = await session.stop_pondering()
+                    if multipv == 1 and pondered is not None and pondered.get("depth", 0) >= budget.max_depth:
+                        logger.info(f"Session {session_id}: serving depth {pondered['depth']} from background search")
+                        lines, depth, satisfied = [pondered], pondered["depth"], pondered["depth"]
+                    else:
+                        lines, depth, satisfied = await run_budgeted_async(session.engine, session.board, budget,
+                                                                multipv=multipv, game=session.session_id,
+                                                                on_depth=on_depth)
+                    if lines and lines[0].get("pv"):
+                        await session.start_pondering(lines[0]["pv"][0])
+                    return lines, depth, satisfied
+                except Exception as e:
+                    # A superseded job is cancelled, which is not an Exception: its search was stopped on the way out
+                    healthy = not engine_failed(e)
+                    raise
+                finally:
+                    if not healthy:
+                        await self._close_locked(session, healthy=False)
+
+    async def _get_or_open(self, session_id: str) -> AsyncGameSession:
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self._sessions.move_to_end(session_id)
+            return session
+        if len(self._sessions) >= self.max_sessions:
+            _, evicted = self._sessions.popitem(last=False)
+            logger.info(f"Closing least recently used session {evicted.session_id}")
+            await self._close(evicted)
+        engine = await self.pool.acquire()
+        existing = self._sessions.get(session_id)
+        if existing is not None:
+            # Another request opened the same session meanwhile
+            await self.pool.release(engine)
+            return existing
+        session = AsyncGameSession(session_id, engine)
+        self._sessions[session_id] = session
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap_loop())
+        logger.info(f"Opened engine session {session_id}")
+        return session
+
+    async def close_session(self, session_id: str) -> bool:
+        session = self._sessions.pop(session_id, None)
+        if session is None:
+            return False
+        await self._close(session)
+        return True
+
+    async def close(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+        for session in list(self._sessions.values()):
+            await self._close(session)
+
+    async def _close(self, session: AsyncGameSession):
+        async with session.lock:
+            await self._close_locked(session)
+
+    async def _close_locked(self, session: AsyncGameSession, healthy: bool = True):
+        if session.closed:
+            return
+        session.closed = True
+        if self._sessions.get(session.session_id) is session:
+            del self._sessions[session.session_id]
+        if healthy:
+            try:
+                await session.stop_pondering()
+            except Exception as e:
+                logger.error(f"Error stopping background search for session {session.session_id}: {str(e)}")
+                healthy = False
+        await self.pool.release(session.engine, healthy)
+
+    async def _reap_loop(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout / 4, 1.0))
+            now = time.monotonic()
+            for session in [session for session in self._sessions.values() if now - session.last_used > self.idle_timeout]:
+                logger.info(f"Closing idle session {session.session_id}")
+                await self._close(session)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
@@ -0,0 +1,228 @@
+import argparse
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+import urllib.request
+from typing import Any, Dict, List, Optional
+
+from chess_engines import EnginePool
+from remote_engines import (decode_board, decode_limit, encode_info, recv_frame, send_frame)
+
+logger = logging.getLogger(__name__)
+
+class WorkerConnection(socketserver.BaseRequestHandler):
+    """
+    Serves one API connection: requests are answered in order, one at a time.
+    The first request must be a hello carrying the worker's token, if it has one.
+    An analysis streams info frames until the search ends, then waits for the
+    client's stop frame before the connection takes the next request.
+    """
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        authenticated = False
+        while True:
+            try:
+                request = recv_frame(self.request)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Dropping connection from {self.client_address[0]}: {str(e)}")
+                return
+            if request is None:
+                return
+            try:
+                if not isinstance(request, dict):
+                    send_frame(self.request, {"error": "Requests must be JSON objects"})
+                elif not authenticated:
+                    if not self.authenticate(request):
+                        logger.warning(f"Refusing connection from {self.client_address[0]}: no hello with the worker token")
+                        send_frame(self.request, {"error": "The first request must be a hello with the worker token"})
+                        return
+                    authenticated = True
+                else:
+                    self.dispatch(request)
+            except OSError as e:
+                logger.warning(f"Connection from {self.client_address[0]} failed: {str(e)}")
+                return
+
+    def authenticate(self, request: Dict[str, Any]) -> bool:
+        """Answer a hello with the worker's engine type and capacity, if its token matches."""
+        server: EngineWorker = self.server
+        token = request.get("token")
+        if request.get("op") != "hello" or (server.token is not None and not (
+                isinstance(token, str) and hmac.compare_digest(token.encode("utf-8"), server.token.encode("utf-8")))):
+            return False
+        send_frame(self.request, {"engine": server.pool.engine_type, "capacity": server.pool.size})
+        return True
+
+    def dispatch(self, request: Dict[str, Any]):
+        op = request.get("op")
+        server: EngineWorker = self.server
+        if op == "hello":
+            send_frame(self.request, {"engine": server.pool.engine_type, "capacity": server.pool.size})
+        elif op == "analyse":
+            send_frame(self.request, self.run(self.analyse, request))
+        elif op == "analyse_wdls":
+            send_frame(self.request, self.run(self.analyse_wdls, request))
+        elif op == "analysis":
+            self.analysis(request)
+        else:
+            send_frame(self.request, {"error": f"Unknown request: {op}"})
+
+    def run(self, handler, request: Dict[str, Any]) -> Dict[str, Any]:
+        try:
+            return handler(request)
+        except OSError:
+            raise
+        except Exception as e:
+            logger.error(f"Error running {request.get('op')} request: {str(e)}")
+            logger.error(traceback.format_exc())
+            return {"error": str(e)}
+
+    def analyse(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        board = decode_board(request["board"])
+        limit = decode_limit(request["limit"])
+        with self.server.pool.checkout() as engine:
+            if request.get("multipv") is not None:
+                infos = engine.analyse_with_multipv(board, limit, request["multipv"], game=request.get("game"))
+                return {"infos": [encode_info(info) for info in infos]}
+            return {"info": encode_info(engine.analyse(board, limit, game=request.get("game")))}
+
+    def analyse_wdls(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        boards = [decode_board(board) for board in request["boards"]]
+        with self.server.pool.checkout() as engine:
+            infos = engine.analyse_wdls(boards, request["nodes"], request["refine_nodes"])
+        return {"infos": [encode_info(info) for info in infos]}
+
+    def analysis(self, request: Dict[str, Any]):
+        try:
+            board = decode_board(request["board"])
+            limit = decode_limit(request["limit"])
+        except (KeyError, TypeError, ValueError) as e:
+            send_frame(self.request, {"event": "error", "error": f"Invalid analysis request: {e!r}"})
+            return
+        stopped = threading.Event()
+        # A client that goes away leaves the engine healthy, so the error is raised only once it is back in the pool
+        client_error = None
+        with self.server.pool.checkout() as engine:
+            with engine.analysis(board, limit, multipv=request.get("multipv"), game=request.get("game")) as analysis:
+                try:
+                    send_frame(self.request, {"event": "started"})
+
+                    def read_stop():
+                        # The only frame a client sends during an analysis; a closed connection stops the search too
+                        try:
+                            recv_frame(self.request)
+                        except (OSError, ValueError):
+                            pass
+                        try:
+                            analysis.stop()
+                        except Exception as e:
+                            logger.warning(f"Could not stop search: {str(e)}")
+                        finally:
+                            stopped.set()
+                    reader = threading.Thread(target=read_stop, daemon=True)
+                    reader.start()
+                    for info in analysis:
+                        send_frame(self.request, {"event": "info", "info": encode_info(info)})
+                    best = analysis.wait()
+                    send_frame(self.request, {"event": "bestmove",
+                                              "move": best.move.uci() if best.move else None,
+                                              "ponder": best.ponder.uci() if best.ponder else None})
+                except OSError as e:
+                    client_error = e
+        if client_error is not None:
+            raise client_error
+        stopped.wait()
+        send_frame(self.request, {"event": "done"})
+
+class EngineWorker(socketserver.ThreadingTCPServer):
+    """Serves a local EnginePool to API servers; see remote_engines.RemoteChessEngine."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, pool: EnginePool, token: Optional[str] = None):
+        super().__init__(address, WorkerConnection)
+        self.pool = pool
+        self.token = token
+
+def register(api_url: str, address: str):
+    """Announce this worker to an API server's /workers endpoint."""
+    request = urllib.request.Request(f"{api_url.rstrip('/')}/workers", data=json.dumps({"address": address}).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(request, timeout=10) as response:
+        logger.info(f"Registered with {api_url}: {response.read().decode('utf-8')}")
+
+def parse_options(pairs: List[str]) -> Dict[str, str]:
+    options = {}
+    for pair in pairs:
+        name, separator, value = pair.partition("=")
+        if not separator:
+            raise ValueError(f"Engine options must be Name=Value, got {pair!r}")
+        options[name] = value
+    return options
+
+def is_loopback(host: str) -> bool:
+    """Whether listening on host only accepts connections from this machine."""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Serve local chess engines to API servers over TCP.")
+    parser.add_argument("--engine-type", choices=("stockfish", "leela"), default="stockfish")
+    parser.add_argument("--engine", help="Engine executable (default: STOCKFISH_PATH or LEELA_PATH)")
+    parser.add_argument("--engines", type=int, default=1, help="Engine processes, i.e. searches run at once")
+    parser.add_argument("--option", action="append", default=[], metavar="NAME=VALUE",
+                        help="UCI option; Threads and Hash are split across the engines")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on; other hosts need --token")
+    parser.add_argument("--token", default=os.environ.get("ENGINE_WORKER_TOKEN"),
+                        help="Shared secret API servers must present (default: ENGINE_WORKER_TOKEN)")
+    parser.add_argument("--port", type=int, default=7000, help="0 picks a free port")
+    parser.add_argument("--advertise", help="host:port API servers should connect to (default: this host and port)")
+    parser.add_argument("--register", metavar="URL", help="API server to register with, e.g. http://api:5000")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    engine_path = args.engine or os.environ.get("STOCKFISH_PATH" if args.engine_type == "stockfish" else "LEELA_PATH")
+    if not engine_path:
+        parser.error("--engine is required")
+    if not args.token and not is_loopback(args.host):
+        parser.error("--token (or ENGINE_WORKER_TOKEN) is required to listen on other hosts than localhost")
+    options = parse_options(args.option)
+    if args.engine_type == "leela":
+        options.setdefault("UCI_ShowWDL", "true")
+
+    pool = EnginePool(args.engine_type, engine_path, options, size=args.engines)
+    server = EngineWorker((args.host, args.port), pool, token=args.token or None)
+    host, port = server.server_address[:2]
+    address = args.advertise or f"{socket.gethostname() if host == '0.0.0.0' else host}:{port}"
+    # Printed for scripts and tests that start workers on port 0
+    print(f"Listening on {host}:{port}", flush=True)
+    logger.info(f"Serving {args.engines} {args.engine_type} engines as {address}")
+    if args.register:
+        try:
+            register(args.register, address)
+        except OSError as e:
+            logger.error(f"Could not register with {args.register}: {str(e)}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
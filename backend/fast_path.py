@@ -0,0 +1,126 @@
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import chess
+import chess.polyglot
+import chess.syzygy
+
+from sharpness import sharpnessLC0
+
+logger = logging.getLogger(__name__)
+
+# Tablebase wins in centipawns: above any engine evaluation, below the mate scores of a search
+TABLEBASE_WIN_SCORE = 20000
+
+def tablebase_score(wdl: int, dtz: int) -> int:
+    """Score of a tablebase result for the side to move. Wins closer to a zeroing move score higher."""
+    if wdl == 2:
+        return TABLEBASE_WIN_SCORE - abs(dtz)
+    if wdl == -2:
+        return -(TABLEBASE_WIN_SCORE - abs(dtz))
+    # Draws, and wins or losses spoiled by the fifty-move rule
+    return 0
+
+def tablebase_wdl(wdl: int) -> Tuple[int, int, int]:
+    """The exact result as a WDL triple in permille, like the ones Leela reports."""
+    if wdl == 2:
+        return 1000, 0, 0
+    if wdl == -2:
+        return 0, 0, 1000
+    return 0, 1000, 0
+
+class FastPathResolver:
+    """
+    Answers positions that need no engine search: moves from a Polyglot opening
+    book and exact results from Syzygy tablebases. Both sources are optional;
+    lookups return None for positions neither of them knows.
+    """
+
+    def __init__(self, book_path: Optional[str] = None, syzygy_path: Optional[str] = None):
+        self.book: Optional[chess.polyglot.MemoryMappedReader] = None
+        self.tablebase: Optional[chess.syzygy.Tablebase] = None
+        if book_path:
+            self.book = chess.polyglot.open_reader(book_path)
+            logger.info(f"Opening book loaded from {book_path}")
+        if syzygy_path:
+            self.tablebase = chess.syzygy.Tablebase()
+            # Several directories may be given, separated like PATH entries
+            for directory in syzygy_path.split(os.pathsep):
+                if directory:
+                    tables = self.tablebase.add_directory(directory)
+                    logger.info(f"Loaded {tables} Syzygy tables from {directory}")
+
+    def probe(self, board: chess.Board) -> Optional[Tuple[int, int]]:
+        """WDL and DTZ for the side to move, or None when the position is not in the tablebases."""
+        if self.tablebase is None:
+            return None
+        wdl = self.tablebase.get_wdl(board)
+        if wdl is None:
+            return None
+        dtz = self.tablebase.get_dtz(board)
+        if dtz is None:
+            return None
+        return wdl, dtz
+
+    def evaluate(self, board: chess.Board) -> Optional[Dict[str, Any]]:
+        """Evaluation from the tablebases. Opening books carry no evaluation, so they are not consulted."""
+        probed = self.probe(board)
+        if probed is None:
+            return None
+        wdl, dtz = probed
+        return {"evaluation": tablebase_score(wdl, dtz), "source": "tablebase", "wdl": wdl, "dtz": dtz}
+
+    def sharpness(self, board: chess.Board) -> Optional[Dict[str, Any]]:
+        probed = self.probe(board)
+        if probed is None:
+            return None
+        wdl, dtz = probed
+        return {"sharpness": sharpnessLC0(tablebase_wdl(wdl)), "source": "tablebase", "wdl": wdl, "dtz": dtz}
+
+    def best_lines(self, board: chess.Board, number_of_lines: int) -> Optional[Dict[str, Any]]:
+        """Best moves from the tablebases, or failing that from the opening book."""
+        lines = self._tablebase_lines(board, number_of_lines)
+        if lines is None:
+            lines = self._book_lines(board, number_of_lines)
+        if lines is None:
+            return None
+        return {"best_lines": lines, "source": lines[0]["source"]}
+
+    def _tablebase_lines(self, board: chess.Board, number_of_lines: int) -> Optional[List[Dict[str, Any]]]:
+        if self.tablebase is None or self.probe(board) is None:
+            return None
+        candidates = []
+        for move in board.legal_moves:
+            board.push(move)
+            probed = self.probe(board)
+            board.pop()
+            if probed is None:
+                return None
+            child_wdl, child_dtz = probed
+            # The child is probed for the opponent, so every value flips sign
+            candidates.append((-tablebase_score(child_wdl, child_dtz), move, child_wdl, child_dtz))
+        if not candidates:
+            return None
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+        return [{"moves": board.san(move), "score": score, "sharpness": sharpnessLC0(tablebase_wdl(child_wdl)),
+                 "source": "tablebase", "wdl": -child_wdl, "dtz": -child_dtz}
+                for score, move, child_wdl, child_dtz in candidates[:number_of_lines]]
+
+    def _book_lines(self, board: chess.Board, number_of_lines: int) -> Optional[List[Dict[str, Any]]]:
+        if self.book is None:
+            return None
+        entries = sorted(self.book.find_all(board), key=lambda entry: entry.weight, reverse=True)
+        if not entries:
+            return None
+        total = sum(entry.weight for entry in entries)
+        # Books weight moves by how often they were played, which says nothing about score or sharpness
+        return [{"moves": board.san(entry.move), "score": None, "sharpness": None,
+                 "source": "book", "weight": entry.weight / total}
+                for entry in entries[:number_of_lines]]
+
+    def close(self):
+        if self.book is not None:
+            self.book.close()
+        if self.tablebase is not None:
+            self.tablebase.close()
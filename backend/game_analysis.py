@@ -0,0 +1,187 @@
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import sys
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import chess
+import chess.engine
+import chess.pgn
+
+from chess_engines import EnginePool, split_engine_options
+from sharpness import SharpnessTable
+
+logger = logging.getLogger(__name__)
+
+# Centipawn loss, from the mover's point of view, at which a move gets flagged
+INACCURACY_THRESHOLD = 50
+MISTAKE_THRESHOLD = 100
+BLUNDER_THRESHOLD = 300
+
+# Mate scores are capped so a single missed mate does not dwarf every other move
+MATE_SCORE = 10000
+
+# Engines owned by each worker process, created by init_worker. Each is a pool of one,
+# so an engine that crashes is replaced and fails only the position it was searching.
+_stockfish: Optional[EnginePool] = None
+_leela: Optional[EnginePool] = None
+
+def init_worker(stockfish_path: str, stockfish_options: Dict[str, str],
+                leela_path: Optional[str], leela_options: Dict[str, str]):
+    global _stockfish, _leela
+    _stockfish = EnginePool("stockfish", stockfish_path, stockfish_options, size=1)
+    if leela_path:
+        _leela = EnginePool("leela", leela_path, leela_options, size=1)
+    # The engines' I/O threads would otherwise keep the worker alive when the pool shuts down
+    multiprocessing.util.Finalize(None, shutdown_worker, exitpriority=10)
+
+def shutdown_worker():
+    global _stockfish, _leela
+    pools, _stockfish, _leela = (_stockfish, _leela), None, None
+    for pool in pools:
+        if pool is not None:
+            pool.close()
+
+def worker_engines() -> Tuple[EnginePool, Optional[EnginePool]]:
+    """The engine pools init_worker started in this worker process; Leela is None when it is disabled."""
+    return _stockfish, _leela
+
+def analyse_position(task: Dict) -> Dict:
+    """Runs in a worker process: score a single position, find its best move, and Leela's WDL if enabled."""
+    board = chess.Board(task["fen"])
+    result = {"index": task["index"], "best_move": None, "wdl": None}
+    if board.is_checkmate():
+        score = chess.engine.Mate(0)
+    elif board.is_game_over():
+        score = chess.engine.Cp(0)
+    else:
+        with _stockfish.checkout() as stockfish:
+            info = stockfish.analyse(board, chess.engine.Limit(depth=task["depth"]))
+        score = info["score"].relative
+        if info.get("pv"):
+            result["best_move"] = board.san(info["pv"][0])
+        if _leela is not None:
+            with _leela.checkout() as leela:
+                wdl = leela.analyse(board, chess.engine.Limit(nodes=task["leela_nodes"])).get("wdl")
+            if wdl is not None:
+                result["wdl"] = (wdl[0], wdl[1], wdl[2])
+    result["score"] = score.score(mate_score=MATE_SCORE)
+    return result
+
+def game_tasks(game: chess.pgn.Game, depth: int, leela_nodes: int) -> List[Dict]:
+    board = game.board()
+    tasks = [{"index": 0, "fen": board.fen(), "depth": depth, "leela_nodes": leela_nodes}]
+    for move in game.mainline_moves():
+        board.push(move)
+        tasks.append({"index": len(tasks), "fen": board.fen(), "depth": depth, "leela_nodes": leela_nodes})
+    return tasks
+
+def classify(cp_loss: int) -> Optional[str]:
+    if cp_loss >= BLUNDER_THRESHOLD:
+        return "blunder"
+    if cp_loss >= MISTAKE_THRESHOLD:
+        return "mistake"
+    if cp_loss >= INACCURACY_THRESHOLD:
+        return "inaccuracy"
+    return None
+
+class GameAnalysisPool:
+    """
+    A multiprocessing pool whose workers each own their own engine processes.
+    Positions of a game are spread across the workers, so a full game takes
+    roughly (game length / workers) single-position searches. The Threads/Hash
+    budget in stockfish_options is split across the workers.
+    """
+
+    def __init__(self, workers: int, stockfish_path: str, stockfish_options: Dict[str, str],
+                 leela_path: Optional[str] = None, leela_options: Optional[Dict[str, str]] = None,
+                 sharpness_table: Optional[SharpnessTable] = None):
+        self.workers = workers
+        # Workers only report Leela's WDL; sharpness is looked up here
+        self.sharpness_table = sharpness_table if sharpness_table is not None or not leela_path else SharpnessTable.build()
+        self._pool = multiprocessing.get_context("spawn").Pool(
+            processes=workers,
+            initializer=init_worker,
+            initargs=(stockfish_path, split_engine_options(stockfish_options, workers),
+                      leela_path, leela_options or {}))
+
+    def analyse_game(self, pgn: str, depth: int = 16, leela_nodes: int = 800) -> Iterator[Dict]:
+        """Yield one result per ply, in order, as soon as the positions around it are scored."""
+        game = chess.pgn.read_game(io.StringIO(pgn))
+        if game is None:
+            raise ValueError("No game found in PGN")
+        if game.errors:
+            raise ValueError(f"Invalid PGN: {game.errors[0]}")
+
+        board = game.board()
+        moves = list(game.mainline_moves())
+        previous = None
+        # imap keeps results in order while workers run ahead on later positions
+        for position in self._pool.imap(analyse_position, game_tasks(game, depth, leela_nodes), chunksize=1):
+            if previous is not None:
+                move = moves[position["index"] - 1]
+                mover = board.turn
+                san = board.san(move)
+                board.push(move)
+                # Both scores from the mover's point of view: the best available before the move,
+                # and what is left after it (the opponent's score, negated)
+                best_score = previous["score"]
+                played_score = -position["score"]
+                cp_loss = max(best_score - played_score, 0)
+                yield {
+                    "ply": position["index"],
+                    "move": san,
+                    "fen": board.fen(),
+                    "evaluation": position["score"] if board.turn == chess.WHITE else -position["score"],
+                    "best_move": previous["best_move"],
+                    "sharpness": self.sharpness(position["wdl"]),
+                    "cp_loss": cp_loss,
+                    "classification": classify(cp_loss),
+                    "color": "white" if mover == chess.WHITE else "black",
+                }
+            previous = position
+
+    def sharpness(self, wdl: Optional[Tuple[int, int, int]]) -> Optional[float]:
+        return None if wdl is None else float(self.sharpness_table.sharpness(wdl))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Analyse every move of a PGN game and print one JSON line per ply.")
+    parser.add_argument("pgn", help="PGN file; only the first game is analysed")
+    parser.add_argument("--workers", type=int, default=max((os.cpu_count() or 2) // 2, 1))
+    parser.add_argument("--depth", type=int, default=16)
+    parser.add_argument("--stockfish", default=os.environ.get("STOCKFISH_PATH", "stockfish"))
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1, help="Stockfish threads shared by all workers")
+    parser.add_argument("--hash", type=int, default=1024, help="Stockfish hash in MB shared by all workers")
+    parser.add_argument("--leela", default=os.environ.get("LEELA_PATH"), help="lc0 executable; enables sharpness")
+    parser.add_argument("--weights", default=os.environ.get("LEELA_WEIGHTS_PATH"))
+    parser.add_argument("--leela-nodes", type=int, default=800)
+    parser.add_argument("--sharpness-table", default=os.environ.get("SHARPNESS_TABLE_PATH"),
+                        help="Sharpness lookup table (.npy), built there if missing")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    with open(args.pgn, encoding="utf-8-sig") as f:
+        pgn = f.read()
+
+    leela_options = {'UCI_ShowWDL': 'true'}
+    if args.weights:
+        leela_options['WeightsFile'] = args.weights
+    pool = GameAnalysisPool(args.workers, args.stockfish, {'Threads': str(args.threads), 'Hash': str(args.hash)},
+                            args.leela, leela_options,
+                            SharpnessTable.load_or_build(args.sharpness_table) if args.leela else None)
+    try:
+        for ply in pool.analyse_game(pgn, depth=args.depth, leela_nodes=args.leela_nodes):
+            print(json.dumps(ply), flush=True)
+    finally:
+        pool.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
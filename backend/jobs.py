@@ -0,0 +1,400 @@
+import asyncio
+import logging
+import queue
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set
+
+from cancellation import CancelToken
+from metrics import CANCELLED_JOB_SECONDS, JOB_QUEUE_WAIT_SECONDS, JOB_RUN_SECONDS, JOBS_CANCELLED, JOBS_REJECTED
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+class QueueFullError(Exception):
+    pass
+
+class Job:
+    def __init__(self, kind: str, params: Dict[str, Any]):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = QUEUED
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.created_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.cancel_token = CancelToken()
+        self.supersede_key: Optional[Hashable] = None
+        # Held while a worker takes the job off the queue, so supersession sees it either queued or running
+        self.start_lock = threading.Lock()
+
+    def is_finished(self) -> bool:
+        return self.status in (COMPLETED, FAILED, CANCELLED)
+
+    def to_dict(self) -> Dict[str, Any]:
+        job = {"job_id": self.id, "kind": self.kind, "status": self.status}
+        if self.status == COMPLETED:
+            job["result"] = self.result
+        elif self.status in (FAILED, CANCELLED):
+            job["error"] = self.error
+        return job
+
+class JobStore:
+    """
+    Keeps at most max_jobs jobs. Finished jobs expire ttl seconds after they
+    finish, and make room for new ones oldest first; unfinished jobs are never
+    evicted. Finished jobs are kept in the order they finished, so eviction
+    only looks at the jobs it drops.
+    """
+
+    def __init__(self, max_jobs: int = 10000, ttl: float = 600.0):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._jobs: Dict[str, Job] = {}
+        self._finished: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, job: Job):
+        with self._lock:
+            self._evict(make_room=True)
+            if len(self._jobs) >= self.max_jobs:
+                raise QueueFullError("Job store is full")
+            self._jobs[job.id] = job
+
+    def record(self, kind: str, result: Dict[str, Any], **params) -> Job:
+        """Store a job that was answered without queueing, so it can be fetched like any other."""
+        job = Job(kind, params)
+        job.result = result
+        job.started_at = job.finished_at = job.created_at
+        job.status = COMPLETED
+        self.add(job)
+        self.finished(job)
+        return job
+
+    def finished(self, job: Job):
+        """Make a finished job eligible for eviction."""
+        with self._lock:
+            if job.id in self._jobs:
+                self._finished[job.id] = job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            self._evict()
+            return self._jobs.get(job_id)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._jobs)
+
+    def _evict(self, make_room: bool = False):
+        now = time.monotonic()
+        while self._finished:
+            job_id, job = next(iter(self._finished.items()))
+            # To make room for a new job, the oldest finished jobs go before they expire
+            if now - job.finished_at <= self.ttl and not (make_room and len(self._jobs) >= self.max_jobs):
+                break
+            del self._finished[job_id]
+            del self._jobs[job_id]
+
+class Supersession:
+    """
+    The latest unfinished job per key, such as one client's requests of one kind.
+    A job for the same key with different params cancels the previous one: it is
+    dropped if still queued, and its running engine search is stopped. Running
+    jobs that stoppable says cannot be stopped are left to finish.
+    """
+
+    def __init__(self, stoppable: Callable[[Job], bool] = lambda job: True):
+        self._latest: Dict[Hashable, Job] = {}
+        self._lock = threading.Lock()
+        self._stoppable = stoppable
+
+    def supersede(self, key: Hashable, params: Dict[str, Any], job: Optional[Job] = None):
+        """Cancel the job under key unless it asked for the same thing; job, if given, takes its place."""
+        with self._lock:
+            previous = self._latest.get(key)
+            if job is not None:
+                job.supersede_key = key
+                self._latest[key] = job
+            elif previous is not None and previous.params != params:
+                del self._latest[key]
+        # A repeat of the same request is left running; the new one shares its search
+        if previous is None or previous.params == params or previous.is_finished():
+            return
+        with previous.start_lock:
+            state = "queued" if previous.status == QUEUED else "running"
+            if state == "running" and not self._stoppable(previous):
+                # Cancelling would only mislabel it: the job completes anyway
+                return
+            cancelled = previous.cancel_token.cancel()
+        if cancelled:
+            JOBS_CANCELLED.labels(previous.kind, state).inc()
+            logger.info(f"Cancelled {state} {previous.kind} job {previous.id}: superseded by a newer request")
+
+    def finished(self, job: Job):
+        with self._lock:
+            if job.supersede_key is not None and self._latest.get(job.supersede_key) is job:
+                del self._latest[job.supersede_key]
+
+def finish_job(job: Job, result: Optional[Dict[str, Any]], error: Optional[BaseException]):
+    """Record how a job ended, once it has run or been skipped."""
+    if error is None:
+        job.result = result
+        status = COMPLETED
+    elif job.cancel_token.cancelled:
+        job.error = "Superseded by a newer request"
+        status = CANCELLED
+    else:
+        job.error = str(error)
+        status = FAILED
+    # finished_at must be set before the status flips so no reader sees a finished job without it
+    job.finished_at = time.monotonic()
+    job.status = status
+    if job.started_at is None:
+        # Dropped from the queue without running
+        return
+    JOB_RUN_SECONDS.labels(job.kind, status).observe(job.finished_at - job.started_at)
+    if status == CANCELLED:
+        CANCELLED_JOB_SECONDS.labels(job.kind).inc(job.finished_at - job.started_at)
+
+def start_job(kind: str, params: Dict[str, Any]) -> Job:
+    """A job its caller runs as it goes, such as a stream, rather than a queued one."""
+    job = Job(kind, params)
+    job.status = IN_PROGRESS
+    job.started_at = job.created_at
+    return job
+
+class JobScheduler:
+    """
+    Runs submitted jobs on a fixed set of worker threads. Each job kind has a
+    handler that takes the job params and returns a JSON-serialisable result.
+    Cancellable handlers also get the job's CancelToken as cancel.
+    """
+
+    def __init__(self, store: JobStore, workers: int = 4, max_queued: int = 1000):
+        self.store = store
+        self.handlers: Dict[str, Callable[..., Dict[str, Any]]] = {}
+        self._cancellable: Set[str] = set()
+        self._supersession = Supersession(lambda job: job.kind in self._cancellable)
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        self._workers: List[threading.Thread] = []
+        self._worker_count = workers
+        self._start_lock = threading.Lock()
+
+    def register(self, kind: str, handler: Callable[..., Dict[str, Any]], cancellable: bool = False):
+        self.handlers[kind] = handler
+        if cancellable:
+            self._cancellable.add(kind)
+
+    def submit(self, kind: str, supersede: Optional[Hashable] = None, **params) -> Job:
+        """Queue a job. With a supersede key, an unfinished job under that key asking for something else is cancelled."""
+        if kind not in self.handlers:
+            raise ValueError(f"No handler registered for job kind: {kind}")
+        self._ensure_started()
+        job = Job(kind, params)
+        try:
+            self.store.add(job)
+        except QueueFullError:
+            JOBS_REJECTED.labels(kind).inc()
+            raise
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            JOBS_REJECTED.labels(kind).inc()
+            job.error = "Server is busy"
+            job.finished_at = time.monotonic()
+            job.status = FAILED
+            self.store.finished(job)
+            raise QueueFullError("Job queue is full")
+        if supersede is not None:
+            self._supersession.supersede(supersede, params, job)
+        return job
+
+    def supersede(self, key: Hashable, params: Dict[str, Any]):
+        """Cancel the job under key for a request that was answered without queueing a job."""
+        self._supersession.supersede(key, params)
+
+    def start(self, kind: str, supersede: Optional[Hashable] = None, **params) -> Job:
+        """
+        Run a job on the caller's own thread, for requests that answer as they go. It supersedes and
+        is superseded like a queued job; the caller stops once its cancel_token is cancelled, and
+        passes it to finish.
+        """
+        job = start_job(kind, params)
+        # The caller watches the token, so a running job of this kind can always be stopped
+        self._cancellable.add(kind)
+        if supersede is not None:
+            self._supersession.supersede(supersede, params, job)
+        return job
+
+    def finish(self, job: Job, result: Optional[Dict[str, Any]] = None, error: Optional[BaseException] = None):
+        finish_job(job, result, error)
+        self._supersession.finished(job)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def workers(self) -> int:
+        return self._worker_count
+
+    def grow(self, workers: int):
+        """Run up to workers jobs at once from now on."""
+        with self._start_lock:
+            self._worker_count = max(self._worker_count, workers)
+        self._ensure_started()
+
+    def _ensure_started(self):
+        with self._start_lock:
+            self._workers = [worker for worker in self._workers if worker.is_alive()]
+            while len(self._workers) < self._worker_count:
+                worker = threading.Thread(target=self._worker_loop, daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _worker_loop(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._run(job)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job: Job):
+        result, error = None, None
+        try:
+            # A job superseded while it was queued is dropped without running
+            with job.start_lock:
+                job.cancel_token.check()
+                job.status = IN_PROGRESS
+            job.started_at = time.monotonic()
+            JOB_QUEUE_WAIT_SECONDS.labels(job.kind).observe(job.started_at - job.created_at)
+            if job.kind in self._cancellable:
+                result = self.handlers[job.kind](**job.params, cancel=job.cancel_token)
+            else:
+                result = self.handlers[job.kind](**job.params)
+        except Exception as e:
+            if not job.cancel_token.cancelled:
+                logger.error(f"Error running {job.kind} job {job.id}: {str(e)}")
+                logger.error(traceback.format_exc())
+            error = e
+        finish_job(job, result, error)
+        self.store.finished(job)
+        self._supersession.finished(job)
+
+class AsyncJobScheduler:
+    """
+    JobScheduler for coroutine handlers. Workers are tasks on the event loop
+    rather than threads, so waiting jobs cost a queue slot and nothing more.
+    Every handler is cancellable: a superseded job's task is cancelled, and
+    leaving its engine with-blocks stops the search.
+    """
+
+    def __init__(self, store: JobStore, workers: int = 4, max_queued: int = 1000):
+        self.store = store
+        self.handlers: Dict[str, Callable[..., Awaitable[Dict[str, Any]]]] = {}
+        self._supersession = Supersession()
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queued)
+        self._workers: List[asyncio.Task] = []
+        self._worker_count = workers
+
+    def register(self, kind: str, handler: Callable[..., Awaitable[Dict[str, Any]]]):
+        self.handlers[kind] = handler
+
+    def submit(self, kind: str, supersede: Optional[Hashable] = None, **params) -> Job:
+        """Queue a job; must be called from the event loop the workers run on."""
+        if kind not in self.handlers:
+            raise ValueError(f"No handler registered for job kind: {kind}")
+        self._ensure_started()
+        job = Job(kind, params)
+        try:
+            self.store.add(job)
+        except QueueFullError:
+            JOBS_REJECTED.labels(kind).inc()
+            raise
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            JOBS_REJECTED.labels(kind).inc()
+            job.error = "Server is busy"
+            job.finished_at = time.monotonic()
+            job.status = FAILED
+            self.store.finished(job)
+            raise QueueFullError("Job queue is full")
+        if supersede is not None:
+            self._supersession.supersede(supersede, params, job)
+        return job
+
+    def supersede(self, key: Hashable, params: Dict[str, Any]):
+        self._supersession.supersede(key, params)
+
+    def start(self, kind: str, supersede: Optional[Hashable] = None, **params) -> Job:
+        """JobScheduler.start for a job run on the caller's task."""
+        job = start_job(kind, params)
+        if supersede is not None:
+            self._supersession.supersede(supersede, params, job)
+        return job
+
+    def finish(self, job: Job, result: Optional[Dict[str, Any]] = None, error: Optional[BaseException] = None):
+        finish_job(job, result, error)
+        self._supersession.finished(job)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def workers(self) -> int:
+        return self._worker_count
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def _ensure_started(self):
+        self._workers = [worker for worker in self._workers if not worker.done()]
+        while len(self._workers) < self._worker_count:
+            self._workers.append(asyncio.create_task(self._worker_loop()))
+
+    async def _worker_loop(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job):
+        result, error = None, None
+        try:
+            job.cancel_token.check()
+            job.status = IN_PROGRESS
+            job.started_at = time.monotonic()
+            JOB_QUEUE_WAIT_SECONDS.labels(job.kind).observe(job.started_at - job.created_at)
+            task = asyncio.ensure_future(self.handlers[job.kind](**job.params))
+            with job.cancel_token.stopping(task.cancel):
+                result = await task
+        except asyncio.CancelledError as e:
+            if not job.cancel_token.cancelled:
+                # The worker itself is shutting down
+                raise
+            error = e
+        except Exception as e:
+            if not job.cancel_token.cancelled:
+                logger.error(f"Error running {job.kind} job {job.id}: {str(e)}")
+                logger.error(traceback.format_exc())
+            error = e
+        finish_job(job, result, error)
+        self.store.finished(job)
+        self._supersession.finished(job)
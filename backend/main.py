@@ -1,18 +1,37 @@
-from flask import Flask, request, jsonify, after_this_request
+from flask import Flask, request, jsonify, after_this_request, Response, stream_with_context, g
 from flask_cors import CORS
 import chess
-from chess.engine import Limit
+import chess.polyglot
 from typing import Optional
 import os
 import traceback
 import logging
 from werkzeug.exceptions import UnsupportedMediaType
-import threading
 import queue
-import numpy as np
-from chess_engines import create_engine, ChessEngine
-from best_line import BestLine  # Import the BestLine class
-import asyncio
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from chess_engines import EnginePool
+from jobs import JobScheduler, QueueFullError
+from game_analysis import GameAnalysisPool
+from search_budget import DepthCallback, plan_search, leela_limit
+from engine_sessions import SessionManager
+from coalescing import SearchCoalescer, SharedCalls, run_in_flight
+from cancellation import CancelToken, Cancelled
+from prefetch import Prefetcher
+from analysis_service import (analysis_cache, analysis_store, apply_root_wdls, BatchTooLargeError, best_lines_params,
+                              best_lines_result, check_batch_size, child_boards, create_game_analysis_pool,
+                              evaluate_params, fast_path, fast_path_answer, job_queue_size, job_store, job_workers,
+                              known_sharpness, latency_target, leela_options, leela_path, leela_pool_size,
+                              leela_search_time, leela_wdl_nodes, leela_wdl_refine_nodes, legacy_result,
+                              LEELA_EXTRA_ROOT_LINES, max_engine_sessions, record_search, remember_job,
+                              root_wdls_by_move, session_idle_timeout, sharpness_event, sse_event,
+                              pool_stockfish_options, stockfish_path, stockfish_pool_size, store_batch_sharpnesses,
+                              store_search, store_sharpness, analysis_event, supersede_key, wdl_batches,
+                              wdl_sharpnesses, evaluation_event, known_lines_event, stream_candidates, stream_params,
+                              tablebase_events)
+import remote_engines
+import time
+import metrics
 
 app = Flask(__name__)
 CORS(app, resources={r"/evaluate": {"origins": "http://localhost:3000"}, 
@@ -20,120 +39,182 @@ CORS(app, resources={r"/evaluate": {"origins": "http://localhost:3000"},
                      r"/sharpness": {"origins": "http://localhost:3000"},
                      r"/sharpness-result": {"origins": "http://localhost:3000"},
                      r"/best-lines": {"origins": "http://localhost:3000"},
-                     r"/best-lines-result": {"origins": "http://localhost:3000"}})
+                     r"/best-lines-result": {"origins": "http://localhost:3000"},
+                     r"/jobs/*": {"origins": "http://localhost:3000"},
+                     r"/analysis-stream": {"origins": "http://localhost:3000"},
+                     r"/sharpness-batch": {"origins": "http://localhost:3000"},
+                     r"/analyse-pgn": {"origins": "http://localhost:3000"},
+                     r"/sessions/*": {"origins": "http://localhost:3000"},
+                     r"/workers": {"origins": "http://localhost:3000"},
+                     r"/metrics": {"origins": "http://localhost:3000"}})
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Global variables
-sf: Optional[ChessEngine] = None
-leela: Optional[ChessEngine] = None
+sf_pool: Optional[EnginePool] = None
+leela_pool: Optional[EnginePool] = None
+prefetcher: Optional[Prefetcher] = None
+session_manager: Optional[SessionManager] = None
+game_analysis_pool: Optional[GameAnalysisPool] = None
+
+job_scheduler = JobScheduler(job_store, workers=job_workers, max_queued=job_queue_size)
+
+# Positions after the latest answer's candidate moves, searched into the cache while Stockfish engines are idle
+prefetch_positions = int(os.environ.get('PREFETCH_POSITIONS', '8'))
+
+# Leela searches for best-lines candidates run here so they overlap each other and the Stockfish search
+candidate_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('LEELA_SCORING_THREADS', str(leela_pool_size + 1))))
+
+# Identical requests that arrive while a search is running share it instead of queueing their own
+search_coalescer = SearchCoalescer(max_searches=stockfish_pool_size)
+leela_calls = SharedCalls()
 
-# Stockfish configuration
-stockfish_path = os.environ.get('STOCKFISH_PATH', r'K:\github\stockfish-windows-x86-64\stockfish\stockfish-windows-x86-64.exe')
-stockfish_options = {'Threads': '10', 'Hash': '4096'}
+# POST /workers has no other authentication: only these hosts may add workers, or be added as one.
+# Defaults to the hosts already named in tcp:// engine paths; with none, no worker can be registered.
+worker_hosts = ([host.strip() for host in os.environ['WORKER_HOSTS'].split(',') if host.strip()]
+                if 'WORKER_HOSTS' in os.environ
+                else remote_engines.listed_hosts(stockfish_path) + remote_engines.listed_hosts(leela_path))
 
-# Leela Chess Zero configuration
-leela_path = r'K:\leela\lc0-v0.30.0-windows-gpu-nvidia-cudnn\lc0.exe'
-weights_path = r'K:\leela\lc0-v0.30.0-windows-gpu-nvidia-cudnn\791556.pb.gz'
-leela_options = {'WeightsFile': weights_path, 'UCI_ShowWDL': 'true'}
+# Without JOB_WORKERS, job threads keep up with pools that grow as engine workers register
+job_workers_follow_pools = 'JOB_WORKERS' not in os.environ
 
-evaluation_queue = queue.Queue(maxsize=1)
-evaluation_thread = None
-evaluation_lock = threading.Lock()
-latest_evaluation = None
+pool_lock = threading.Lock()
 
-sharpness_queue = queue.Queue(maxsize=1)
-sharpness_thread = None
-sharpness_lock = threading.Lock()
-latest_sharpness = None
+metrics.JOB_QUEUE_DEPTH.set_function(job_scheduler.queue_depth)
 
-best_lines_queue = queue.Queue(maxsize=1)
-best_lines_thread = None
-best_lines_lock = threading.Lock()
-latest_best_lines = None
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
 
-engine_lock = threading.Lock()
+@app.after_request
+def record_request_time(response):
+    # Streamed responses are timed until their headers are sent
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.REQUEST_SECONDS.labels(endpoint, request.method, response.status_code).observe(
+        time.perf_counter() - g.request_started)
+    return response
 
 def initialize_engines():
-    global sf, leela
-    
-    with engine_lock:
-        if sf is None:
-            try:
-                sf = create_engine("stockfish", stockfish_path, stockfish_options)
-                logger.info("Stockfish engine initialized successfully")
-            except Exception as e:
-                logger.error(f"Failed to initialize Stockfish engine: {str(e)}")
-                logger.error(traceback.format_exc())
-        
-        if leela is None:
-            try:
-                leela = create_engine("leela", leela_path, leela_options)
-                logger.info("Leela Chess Zero engine initialized successfully")
-            except Exception as e:
-                logger.error(f"Failed to initialize Leela Chess Zero engine: {str(e)}")
-                logger.error(traceback.format_exc())
-
-def restart_engine(engine_name: str):
-    global sf, leela
-    with engine_lock:
-        if engine_name == "stockfish":
-            if sf:
-                try:
-                    sf.quit()
-                except Exception as e:
-                    logger.error(f"Error shutting down Stockfish engine: {str(e)}")
-            sf = None
-            try:
-                sf = create_engine("stockfish", stockfish_path, stockfish_options)
-                logger.info("Stockfish engine restarted successfully")
-            except Exception as e:
-                logger.error(f"Failed to restart Stockfish engine: {str(e)}")
-                logger.error(traceback.format_exc())
-        elif engine_name == "leela":
-            if leela:
-                try:
-                    leela.quit()
-                except Exception as e:
-                    logger.error(f"Error shutting down Leela Chess Zero engine: {str(e)}")
-            leela = None
-            try:
-                leela = create_engine("leela", leela_path, leela_options)
-                logger.info("Leela Chess Zero engine restarted successfully")
-            except Exception as e:
-                logger.error(f"Failed to restart Leela Chess Zero engine: {str(e)}")
-                logger.error(traceback.format_exc())
-
-def evaluate_position_thread():
-    global sf, latest_evaluation
-    while True:
-        try:
-            fen, depth = evaluation_queue.get()
-            if fen is None:  # Signal to stop the thread
-                break
-            
-            with evaluation_lock:
-                if sf is None:
-                    initialize_engines()
-                
-                board = chess.Board(fen)
-                result = sf.analyse(board, chess.engine.Limit(depth=depth))
-                evaluation = result["score"].relative.score(mate_score=100000)
-                latest_evaluation = evaluation
-                logger.info(f"Analysis complete. Evaluation: {evaluation}")
-        except Exception as e:
-            logger.error(f"Error during position evaluation: {str(e)}")
-            logger.error(traceback.format_exc())
-            restart_engine("stockfish")
-        finally:
-            evaluation_queue.task_done()
+    global sf_pool, leela_pool, session_manager, prefetcher
+
+    with pool_lock:
+        if sf_pool is None:
+            sf_pool = EnginePool("stockfish", stockfish_path, pool_stockfish_options, size=stockfish_pool_size)
+            logger.info(f"Stockfish pool initialized with {stockfish_pool_size} engines")
+            if max_engine_sessions > 0:
+                session_manager = SessionManager(sf_pool, max_engine_sessions, idle_timeout=session_idle_timeout)
+            if prefetch_positions > 0:
+                prefetcher = Prefetcher(sf_pool, analysis_cache, max_positions=prefetch_positions)
+
+        if leela_pool is None:
+            leela_pool = EnginePool("leela", leela_path, leela_options, size=leela_pool_size)
+            logger.info(f"Leela Chess Zero pool initialized with {leela_pool_size} engines")
+
+    fit_pools_to_workers()
+
+def fit_pools_to_workers():
+    """
+    Grow pools of remote engines to the capacity of their registered workers, and the
+    search and job threads that feed them, so every worker engine gets used.
+    """
+    with pool_lock:
+        pools = [pool for pool in (sf_pool, leela_pool) if pool is not None]
+    for pool in pools:
+        if not remote_engines.is_remote(pool.engine_path):
+            continue
+        capacity = remote_engines.cluster_for(pool.engine_type).capacity()
+        if capacity > pool.size:
+            logger.info(f"Growing the {pool.engine_type} pool from {pool.size} to {capacity} engines to match its workers")
+            pool.grow(capacity)
+    if sf_pool is not None:
+        search_coalescer.grow(sf_pool.size)
+    if job_workers_follow_pools:
+        job_scheduler.grow(sum(pool.size for pool in pools))
+
+def submit_job(kind: str, message: str, supersede=None, **params):
+    try:
+        job = job_scheduler.submit(kind, supersede=supersede, **params)
+    except QueueFullError as e:
+        logger.warning(f"Rejecting {kind} request: {str(e)}")
+        return jsonify({"error": "Server is busy, try again later"}), 503
+    remember_job(job)
+    return jsonify({"message": message, "job_id": job.id}), 202
+
+def answer_from_fast_path(kind: str, message: str, lookup, fen: str, params: dict, supersede=None):
+    """A completed response when the book or tablebases know the position, otherwise None."""
+    answer = fast_path_answer(kind, message, lookup, fen, params, supersede, job_scheduler)
+    return (jsonify(answer), 200) if answer is not None else None
+
+def legacy_result_response(kind: str, field: str):
+    return jsonify(legacy_result(kind, field, request.args.get('job_id')))
+
+def search_lines(board: chess.Board, depth: int, multipv: int = 1, latency_ms: Optional[int] = None,
+                 session_id: Optional[str] = None, cancel: Optional[CancelToken] = None,
+                 on_depth: Optional[DepthCallback] = None):
+    """
+    Run a budgeted Stockfish search, on the session's pinned engine when a session is given, and
+    return what run_budgeted does; on_depth sees the depths it completes. Cancelling stops the
+    search unless other requests are still waiting for it, and raises Cancelled.
+    """
+    budget = plan_search(board, depth, latency_ms / 1000 if latency_ms else latency_target,
+                         job_scheduler.queue_depth(), job_scheduler.workers)
+    logger.info(f"Searching with {budget}")
+    if session_id is not None and session_manager is not None:
+        with metrics.STAGE_SECONDS.labels("stockfish_search").time():
+            lines, reached_depth, satisfied_depth = session_manager.analyse(session_id, board.fen(), budget,
+                                                                            multipv=multipv, cancel=cancel,
+                                                                            on_depth=on_depth)
+        record_search("stockfish", lines, reached_depth)
+        return lines, reached_depth, satisfied_depth
+
+    def run(search):
+        with metrics.STAGE_SECONDS.labels("stockfish_search").time():
+            with sf_pool.checkout() as sf:
+                lines, reached_depth, satisfied_depth = run_in_flight(sf, board, search, multipv=multipv)
+        record_search("stockfish", lines, reached_depth)
+        return lines, reached_depth, satisfied_depth
+    return search_coalescer.search((chess.polyglot.zobrist_hash(board), multipv), budget, run, cancel, on_depth)
+
+def prefetch_after(board: chess.Board, lines: list, depth: int, multipv: int = 1):
+    if prefetcher is not None:
+        prefetcher.schedule(board, lines, depth, multipv)
+
+def served_from_cache(board: chess.Board):
+    if prefetcher is not None and prefetcher.was_prefetched(board):
+        logger.info(f"Cache entry was prefetched: FEN={board.fen()}")
+
+def evaluate_position_thread(fen: str, depth: int, latency_ms: Optional[int] = None, session_id: Optional[str] = None,
+                             cancel: Optional[CancelToken] = None):
+    if sf_pool is None:
+        initialize_engines()
+
+    board = chess.Board(fen)
+    lines = analysis_cache.get(board, depth)
+    if lines is not None:
+        logger.info(f"Serving evaluation from cache: FEN={fen}, depth={depth}")
+        served_from_cache(board)
+        score = lines[0]["score"]
+    else:
+        stored = analysis_store.get_score(board, depth)
+        if stored is not None:
+            logger.info(f"Serving evaluation from analysis store: FEN={fen}, depth={stored[1]}")
+            score = stored[0]
+        else:
+            lines, reached_depth, satisfied_depth = search_lines(board, depth, latency_ms=latency_ms,
+                                                                 session_id=session_id, cancel=cancel)
+            store_search(board, lines, reached_depth, satisfied_depth)
+            score = lines[0]["score"]
+    if lines is not None:
+        # Stored scores carry no principal variation to follow
+        prefetch_after(board, lines, depth)
+    evaluation = score.relative.score(mate_score=100000)
+    logger.info(f"Analysis complete. Evaluation: {evaluation}")
+    return {"evaluation": evaluation}
 
 @app.route('/evaluate', methods=['POST'])
 def evaluate_position():
-    global evaluation_thread
-    
     if not request.is_json:
         logger.warning("Request Content-Type is not application/json")
         return jsonify({"error": "Content-Type must be application/json"}), 415
@@ -144,72 +225,38 @@ def evaluate_position():
         logger.warning("Failed to parse JSON data")
         return jsonify({"error": "Invalid JSON data"}), 400
 
-    fen = data.get('fen')
-    depth = data.get('depth', 20)
+    params = evaluate_params(data)
+    fen = params["fen"]
 
     if not fen:
         logger.warning("FEN string not provided in request")
         return jsonify({"error": "FEN string is required"}), 400
 
-    logger.info(f"Evaluating position: FEN={fen}, depth={depth}")
-
-    # Clear the queue and add the new request
-    while not evaluation_queue.empty():
-        try:
-            evaluation_queue.get_nowait()
-        except queue.Empty:
-            break
-    evaluation_queue.put((fen, depth))
+    logger.info(f"Evaluating position: FEN={fen}, depth={params['depth']}")
 
-    # Start the evaluation thread if it's not running
-    if evaluation_thread is None or not evaluation_thread.is_alive():
-        evaluation_thread = threading.Thread(target=evaluate_position_thread)
-        evaluation_thread.start()
+    supersede = supersede_key("evaluate", data)
+    answered = answer_from_fast_path("evaluate", "Evaluation answered from tablebases", fast_path.evaluate, fen,
+                                     params, supersede)
+    if answered is not None:
+        return answered
 
-    return jsonify({"message": "Evaluation request received"}), 202
+    return submit_job("evaluate", "Evaluation request received", supersede, **params)
 
 @app.route('/evaluation-result', methods=['GET'])
 def get_evaluation_result():
-    with evaluation_lock:
-        if latest_evaluation is not None:
-            return jsonify({"status": "completed", "evaluation": latest_evaluation})
-        else:
-            return jsonify({"status": "in_progress"})
+    return legacy_result_response("evaluate", "evaluation")
 
-def sharpness_calculation_thread():
-    global leela, latest_sharpness
-    while True:
-        try:
-            fen = sharpness_queue.get()
-            if fen is None:  # Signal to stop the thread
-                break
-            
-            with sharpness_lock:
-                if leela is None:
-                    initialize_engines()
-                
-                board = chess.Board(fen)
-                result = leela.analyse(board, Limit(time=1.0))
-                wdl = result.get("wdl")
-                
-                if wdl is None:
-                    latest_sharpness = None
-                else:
-                    sharpness = sharpnessLC0(wdl)
-                    latest_sharpness = sharpness
-                    logger.info(f"Sharpness calculation complete. Sharpness: {sharpness}")
-        except Exception as e:
-            logger.error(f"Error during sharpness calculation: {str(e)}")
-            logger.error(traceback.format_exc())
-            latest_sharpness = None
-            restart_engine("leela")
-        finally:
-            sharpness_queue.task_done()
+def sharpness_calculation_thread(fen: str):
+    if leela_pool is None:
+        initialize_engines()
+
+    board = chess.Board(fen)
+    sharpness = leela_sharpness(board)
+    logger.info(f"Sharpness calculation complete. Sharpness: {sharpness}")
+    return {"sharpness": sharpness}
 
 @app.route('/sharpness', methods=['POST'])
 def calculate_sharpness():
-    global sharpness_thread
-    
     if not request.is_json:
         logger.warning("Request Content-Type is not application/json")
         return jsonify({"error": "Content-Type must be application/json"}), 415
@@ -228,100 +275,175 @@ def calculate_sharpness():
 
     logger.info(f"Calculating sharpness for position: FEN={fen}")
 
-    # Clear the queue and add the new request
-    while not sharpness_queue.empty():
-        try:
-            sharpness_queue.get_nowait()
-        except queue.Empty:
-            break
-    sharpness_queue.put(fen)
-
-    # Start the sharpness thread if it's not running
-    if sharpness_thread is None or not sharpness_thread.is_alive():
-        sharpness_thread = threading.Thread(target=sharpness_calculation_thread)
-        sharpness_thread.start()
+    supersede = supersede_key("sharpness", data)
+    answered = answer_from_fast_path("sharpness", "Sharpness answered from tablebases", fast_path.sharpness, fen,
+                                     {"fen": fen}, supersede)
+    if answered is not None:
+        return answered
 
-    return jsonify({"message": "Sharpness calculation request received"}), 202
+    return submit_job("sharpness", "Sharpness calculation request received", supersede, fen=fen)
 
 @app.route('/sharpness-result', methods=['GET'])
 def get_sharpness_result():
-    with sharpness_lock:
-        if latest_sharpness is not None:
-            return jsonify({"status": "completed", "sharpness": latest_sharpness})
-        else:
-            return jsonify({"status": "in_progress"})
+    return legacy_result_response("sharpness", "sharpness")
+
+def leela_sharpness(board: chess.Board) -> float:
+    known = known_sharpness(board)
+    if known is not None:
+        return known
+    return leela_calls.call(("sharpness", chess.polyglot.zobrist_hash(board)), lambda: search_sharpness(board))
+
+def search_sharpness(board: chess.Board) -> float:
+    with metrics.STAGE_SECONDS.labels("leela_wdl").time():
+        with leela_pool.checkout() as leela:
+            result = leela.analyse_wdl(board, leela_wdl_nodes, leela_wdl_refine_nodes)
+    record_search("leela", [result])
+    return store_sharpness(board, result)
+
+def leela_sharpnesses(boards: list) -> list:
+    """
+    leela_sharpness for many positions. Known positions are answered first; the rest
+    go to Leela in one WDL batch per engine, so every engine's network stays busy.
+    """
+    sharpnesses = [known_sharpness(board) for board in boards]
+    pending = [i for i, sharpness in enumerate(sharpnesses) if sharpness is None]
+    if not pending:
+        return sharpnesses
+
+    def run(batch):
+        with leela_pool.checkout() as leela:
+            return leela.analyse_wdls([boards[i] for i in batch], leela_wdl_nodes, leela_wdl_refine_nodes)
+    batches = wdl_batches(pending, leela_pool.size)
+    with metrics.STAGE_SECONDS.labels("leela_wdl").time():
+        results = list(candidate_executor.map(run, batches))
+    store_batch_sharpnesses(boards, sharpnesses, batches, results)
+    return sharpnesses
+
+def sharpness_batch_calculation_thread(fens: list):
+    if leela_pool is None:
+        initialize_engines()
+
+    boards = [chess.Board(fen) for fen in fens]
+    sharpnesses = leela_sharpnesses(boards)
+    logger.info(f"Batch sharpness calculation complete for {len(fens)} positions")
+    return {"sharpness": sharpnesses}
+
+@app.route('/sharpness-batch', methods=['POST'])
+def calculate_sharpness_batch():
+    if not request.is_json:
+        logger.warning("Request Content-Type is not application/json")
+        return jsonify({"error": "Content-Type must be application/json"}), 415
+
+    try:
+        data = request.json
+    except UnsupportedMediaType:
+        logger.warning("Failed to parse JSON data")
+        return jsonify({"error": "Invalid JSON data"}), 400
 
-def sharpnessLC0(wdl: list) -> float:
-    W = min(max(wdl[0]/1000, 0.0001), 0.9999)
-    L = min(max(wdl[2]/1000, 0.0001), 0.9999)
-    return (max(2/(np.log((1/W)-1) + np.log((1/L)-1)), 0))**2 * min(W, L) * 4
+    wdls = data.get('wdls')
+    fens = data.get('fens')
 
-def best_lines_calculation_thread():
-    global sf, leela, latest_best_lines
-    while True:
+    if wdls is not None:
+        # WDLs need no engine, so answer them straight away
         try:
-            current_fen, number_of_lines, depth = best_lines_queue.get()
-            if current_fen is None:  # Signal to stop the thread
-                break
-            
-            with engine_lock:
-                if sf is None or leela is None:
-                    initialize_engines()
-
-                board = chess.Board(current_fen)
-                info = sf.analyse_with_multipv(board, chess.engine.Limit(depth=depth), multipv=number_of_lines)
-                best_lines = []
-
-                for i, line_info in enumerate(info):
-                    logger.info(f"Line {i+1}:")
-                    moves = line_info['pv']
-                    move_sans = board.variation_san(moves)
-                    score = line_info['score'].relative.score()
-                    logger.info(f"Moves: {move_sans}, Score: {score}")
-
-                    # Generate the FEN based on the next move
-                    board.push(moves[0])
-                    new_fen = board.fen()
-                    board.pop()
-
-                    try:
-                        leela_board = chess.Board(new_fen)
-                        wdl_info = leela.analyse(leela_board, Limit(time=1.0))
-                        wdl = wdl_info['wdl']
-                    except chess.engine.EngineTerminatedError as e:
-                        logger.error(f"Leela engine terminated unexpectedly: {str(e)}")
-                        leela = None  # Reset the engine
-                        restart_engine("leela")
-                        raise
-                    except Exception as e:
-                        logger.error(f"Error during Leela analysis: {str(e)}")
-                        logger.error(traceback.format_exc())
-                        restart_engine("leela")
-                        raise
-
-                    # Calculate the sharpness based on WDL
-                    sharpness = sharpnessLC0(wdl)
-                    logger.info(f"Sharpness: {sharpness}")
-
-                    # Append the best line with sharpness
-                    best_line = BestLine(move_sans, score, sharpness)
-                    best_lines.append(best_line.to_dict())
-
-                with best_lines_lock:
-                    latest_best_lines = best_lines
-                logger.info("Best lines calculation complete")
+            sharpnesses = wdl_sharpnesses(wdls)
+        except BatchTooLargeError as e:
+            logger.warning("Too many WDLs in batch sharpness request")
+            return jsonify({"error": str(e)}), 413
+        except ValueError as e:
+            logger.warning("Invalid WDL list in batch sharpness request")
+            return jsonify({"error": str(e)}), 400
+        logger.info(f"Batch sharpness calculated for {len(sharpnesses)} WDLs")
+        return jsonify({"status": "completed", "sharpness": sharpnesses})
+
+    if not fens or not isinstance(fens, list):
+        logger.warning("Neither WDLs nor FEN strings provided in request")
+        return jsonify({"error": "Either wdls or a list of FEN strings is required"}), 400
+    try:
+        check_batch_size(fens)
+    except BatchTooLargeError as e:
+        logger.warning("Too many FENs in batch sharpness request")
+        return jsonify({"error": str(e)}), 413
+
+    logger.info(f"Calculating batch sharpness for {len(fens)} positions")
+
+    return submit_job("sharpness_batch", "Batch sharpness calculation request received", fens=fens)
+
+def leela_root_wdls(board: chess.Board, multipv: int) -> dict:
+    """Score the root moves with one Leela multipv search, returning the WDL of each first move."""
+    def search():
+        with metrics.STAGE_SECONDS.labels("leela_wdl").time():
+            with leela_pool.checkout() as leela:
+                infos = leela.analyse_with_multipv(board, leela_limit(leela_search_time, job_scheduler.queue_depth(), job_scheduler.workers),
+                                                   multipv=multipv)
+        return root_wdls_by_move(infos)
+    return leela_calls.call(("root_wdls", chess.polyglot.zobrist_hash(board), multipv), search)
+
+def score_candidates(board: chess.Board, moves: list, root_wdls: Optional[Future] = None) -> list:
+    """
+    Sharpness of the position after each move. Uses the tablebases and analysis store first,
+    then the WDL Leela reported for that root move, then fans the rest out across the Leela pool.
+    """
+    children = child_boards(board, moves)
+    sharpnesses = [known_sharpness(child) for child in children]
+
+    if root_wdls is not None and None in sharpnesses:
+        try:
+            wdls = root_wdls.result()
         except Exception as e:
-            logger.error(f"Error during best lines calculation: {str(e)}")
-            logger.error(traceback.format_exc())
-            with best_lines_lock:
-                latest_best_lines = None
-        finally:
-            best_lines_queue.task_done()
+            logger.error(f"Leela root move scoring failed, scoring candidates one by one: {str(e)}")
+            wdls = {}
+        apply_root_wdls(moves, children, sharpnesses, wdls)
+
+    pending = [i for i in range(len(moves)) if sharpnesses[i] is None]
+    for i, sharpness in zip(pending, leela_sharpnesses([children[i] for i in pending])):
+        sharpnesses[i] = sharpness
+    return sharpnesses
+
+def best_lines_calculation_thread(current_fen: str, number_of_lines: int, depth: int, latency_ms: Optional[int] = None,
+                                  session_id: Optional[str] = None, cancel: Optional[CancelToken] = None):
+    if sf_pool is None or leela_pool is None:
+        initialize_engines()
+
+    board = chess.Board(current_fen)
+    info = analysis_cache.get(board, depth, multipv=number_of_lines)
+    root_wdls = None
+    if info is None:
+        # Let Leela score the root moves while Stockfish searches; a few extra lines
+        # make it likely that every Stockfish candidate is among them
+        leela_lines = min(number_of_lines + LEELA_EXTRA_ROOT_LINES, board.legal_moves.count())
+        if leela_lines > 0:
+            root_wdls = candidate_executor.submit(leela_root_wdls, board.copy(), leela_lines)
+        try:
+            info, reached_depth, satisfied_depth = search_lines(board, depth, number_of_lines, latency_ms,
+                                                                session_id, cancel)
+        except Cancelled:
+            # A Leela root search that already started is short and may be shared, so it is left to finish
+            if root_wdls is not None:
+                root_wdls.cancel()
+            raise
+        store_search(board, info, reached_depth, satisfied_depth)
+    else:
+        logger.info(f"Serving best lines from cache: FEN={current_fen}, depth={depth}")
+        served_from_cache(board)
+    prefetch_after(board, info, depth, number_of_lines)
+
+    try:
+        # Calculate the sharpness based on WDL
+        with metrics.STAGE_SECONDS.labels("sharpness").time():
+            sharpnesses = score_candidates(board, [line_info['pv'][0] for line_info in info], root_wdls)
+    except chess.engine.EngineTerminatedError as e:
+        logger.error(f"Leela engine terminated unexpectedly: {str(e)}")
+        raise
+    except Exception as e:
+        logger.error(f"Error during Leela analysis: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise
+
+    return best_lines_result(board, info, sharpnesses)
 
 @app.route('/best-lines', methods=['POST'])
 def get_best_lines():
-    global best_lines_thread
-    
     if not request.is_json:
         logger.warning("Request Content-Type is not application/json")
         return jsonify({"error": "Content-Type must be application/json"}), 415
@@ -332,38 +454,274 @@ def get_best_lines():
         logger.warning("Failed to parse JSON data")
         return jsonify({"error": "Invalid JSON data"}), 400
 
-    current_fen = data.get('current_fen')
-    number_of_lines = data.get('number_of_lines', 1)
-    depth = data.get('depth', 20)
+    params = best_lines_params(data)
+    current_fen, number_of_lines = params["current_fen"], params["number_of_lines"]
 
     if not current_fen:
         logger.warning("FEN string not provided in request")
         return jsonify({"error": "FEN string is required"}), 400
 
-    logger.info(f"Getting best lines: FEN={current_fen}, number_of_lines={number_of_lines}, depth={depth}")
+    logger.info(f"Getting best lines: FEN={current_fen}, number_of_lines={number_of_lines}, depth={params['depth']}")
 
-    # Clear the queue and add the new request
-    while not best_lines_queue.empty():
-        try:
-            best_lines_queue.get_nowait()
-        except queue.Empty:
-            break
-    best_lines_queue.put((current_fen, number_of_lines, depth))
+    supersede = supersede_key("best_lines", data)
+    answered = answer_from_fast_path("best_lines", "Best lines answered without a search",
+                                     lambda board: fast_path.best_lines(board, number_of_lines), current_fen,
+                                     params, supersede)
+    if answered is not None:
+        return answered
 
-    # Start the best lines thread if it's not running
-    if best_lines_thread is None or not best_lines_thread.is_alive():
-        best_lines_thread = threading.Thread(target=best_lines_calculation_thread)
-        best_lines_thread.start()
-
-    return jsonify({"message": "Best lines calculation request received"}), 202
+    return submit_job("best_lines", "Best lines calculation request received", supersede, **params)
 
 @app.route('/best-lines-result', methods=['GET'])
 def get_best_lines_result():
-    with best_lines_lock:
-        if latest_best_lines is not None:
-            return jsonify({"status": "completed", "best_lines": latest_best_lines})
-        else:
-            return jsonify({"status": "in_progress"})
+    return legacy_result_response("best_lines", "best_lines")
+
+def analysis_stream(board: chess.Board, params: dict, supersede):
+    """
+    The events of one stream. It runs as a job of its own, so a newer stream from the same client
+    cancels it as a newer request cancels a queued job, and it sends superseded instead of done.
+    """
+    job = job_scheduler.start("analysis_stream", supersede, **params)
+    error = None
+    try:
+        yield from analysis_events(board, cancel=job.cancel_token, **params)
+    except Cancelled as e:
+        logger.info(f"Stopping superseded analysis stream: FEN={params['fen']}")
+        error = e
+        yield sse_event("superseded", {"fen": params["fen"]})
+    except GeneratorExit as e:
+        # The client closed the connection: stop the search unless other requests share it
+        job.cancel_token.cancel()
+        error = e
+        raise
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        job_scheduler.finish(job, error=error)
+
+def analysis_events(board: chess.Board, fen: str, depth: int, multipv: int, sharpness: bool,
+                    latency_ms: Optional[int], session_id: Optional[str], cancel: CancelToken):
+    """
+    The book or tablebases first, then the cache, the analysis store and a search as the job
+    endpoints use them. Book moves come without a score, so the position is still evaluated.
+    """
+    known = fast_path.best_lines(board, multipv)
+    if known is not None:
+        yield known_lines_event(fen, known)
+        if known["source"] == "tablebase":
+            yield from tablebase_events(board, fen, known, sharpness)
+            return
+        multipv = 1
+    lines = analysis_cache.get(board, depth, multipv=multipv)
+    stored = None
+    if lines is None and multipv == 1:
+        # Stored scores carry no moves, which one line or book lines do without
+        stored = analysis_store.get_score(board, depth)
+    if lines is not None:
+        logger.info(f"Streaming analysis from cache: FEN={fen}, depth={depth}")
+        served_from_cache(board)
+        yield analysis_event(board, fen, depth, lines)
+        reached_depth = depth
+    elif stored is not None:
+        logger.info(f"Streaming evaluation from analysis store: FEN={fen}, depth={stored[1]}")
+        yield evaluation_event(fen, stored[0].relative.score(mate_score=100000), stored[1], "store")
+        lines, reached_depth = [], stored[1]
+    else:
+        lines, reached_depth = yield from searched_events(board, fen, depth, multipv, latency_ms, session_id, cancel)
+    if lines:
+        prefetch_after(board, lines, depth, multipv)
+    if sharpness:
+        cancel.check()
+        try:
+            with metrics.STAGE_SECONDS.labels("sharpness").time():
+                yield sharpness_event(fen, leela_sharpness(board),
+                                      score_candidates(board, stream_candidates(board, known, lines)))
+        except Exception as e:
+            logger.error(f"Error scoring streamed position: {str(e)}")
+            logger.error(traceback.format_exc())
+    yield sse_event("done", {"fen": fen, "depth": reached_depth})
+
+def searched_events(board: chess.Board, fen: str, depth: int, multipv: int, latency_ms: Optional[int],
+                    session_id: Optional[str], cancel: CancelToken):
+    """
+    An analysis event for each depth search_lines completes; returns its lines and depth once it
+    is done. The search runs on a thread of its own so the events can be sent as they arrive.
+    """
+    updates = queue.Queue()
+
+    def search():
+        try:
+            result = search_lines(board, depth, multipv, latency_ms, session_id, cancel,
+                                  on_depth=lambda lines, reached: updates.put(("depth", (lines, reached))))
+            updates.put(("result", result))
+        except Exception as e:
+            updates.put(("error", e))
+    threading.Thread(target=search, daemon=True).start()
+    reported = 0
+    while True:
+        kind, update = updates.get()
+        if kind == "error":
+            raise update
+        if kind == "depth":
+            lines, reported = update
+            yield analysis_event(board, fen, reported, lines)
+            continue
+        lines, reached_depth, satisfied_depth = update
+        if reached_depth > reported:
+            yield analysis_event(board, fen, reached_depth, lines)
+        store_search(board, lines, reached_depth, satisfied_depth)
+        return lines, reached_depth
+
+@app.route('/analysis-stream', methods=['GET'])
+def stream_analysis():
+    params = stream_params(request.args)
+    fen = params["fen"]
+
+    if not fen:
+        logger.warning("FEN string not provided in request")
+        return jsonify({"error": "FEN string is required"}), 400
+
+    try:
+        board = chess.Board(fen)
+    except ValueError:
+        logger.warning(f"Invalid FEN string: {fen}")
+        return jsonify({"error": "Invalid FEN string"}), 400
+
+    if sf_pool is None or leela_pool is None:
+        initialize_engines()
+
+    logger.info(f"Streaming analysis: FEN={fen}, depth={params['depth']}, multipv={params['multipv']}, "
+                f"sharpness={params['sharpness']}, session_id={params['session_id']}")
+
+    supersede = supersede_key("analysis_stream", request.args)
+    # Closing the connection raises GeneratorExit inside the generator, which stops the search
+    return Response(stream_with_context(analysis_stream(board, params, supersede)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def get_game_analysis_pool() -> GameAnalysisPool:
+    global game_analysis_pool
+    with pool_lock:
+        if game_analysis_pool is None:
+            game_analysis_pool = create_game_analysis_pool()
+        return game_analysis_pool
+
+def game_analysis_events(pgn: str, depth: int):
+    try:
+        for ply in get_game_analysis_pool().analyse_game(pgn, depth=depth):
+            yield sse_event("ply", ply)
+    except ValueError as e:
+        logger.warning(f"Invalid PGN in game analysis request: {str(e)}")
+        yield sse_event("error", {"error": str(e)})
+        return
+    except Exception as e:
+        logger.error(f"Error during game analysis: {str(e)}")
+        logger.error(traceback.format_exc())
+        yield sse_event("error", {"error": "Game analysis failed"})
+        return
+    yield sse_event("done", {})
+
+@app.route('/analyse-pgn', methods=['POST'])
+def analyse_pgn():
+    if not request.is_json:
+        logger.warning("Request Content-Type is not application/json")
+        return jsonify({"error": "Content-Type must be application/json"}), 415
+
+    try:
+        data = request.json
+    except UnsupportedMediaType:
+        logger.warning("Failed to parse JSON data")
+        return jsonify({"error": "Invalid JSON data"}), 400
+
+    pgn = data.get('pgn')
+    depth = data.get('depth', 16)
+
+    if not pgn:
+        logger.warning("PGN not provided in request")
+        return jsonify({"error": "PGN is required"}), 400
+
+    logger.info(f"Analysing game: {len(pgn)} characters of PGN, depth={depth}")
+
+    return Response(stream_with_context(game_analysis_events(pgn, depth)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.REGISTRY.exposition(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/sessions/<session_id>', methods=['DELETE'])
+def close_session(session_id):
+    if session_manager is None or not session_manager.close_session(session_id):
+        return jsonify({"error": "Session not found"}), 404
+    return jsonify({"message": "Session closed"})
+
+@app.route('/workers', methods=['GET'])
+def list_workers():
+    return jsonify({engine_type: remote_engines.cluster_for(engine_type).status()
+                    for engine_type, path in (("stockfish", stockfish_path), ("leela", leela_path))
+                    if remote_engines.is_remote(path)})
+
+@app.route('/workers', methods=['POST'])
+def register_worker():
+    if not request.is_json:
+        logger.warning("Request Content-Type is not application/json")
+        return jsonify({"error": "Content-Type must be application/json"}), 415
+
+    try:
+        data = request.json
+    except UnsupportedMediaType:
+        logger.warning("Failed to parse JSON data")
+        return jsonify({"error": "Invalid JSON data"}), 400
+
+    address = data.get('address')
+    if not address:
+        logger.warning("Worker address not provided in request")
+        return jsonify({"error": "Address is required"}), 400
+
+    try:
+        host, port = remote_engines.parse_address(address)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    if not (remote_engines.is_allowed_host(request.remote_addr, worker_hosts)
+            and remote_engines.is_allowed_host(host, worker_hosts)):
+        logger.warning(f"Refusing to register worker {address} for {request.remote_addr}: host not in WORKER_HOSTS")
+        return jsonify({"error": "Worker host is not allowed"}), 403
+
+    try:
+        worker = remote_engines.probe_worker(address)
+    except OSError as e:
+        logger.warning(f"Worker {address} is unreachable: {str(e)}")
+        return jsonify({"error": f"Worker {address} is unreachable"}), 503
+    except ValueError as e:
+        logger.warning(f"Worker {address} did not answer like an engine worker: {str(e)}")
+        return jsonify({"error": f"Worker {address} sent an invalid handshake"}), 502
+    if worker["engine"] not in ("stockfish", "leela"):
+        logger.warning(f"Worker {address} runs an unknown engine type: {worker['engine']!r}")
+        return jsonify({"error": f"Worker {address} runs an unknown engine type"}), 502
+
+    engine_path = stockfish_path if worker["engine"] == "stockfish" else leela_path
+    if not remote_engines.is_remote(engine_path):
+        # The pool runs local engines, so nothing would send work to this worker
+        return jsonify({"error": f"{worker['engine']} engines are local on this server"}), 409
+
+    remote_engines.cluster_for(worker["engine"]).add((host, port))
+    fit_pools_to_workers()
+    return jsonify({"address": address, **worker})
+
+job_scheduler.register("evaluate", evaluate_position_thread, cancellable=True)
+job_scheduler.register("sharpness", sharpness_calculation_thread)
+job_scheduler.register("best_lines", best_lines_calculation_thread, cancellable=True)
+job_scheduler.register("sharpness_batch", sharpness_batch_calculation_thread)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,259 @@
+"""
+Counters, gauges and histograms in the Prometheus text exposition format.
+
+Recording a value takes one lock and a few arithmetic operations, cheap
+enough for every request and every engine search. All metrics of the
+backend are defined at the bottom of this module, so the names live in one
+place.
+"""
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, from a cache hit to a long engine search
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return repr(float(value))
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+class Registry:
+    def __init__(self):
+        self._metrics: List["Metric"] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: "Metric"):
+        with self._lock:
+            if any(existing.name == metric.name for existing in self._metrics):
+                raise ValueError(f"Metric already registered: {metric.name}")
+            self._metrics.append(metric)
+
+    def exposition(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines: List[str] = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+class Metric:
+    """A named metric with an optional fixed set of labels; labels() returns the series for one set of values."""
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional[Registry] = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._series[()] = self._new_series()
+        if registry is not None:
+            registry.register(self)
+
+    def _new_series(self):
+        raise NotImplementedError
+
+    def labels(self, *values) -> object:
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+        key = tuple(str(value) for value in values)
+        series = self._series.get(key)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(key, self._new_series())
+        return series
+
+    def _unlabelled(self):
+        if self.labelnames:
+            raise ValueError(f"{self.name} has labels {self.labelnames}; use labels()")
+        return self._series[()]
+
+    def _items(self):
+        with self._lock:
+            return list(self._series.items())
+
+    def collect(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(series.get())}"
+                for key, series in self._items()]
+
+class _Value:
+    def __init__(self):
+        self._value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self._value += amount
+
+    def set(self, value: float):
+        with self._lock:
+            self._value = float(value)
+
+    def set_function(self, function: Callable[[], float]):
+        """Read the value from function at collection time instead of storing it."""
+        self._function = function
+
+    def get(self) -> float:
+        if self._function is not None:
+            return float(self._function())
+        with self._lock:
+            return self._value
+
+class _CounterValue(_Value):
+    def inc(self, amount: float = 1.0):
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        super().inc(amount)
+
+class _GaugeValue(_Value):
+    def dec(self, amount: float = 1.0):
+        self.inc(-amount)
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_series(self):
+        return _CounterValue()
+
+    def inc(self, amount: float = 1.0):
+        self._unlabelled().inc(amount)
+
+    def set_function(self, function: Callable[[], float]):
+        self._unlabelled().set_function(function)
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def _new_series(self):
+        return _GaugeValue()
+
+    def inc(self, amount: float = 1.0):
+        self._unlabelled().inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self._unlabelled().dec(amount)
+
+    def set(self, value: float):
+        self._unlabelled().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self._unlabelled().set_function(function)
+
+class _HistogramValue:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # One count per bucket plus +Inf, not cumulative; collect() adds them up
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def snapshot(self) -> Tuple[List[int], float]:
+        with self._lock:
+            return list(self._counts), self._sum
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS, registry: Optional[Registry] = REGISTRY):
+        self.buckets = tuple(sorted(float(bucket) for bucket in buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_series(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._unlabelled().observe(value)
+
+    def time(self):
+        return self._unlabelled().time()
+
+    def collect(self) -> List[str]:
+        lines = []
+        for key, series in self._items():
+            counts, total = series.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ("le",), key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+# HTTP
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Time to answer an HTTP request, excluding streamed bodies.",
+                            ("endpoint", "method", "status"))
+
+# Jobs
+JOB_QUEUE_WAIT_SECONDS = Histogram("job_queue_wait_seconds", "Time a job waited in the queue before a worker took it.", ("kind",))
+JOB_RUN_SECONDS = Histogram("job_run_seconds", "Time a worker spent running a job.", ("kind", "status"))
+JOBS_REJECTED = Counter("jobs_rejected_total", "Jobs refused because the queue or job store was full.", ("kind",))
+JOB_QUEUE_DEPTH = Gauge("job_queue_depth", "Jobs waiting for a worker.")
+JOBS_CANCELLED = Counter("jobs_cancelled_total", "Jobs cancelled by a newer request from the same client, by state: queued or running.",
+                         ("kind", "state"))
+CANCELLED_JOB_SECONDS = Counter("cancelled_job_seconds_total", "Time workers and engines spent on jobs that were then cancelled.",
+                                ("kind",))
+
+# Analysis stages
+STAGE_SECONDS = Histogram("analysis_stage_seconds",
+                          "Time spent in each analysis stage: stockfish_search, leela_wdl and sharpness.", ("stage",))
+SEARCH_DEPTH = Histogram("stockfish_search_depth", "Depth reached by Stockfish searches.",
+                         buckets=(4, 8, 12, 16, 20, 24, 28, 32, 40))
+ENGINE_NPS = Gauge("engine_nodes_per_second", "Nodes per second reported at the end of the latest search.", ("engine",))
+FAST_PATH_ANSWERS = Counter("fast_path_answers_total", "Requests answered from the opening book or tablebases without a search.",
+                            ("source",))
+SEARCHES_COALESCED = Counter("searches_coalesced_total", "Requests that attached to a search already running for the same position.")
+PREFETCH_SEARCHES = Counter("prefetch_searches_total",
+                            "Speculative searches of likely next positions, by outcome: completed, preempted or superseded.",
+                            ("outcome",))
+PREFETCH_HITS = Counter("prefetch_hits_total", "Requests answered from the cache by a speculative search.")
+
+# Caches
+CACHE_LOOKUPS = Counter("cache_lookups_total", "Lookups in the in-memory cache and the persistent analysis store.",
+                        ("cache", "result"))
+
+# Engine processes
+ENGINE_STARTS = Counter("engine_starts_total", "Engine processes started, including replacements.", ("engine",))
+ENGINE_START_FAILURES = Counter("engine_start_failures_total", "Engine processes that failed to start.", ("engine",))
+ENGINE_CRASHES = Counter("engine_crashes_total", "Engines discarded after an error or a failed health check.", ("engine",))
+REMOTE_WORKER_FAILURES = Counter("remote_worker_failures_total",
+                                 "Requests moved to another engine worker because theirs could not be reached.", ("engine",))
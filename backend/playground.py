@@ -1,24 +1,21 @@
+import os
 import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
+from sharpness import SharpnessTable
 
-# Define the function
-def sharpnessLC0(wdl: list) -> float:
-    W = min(max(wdl[0] / 1000, 0.0001), 0.9999)
-    L = min(max(wdl[2] / 1000, 0.0001), 0.9999)
-    return (max(2 / (np.log((1 / W) - 1) + np.log((1 / L) - 1)), 0)) ** 2 * min(W, L) * 4
+# The same table the server uses, so both read one file
+sharpness_table = SharpnessTable.load_or_build(os.environ.get('SHARPNESS_TABLE_PATH',
+                                                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sharpness_table.npy')))
 
 # Generate a grid of values for W and L
 win_values = np.linspace(0, 1000, 100)
 loss_values = np.linspace(0, 1000, 100)
 W, L = np.meshgrid(win_values, loss_values)
-sharpness = np.zeros_like(W)
 
-# Compute sharpness for each pair of W and L
-for i in range(len(win_values)):
-    for j in range(len(loss_values)):
-        wdl = [W[i, j], 0, L[i, j]]  # Keeping draw value at 0 since it's not used
-        sharpness[i, j] = sharpnessLC0(wdl)
+# Compute sharpness for every pair of W and L in one call
+wdl = np.stack([W.ravel(), np.zeros(W.size), L.ravel()], axis=1)  # Keeping draw value at 0 since it's not used
+sharpness = sharpness_table.lookup(wdl).reshape(W.shape)
 
 # Create a 3D surface plot
 fig = plt.figure(figsize=(10, 8))
@@ -34,18 +31,9 @@ plt.colorbar(surf)
 plt.show()
 
 
-# Initialize variables to store min and max values
-min_value = 0
-max_value = 0
-
-for W in win_values:
-    for L in loss_values:
-        wdl = [W, 0, L]  # Draw (D) is not used, so set it to 0
-        sharpness = sharpnessLC0(wdl)
-        if sharpness < min_value:
-            min_value = sharpness
-        if sharpness > max_value:
-            max_value = sharpness
+# Min and max over the grid, starting from 0 as before
+min_value = min(sharpness.min(), 0)
+max_value = max(sharpness.max(), 0)
 
 print(f"Minimum Sharpness: {min_value}")
 print(f"Maximum Sharpness: {max_value}")
@@ -54,14 +42,12 @@ print(f"Maximum Sharpness: {max_value}")
 # Store combinations where sharpness is greater than 10
 combinations = []
 
-for W in win_values:
-    for L in loss_values:
-        wdl = [W, 0, L]  # Draw (D) is not used, so set it to 0
-        sharpness = sharpnessLC0(wdl)
-        if sharpness > 10:
-            combinations.append((W, L, sharpness))
-            if len(combinations) >= 5:  # Limit to 5 combinations
-                break
+# sharpness[j, i] belongs to win_values[i] and loss_values[j]
+for i, W in enumerate(win_values):
+    for j in np.nonzero(sharpness[:, i] > 10)[0]:
+        combinations.append((W, loss_values[j], sharpness[j, i]))
+        if len(combinations) >= 5:  # Limit to 5 combinations
+            break
     if len(combinations) >= 10:
         break
 
@@ -0,0 +1,178 @@
+import logging
+import threading
+import traceback
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import chess
+import chess.engine
+import chess.polyglot
+
+from analysis_cache import AnalysisCache
+from chess_engines import EnginePool
+from metrics import PREFETCH_HITS, PREFETCH_SEARCHES
+from search_budget import SearchBudget, SearchProgress
+
+logger = logging.getLogger(__name__)
+
+# How long to wait before looking for an idle engine again
+IDLE_POLL_INTERVAL = 0.05
+# Prefetched positions remembered for prefetch_hits_total
+MAX_REMEMBERED = 1000
+
+class _Speculation:
+    """One speculative search, which a real request or a newer position can stop at any time."""
+
+    def __init__(self):
+        self.stopped = False
+        self.reason: Optional[str] = None
+        self._analysis = None
+        self._lock = threading.Lock()
+
+    def start(self, analysis) -> bool:
+        with self._lock:
+            self._analysis = analysis
+            return not self.stopped
+
+    def stop(self, reason: str = "preempted"):
+        with self._lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            self.reason = reason
+            analysis = self._analysis
+        if analysis is not None:
+            analysis.stop()
+
+class Prefetcher:
+    """
+    Analyses the positions a user is likely to reach next while Stockfish engines
+    are idle, so that the next request is answered from the analysis cache.
+
+    schedule() replaces the pending work with the positions after each candidate
+    move of the latest answered position, then those after each line's expected
+    reply. One background thread searches them on engines borrowed with
+    EnginePool.checkout_preemptible, so any real request that has to wait for an
+    engine stops the speculative search and gets the engine straight away.
+    """
+
+    def __init__(self, pool: EnginePool, cache: AnalysisCache, max_positions: int = 8):
+        self.pool = pool
+        self.cache = cache
+        self.max_positions = max_positions
+        self._pending: List[chess.Board] = []
+        self._root: Optional[int] = None
+        self._depth = 0
+        self._multipv = 1
+        self._current: Optional[_Speculation] = None
+        self._prefetched: "OrderedDict[int, None]" = OrderedDict()
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def schedule(self, board: chess.Board, lines: List[Dict[str, Any]], depth: int, multipv: int = 1):
+        """Queue the likely successors of board, given the lines just found for it, in place of older work."""
+        children, replies = [], []
+        for line in lines:
+            pv = line.get("pv") or []
+            if len(pv) >= 1:
+                child = board.copy(stack=False)
+                child.push(pv[0])
+                children.append(child)
+                if len(pv) >= 2:
+                    reply = child.copy(stack=False)
+                    reply.push(pv[1])
+                    replies.append(reply)
+        targets, seen = [], set()
+        for target in children + replies:
+            key = chess.polyglot.zobrist_hash(target)
+            if key not in seen and not target.is_game_over():
+                seen.add(key)
+                targets.append(target)
+
+        root = chess.polyglot.zobrist_hash(board)
+        with self._condition:
+            if root == self._root:
+                # Several requests for the same position, e.g. an evaluation and best lines: cover both
+                depth, multipv = max(depth, self._depth), max(multipv, self._multipv)
+            elif self._current is not None:
+                self._current.stop("superseded")
+            self._root, self._depth, self._multipv = root, depth, multipv
+            self._pending = targets[:self.max_positions]
+            self._condition.notify()
+
+    def was_prefetched(self, board: chess.Board) -> bool:
+        """Record a cache hit; True, and counted once, if a speculative search put the entry there."""
+        key = chess.polyglot.zobrist_hash(board)
+        with self._condition:
+            if key not in self._prefetched:
+                return False
+            del self._prefetched[key]
+        PREFETCH_HITS.inc()
+        return True
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._pending = []
+            if self._current is not None:
+                self._current.stop("superseded")
+            self._condition.notify()
+
+    def _next(self) -> Optional[Tuple[chess.Board, int, int, _Speculation]]:
+        with self._condition:
+            while True:
+                if self._closed:
+                    return None
+                # Positions the cache already covers, for instance from a real request, need no search
+                while self._pending and self.cache.contains(self._pending[0], self._depth, self._multipv):
+                    self._pending.pop(0)
+                if self._pending:
+                    self._current = _Speculation()
+                    return self._pending[0], self._depth, self._multipv, self._current
+                self._condition.wait()
+
+    def _run(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            board, depth, multipv, speculation = task
+            try:
+                searched = self._search(board, depth, multipv, speculation)
+            except Exception as e:
+                logger.error(f"Speculative search failed: {str(e)}")
+                logger.error(traceback.format_exc())
+                searched = True
+            with self._condition:
+                self._current = None
+                if searched and self._pending and self._pending[0] is board:
+                    self._pending.pop(0)
+                if not searched and not self._closed:
+                    # No idle engine, or a real request took it; try again once the pool is free
+                    self._condition.wait(IDLE_POLL_INTERVAL)
+
+    def _search(self, board: chess.Board, depth: int, multipv: int, speculation: _Speculation) -> bool:
+        """Search board on an idle engine; False if there was none or the search was preempted."""
+        with self.pool.checkout_preemptible(speculation.stop) as engine:
+            if engine is None:
+                return False
+            # No time limit and no early stop: idle time is free, and the cache only serves full depths
+            progress = SearchProgress(board, SearchBudget(depth, 0.0, depth), multipv)
+            with engine.analysis(board, chess.engine.Limit(depth=depth), multipv=multipv) as analysis:
+                if speculation.start(analysis):
+                    for info in analysis:
+                        progress.update(info, analysis.multipv)
+        if progress.lines:
+            self.cache.put(board, progress.completed_depth, progress.lines)
+        if speculation.stopped:
+            PREFETCH_SEARCHES.labels(speculation.reason).inc()
+            return speculation.reason == "superseded"
+        PREFETCH_SEARCHES.labels("completed").inc()
+        with self._condition:
+            self._prefetched[chess.polyglot.zobrist_hash(board)] = None
+            while len(self._prefetched) > MAX_REMEMBERED:
+                self._prefetched.popitem(last=False)
+        logger.info(f"Prefetched FEN={board.fen()} to depth {progress.completed_depth}")
+        return True
@@ -0,0 +1,568 @@
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import chess
+import chess.engine
+
+from chess_engines import WDL_NODES, ChessEngine, LeelaEngine
+from metrics import REMOTE_WORKER_FAILURES
+
+logger = logging.getLogger(__name__)
+
+# Engine paths of the form tcp://host:port,host:port name engine workers instead of a binary
+REMOTE_SCHEME = "tcp://"
+# Frames are a 4-byte big-endian length followed by that many bytes of UTF-8 JSON
+_LENGTH = struct.Struct(">I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+CONNECT_TIMEOUT = 5.0
+# A timed search's reply may come this much later than its time limit before the worker is given up on
+REPLY_MARGIN = 10.0
+# Idle or untimed connections are probed after this many seconds of silence, so a worker that vanished is noticed
+KEEPALIVE_IDLE = 30
+# Shared secret every connection presents in its hello; workers not on localhost refuse connections without it
+WORKER_TOKEN = os.environ.get('ENGINE_WORKER_TOKEN')
+# How long a worker that could not be reached is skipped before it is tried again
+RETRY_INTERVAL = 5.0
+
+class WorkerUnavailableError(chess.engine.EngineTerminatedError):
+    """No engine worker of the requested type could be reached."""
+
+def send_frame(sock: socket.socket, message: Dict[str, Any]):
+    payload = json.dumps(message, separators=(",", ":")).encode("utf-8")
+    sock.sendall(_LENGTH.pack(len(payload)) + payload)
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise ConnectionError("Connection closed in the middle of a frame")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def recv_frame(sock: socket.socket) -> Optional[Dict[str, Any]]:
+    """The next message, or None if the peer closed the connection between frames."""
+    header = sock.recv(_LENGTH.size)
+    if not header:
+        return None
+    if len(header) < _LENGTH.size:
+        header += _recv_exactly(sock, _LENGTH.size - len(header))
+    (size,) = _LENGTH.unpack(header)
+    if size > MAX_FRAME_SIZE:
+        raise ConnectionError(f"Frame of {size} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return json.loads(_recv_exactly(sock, size).decode("utf-8"))
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.strip().rpartition(":")
+    if not host or not port.isdigit():
+        raise ValueError(f"Worker address must be host:port, got {address!r}")
+    return host, int(port)
+
+def is_remote(engine_path: str) -> bool:
+    return engine_path.startswith(REMOTE_SCHEME)
+
+def reply_timeout(request: Dict[str, Any]) -> Optional[float]:
+    """How long to wait for each reply to request: a timed search's time plus REPLY_MARGIN, otherwise until keepalive gives up."""
+    limit = request.get("limit")
+    if limit and limit.get("time") is not None:
+        return limit["time"] + REPLY_MARGIN
+    return None
+
+def set_keepalive(sock: socket.socket):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # The intervals are only tunable on some platforms; elsewhere the system defaults apply
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+    if hasattr(socket, "TCP_KEEPCNT"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+# python-chess objects travel as plain JSON: boards as the root FEN and the moves played
+# since, so the worker's engine sees the same game, and scores relative to the side to move
+
+def encode_board(board: chess.Board) -> Dict[str, Any]:
+    return {"fen": board.root().fen(), "moves": [move.uci() for move in board.move_stack]}
+
+def decode_board(data: Dict[str, Any]) -> chess.Board:
+    if not (isinstance(data, dict) and isinstance(data.get("fen"), str) and isinstance(data.get("moves"), list)
+            and all(isinstance(uci, str) for uci in data["moves"])):
+        raise ValueError("A board must be a FEN and a list of UCI moves")
+    board = chess.Board(data["fen"])
+    for uci in data["moves"]:
+        board.push_uci(uci)
+    return board
+
+def encode_limit(limit: Optional[chess.engine.Limit]) -> Optional[Dict[str, Any]]:
+    if limit is None:
+        return None
+    return {name: getattr(limit, name) for name in ("depth", "nodes", "time", "mate") if getattr(limit, name) is not None}
+
+def decode_limit(data: Optional[Dict[str, Any]]) -> Optional[chess.engine.Limit]:
+    return None if data is None else chess.engine.Limit(**data)
+
+def encode_info(info: Dict[str, Any]) -> Dict[str, Any]:
+    encoded = {}
+    for key, value in info.items():
+        if key == "score":
+            encoded[key] = {"turn": value.turn, "mate": value.relative.mate()} if value.is_mate() \
+                else {"turn": value.turn, "cp": value.relative.score()}
+        elif key == "wdl":
+            encoded[key] = {"turn": value.turn, "wdl": list(value.relative)}
+        elif key == "pv":
+            encoded[key] = [move.uci() for move in value]
+        elif key == "currmove":
+            encoded[key] = value.uci()
+        elif isinstance(value, (bool, int, float, str)):
+            encoded[key] = value
+        # refutation and currline maps are not used by the server and are not sent
+    return encoded
+
+def decode_info(data: Dict[str, Any]) -> Dict[str, Any]:
+    info = dict(data)
+    if "score" in data:
+        score = data["score"]
+        if "mate" in score:
+            relative = chess.engine.MateGiven if score["mate"] == 0 else chess.engine.Mate(score["mate"])
+        else:
+            relative = chess.engine.Cp(score["cp"])
+        info["score"] = chess.engine.PovScore(relative, score["turn"])
+    if "wdl" in data:
+        info["wdl"] = chess.engine.PovWdl(chess.engine.Wdl(*data["wdl"]["wdl"]), data["wdl"]["turn"])
+    if "pv" in data:
+        info["pv"] = [chess.Move.from_uci(uci) for uci in data["pv"]]
+    if "currmove" in data:
+        info["currmove"] = chess.Move.from_uci(data["currmove"])
+    return info
+
+class RemoteWorker:
+    """One engine-worker daemon: its capacity, the requests in flight on it, and idle connections to reuse."""
+
+    def __init__(self, address: Tuple[str, int]):
+        self.address = address
+        self.engine_type: Optional[str] = None
+        self.capacity = 1
+        self.in_flight = 0
+        self.down_until = 0.0
+        self._idle: List[socket.socket] = []
+        self._lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return f"{self.address[0]}:{self.address[1]}"
+
+    def connect(self) -> Tuple[socket.socket, Dict[str, Any]]:
+        """
+        A new connection that has presented WORKER_TOKEN, and the worker's hello reply.
+        Raises OSError if the worker cannot be reached or refuses the connection, and
+        ValueError if its reply is not a handshake.
+        """
+        sock = socket.create_connection(self.address, timeout=CONNECT_TIMEOUT)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            set_keepalive(sock)
+            send_frame(sock, {"op": "hello", "token": WORKER_TOKEN})
+            reply = recv_frame(sock)
+            if reply is None:
+                raise ConnectionError(f"Worker {self.name} closed the connection during the handshake")
+            if "error" in reply:
+                raise ConnectionRefusedError(f"Worker {self.name} refused the connection: {reply['error']}")
+            try:
+                engine_type, capacity = reply["engine"], max(int(reply["capacity"]), 1)
+            except (KeyError, TypeError, ValueError):
+                raise ValueError(f"Worker {self.name} sent an invalid handshake: {reply!r}") from None
+        except Exception:
+            sock.close()
+            raise
+        self.engine_type = engine_type
+        self.capacity = capacity
+        # Each request sets its own timeout from its search limit
+        sock.settimeout(None)
+        return sock, reply
+
+    def hello(self) -> Dict[str, Any]:
+        """Ask the worker what it runs; also how a worker that was down is brought back."""
+        sock, reply = self.connect()
+        self.down_until = 0.0
+        self.release(sock)
+        return reply
+
+    def take(self) -> Tuple[socket.socket, bool]:
+        """A connection, and whether it was reused from the pool rather than opened now."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self.connect()[0], False
+
+    def release(self, sock: socket.socket):
+        with self._lock:
+            # Keep enough idle connections for every engine on the worker, plus one per engine waiting for it
+            if len(self._idle) < self.capacity * 2:
+                self._idle.append(sock)
+                return
+        sock.close()
+
+    def mark_down(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sock in idle:
+            sock.close()
+        self.down_until = time.monotonic() + RETRY_INTERVAL
+
+    def status(self) -> Dict[str, Any]:
+        return {"address": self.name, "engine": self.engine_type, "capacity": self.capacity,
+                "in_flight": self.in_flight, "up": self.down_until <= time.monotonic()}
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for sock in idle:
+            sock.close()
+
+class WorkerCluster:
+    """
+    The engine workers of one engine type. Each request goes to the reachable worker
+    with the lowest load for its capacity; a worker that cannot be reached is
+    skipped for RETRY_INTERVAL seconds and the request moves on to the next one.
+    """
+
+    def __init__(self, engine_type: str):
+        self.engine_type = engine_type
+        self._workers: Dict[Tuple[str, int], RemoteWorker] = {}
+        self._lock = threading.Lock()
+
+    def add(self, address: Tuple[str, int]) -> RemoteWorker:
+        """Add a worker, or return the known one. Unreachable workers are kept and retried later."""
+        with self._lock:
+            worker = self._workers.get(address)
+            if worker is None:
+                worker = self._workers[address] = RemoteWorker(address)
+        try:
+            worker.hello()
+        except (OSError, ValueError) as e:
+            logger.warning(f"{self.engine_type} worker {worker.name} is unreachable: {str(e)}")
+            worker.mark_down()
+        else:
+            logger.info(f"Registered {self.engine_type} worker {worker.name} with capacity {worker.capacity}")
+        return worker
+
+    def workers(self) -> List[RemoteWorker]:
+        with self._lock:
+            return list(self._workers.values())
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [worker.status() for worker in self.workers()]
+
+    def capacity(self) -> int:
+        """Engines across the registered workers, counting those that are down for now."""
+        return sum(worker.capacity for worker in self.workers())
+
+    def _pick(self, tried: set) -> Optional[RemoteWorker]:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [worker for worker in self._workers.values()
+                          if worker.address not in tried and worker.down_until <= now]
+            if not candidates:
+                return None
+            worker = min(candidates, key=lambda candidate: candidate.in_flight / candidate.capacity)
+            worker.in_flight += 1
+            return worker
+
+    def _done(self, worker: RemoteWorker):
+        with self._lock:
+            worker.in_flight -= 1
+
+    def open(self, request: Dict[str, Any]) -> Tuple[RemoteWorker, socket.socket, Dict[str, Any]]:
+        """
+        Send request to a worker and return it with the connection and the first reply,
+        failing over to the next worker while nothing has been received yet. Every
+        successful open() must be followed by finish().
+        """
+        tried = set()
+        while True:
+            worker = self._pick(tried)
+            if worker is None:
+                raise WorkerUnavailableError(f"No {self.engine_type} engine worker is reachable")
+            tried.add(worker.address)
+            try:
+                sock, reply = self._exchange(worker, request)
+            except (OSError, ValueError) as e:
+                self._done(worker)
+                REMOTE_WORKER_FAILURES.labels(self.engine_type).inc()
+                logger.warning(f"{self.engine_type} worker {worker.name} failed, trying another: {str(e)}")
+                worker.mark_down()
+                continue
+            return worker, sock, reply
+
+    def finish(self, worker: RemoteWorker, sock: socket.socket, healthy: bool = True):
+        """Hand the connection back to its worker's pool, or close it if the exchange did not complete."""
+        self._done(worker)
+        if healthy:
+            worker.release(sock)
+        else:
+            sock.close()
+
+    def _exchange(self, worker: RemoteWorker, request: Dict[str, Any]) -> Tuple[socket.socket, Dict[str, Any]]:
+        if worker.engine_type is None:
+            # Added while it was down; the handshake also checks what it runs
+            worker.hello()
+        if worker.engine_type != self.engine_type:
+            raise ConnectionError(f"Worker {worker.name} runs {worker.engine_type}, not {self.engine_type}")
+        sock, reused = worker.take()
+        timeout = reply_timeout(request)
+        try:
+            sock.settimeout(timeout)
+            send_frame(sock, request)
+            reply = recv_frame(sock)
+            if reply is None:
+                raise ConnectionError(f"Worker {worker.name} closed the connection")
+        except ValueError:
+            sock.close()
+            raise
+        except OSError as e:
+            sock.close()
+            # A worker that did not answer in time would not answer on another connection either
+            if not reused or isinstance(e, TimeoutError):
+                raise
+            # A pooled connection may have been closed by a worker restart; try once on a fresh one
+            sock, _ = worker.connect()
+            try:
+                sock.settimeout(timeout)
+                send_frame(sock, request)
+                reply = recv_frame(sock)
+                if reply is None:
+                    raise ConnectionError(f"Worker {worker.name} closed the connection")
+            except Exception:
+                sock.close()
+                raise
+        return sock, reply
+
+    def call(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """One request and its reply; raises chess.engine.EngineError if the worker's engine failed."""
+        worker, sock, reply = self.open(request)
+        self.finish(worker, sock)
+        if "error" in reply:
+            raise chess.engine.EngineError(f"Worker {worker.name}: {reply['error']}")
+        return reply
+
+    def ping(self):
+        """Raise unless at least one worker answers."""
+        for worker in self.workers():
+            if worker.down_until > time.monotonic():
+                continue
+            try:
+                worker.hello()
+                return
+            except (OSError, ValueError) as e:
+                logger.warning(f"{self.engine_type} worker {worker.name} failed health check: {str(e)}")
+                worker.mark_down()
+        raise WorkerUnavailableError(f"No {self.engine_type} engine worker is reachable")
+
+    def close(self):
+        for worker in self.workers():
+            worker.close()
+
+_clusters: Dict[str, WorkerCluster] = {}
+_clusters_lock = threading.Lock()
+
+def cluster_for(engine_type: str) -> WorkerCluster:
+    """The process-wide cluster of one engine type, shared by every engine in its pools."""
+    with _clusters_lock:
+        cluster = _clusters.get(engine_type)
+        if cluster is None:
+            cluster = _clusters[engine_type] = WorkerCluster(engine_type)
+        return cluster
+
+def probe_worker(address: str) -> Dict[str, Any]:
+    """
+    Ask the worker at host:port what it runs, without adding it anywhere. Raises OSError
+    if it cannot be reached or refuses WORKER_TOKEN, and ValueError if it does not answer like a worker.
+    """
+    worker = RemoteWorker(parse_address(address))
+    try:
+        return worker.hello()
+    finally:
+        worker.close()
+
+def listed_hosts(engine_path: str) -> List[str]:
+    """The hosts of the workers in a tcp://host:port,host:port engine path."""
+    if not is_remote(engine_path):
+        return []
+    return [parse_address(address)[0] for address in engine_path[len(REMOTE_SCHEME):].split(",") if address.strip()]
+
+def host_addresses(host: str) -> Set[str]:
+    """host and every address it resolves to; a name that does not resolve stands only for itself."""
+    addresses = {host}
+    try:
+        addresses.update(info[4][0] for info in socket.getaddrinfo(host, None))
+    except OSError:
+        pass
+    return addresses
+
+def is_allowed_host(host: str, allowed: Iterable[str]) -> bool:
+    """Whether host, by name or by any address, is one of the allowed hosts."""
+    allowed_addresses = set()
+    for allowed_host in allowed:
+        allowed_addresses |= host_addresses(allowed_host)
+    return bool(host_addresses(host) & allowed_addresses)
+
+class RemoteAnalysis:
+    """
+    The ChessEngine.analysis handle of a remote search: iterate it for info dicts,
+    read multipv for the latest line of each rank, and stop() it from any thread.
+    Leaving the with-block stops the search and waits for the worker to finish it.
+    """
+
+    def __init__(self, cluster: WorkerCluster, request: Dict[str, Any]):
+        self.cluster = cluster
+        self.worker, self._sock, reply = cluster.open(request)
+        if reply.get("event") != "started":
+            cluster.finish(self.worker, self._sock)
+            raise chess.engine.EngineError(f"Worker {self.worker.name}: {reply.get('error', 'analysis did not start')}")
+        self.multipv: List[Dict[str, Any]] = []
+        self.best: Optional[chess.engine.BestMove] = None
+        self._stop_sent = False
+        self._finished = False
+        self._broken = False
+        self._closed = False
+        self._write_lock = threading.Lock()
+
+    @property
+    def info(self) -> Dict[str, Any]:
+        return self.multipv[0] if self.multipv else {}
+
+    def stop(self):
+        # Every analysis ends with exactly one stop frame, so the worker knows when the connection is free again
+        with self._write_lock:
+            if self._stop_sent or self._closed:
+                return
+            self._stop_sent = True
+            try:
+                send_frame(self._sock, {"op": "stop"})
+            except OSError as e:
+                logger.warning(f"Could not stop search on worker {self.worker.name}: {str(e)}")
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Dict[str, Any]:
+        while not self._finished:
+            try:
+                frame = recv_frame(self._sock)
+            except OSError as e:
+                frame = None
+                error = e
+            else:
+                error = None
+            if frame is None:
+                self._finished = True
+                self._broken = True
+                raise chess.engine.EngineTerminatedError(f"Worker {self.worker.name} went away during a search") from error
+            event = frame.get("event")
+            if event == "info":
+                info = decode_info(frame["info"])
+                rank = info.get("multipv", 1)
+                while len(self.multipv) < rank:
+                    self.multipv.append({})
+                self.multipv[rank - 1].update(info)
+                return info
+            if event == "bestmove":
+                move = frame.get("move")
+                ponder = frame.get("ponder")
+                self.best = chess.engine.BestMove(chess.Move.from_uci(move) if move else None,
+                                                  chess.Move.from_uci(ponder) if ponder else None)
+                self.stop()
+            elif event == "done":
+                self._finished = True
+            elif event == "error":
+                self._finished = True
+                raise chess.engine.EngineError(f"Worker {self.worker.name}: {frame['error']}")
+        raise StopIteration
+
+    def wait(self) -> Optional[chess.engine.BestMove]:
+        for _ in self:
+            pass
+        return self.best
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(exc_type is None)
+
+    def close(self, healthy: bool = True):
+        if self._closed:
+            return
+        try:
+            if not self._finished:
+                self.stop()
+                self.wait()
+        except Exception:
+            healthy = False
+            raise
+        finally:
+            with self._write_lock:
+                self._closed = True
+            # After an error the connection may be in the middle of a search, so it is not reused
+            self.cluster.finish(self.worker, self._sock, healthy and not self._broken)
+
+class RemoteChessEngine(ChessEngine):
+    """A ChessEngine whose searches run on engine workers; see engine_worker.py."""
+
+    # A background search would hold a worker engine and connection for as long as the session lives
+    can_ponder = False
+
+    def __init__(self, cluster: WorkerCluster):
+        self.cluster = cluster
+
+    def _request(self, op: str, board: chess.Board, limit: Optional[chess.engine.Limit], game: object, **fields) -> Dict[str, Any]:
+        request = {"op": op, "board": encode_board(board), "limit": encode_limit(limit), **fields}
+        if game is not None:
+            request["game"] = str(game)
+        return request
+
+    def analyse(self, board: chess.Board, limit: chess.engine.Limit, game: object = None):
+        return decode_info(self.cluster.call(self._request("analyse", board, limit, game))["info"])
+
+    def analyse_with_multipv(self, board: chess.Board, limit: chess.engine.Limit, multipv: int, game: object = None):
+        reply = self.cluster.call(self._request("analyse", board, limit, game, multipv=multipv))
+        return [decode_info(info) for info in reply["infos"]]
+
+    def analysis(self, board: chess.Board, limit: Optional[chess.engine.Limit] = None, multipv: Optional[int] = None,
+                 game: object = None):
+        return RemoteAnalysis(self.cluster, self._request("analysis", board, limit, game, multipv=multipv))
+
+    def ping(self):
+        self.cluster.ping()
+
+    def quit(self):
+        # The workers and their connections are shared by every engine of the cluster
+        pass
+
+class RemoteLeelaEngine(RemoteChessEngine, LeelaEngine):
+    def analyse_wdls(self, boards: Sequence[chess.Board], nodes: int = WDL_NODES, refine_nodes: int = 0) -> List[Dict[str, Any]]:
+        """The whole batch in one request, searched back to back on one worker engine."""
+        reply = self.cluster.call({"op": "analyse_wdls", "boards": [encode_board(board) for board in boards],
+                                   "nodes": nodes, "refine_nodes": refine_nodes})
+        return [decode_info(info) for info in reply["infos"]]
+
+def create_remote_engine(engine_type: str, engine_path: str) -> ChessEngine:
+    """An engine backed by the workers listed in engine_path, tcp://host:port,host:port (possibly none yet)."""
+    cluster = cluster_for(engine_type)
+    known = {worker.address for worker in cluster.workers()}
+    for address in engine_path[len(REMOTE_SCHEME):].split(","):
+        if address.strip() and parse_address(address) not in known:
+            cluster.add(parse_address(address))
+    if engine_type == "stockfish":
+        return RemoteChessEngine(cluster)
+    elif engine_type == "leela":
+        return RemoteLeelaEngine(cluster)
+    else:
+        raise ValueError(f"Unsupported engine type: {engine_type}")
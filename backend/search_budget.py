@@ -0,0 +1,154 @@
+import logging
+import time
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import chess
+import chess.engine
+
+from async_engines import AsyncChessEngine
+from cancellation import CancelToken
+from chess_engines import ChessEngine
+
+logger = logging.getLogger(__name__)
+
+# Never plan less than this much search time, however loaded the server is
+MIN_SEARCH_TIME = 0.05
+# Depth below which a search is never cut short for being stable
+MIN_STABLE_DEPTH = 10
+# Consecutive depths with the same best move and a score within STABLE_SCORE_MARGIN
+STABLE_ITERATIONS = 4
+STABLE_SCORE_MARGIN = 15
+
+class SearchBudget:
+    def __init__(self, max_depth: int, time_limit: float, min_depth: int,
+                 stable_iterations: int = STABLE_ITERATIONS, stable_margin: int = STABLE_SCORE_MARGIN):
+        self.max_depth = max_depth
+        self.time_limit = time_limit
+        self.min_depth = min_depth
+        self.stable_iterations = stable_iterations
+        self.stable_margin = stable_margin
+
+    def limit(self) -> chess.engine.Limit:
+        return chess.engine.Limit(depth=self.max_depth, time=self.time_limit)
+
+    def __repr__(self) -> str:
+        return f"SearchBudget(max_depth={self.max_depth}, time_limit={self.time_limit:.2f}, min_depth={self.min_depth})"
+
+def load_factor(queue_depth: int, workers: int) -> float:
+    """How many requests each worker has to get through, including the current one."""
+    return 1 + queue_depth / max(workers, 1)
+
+def plan_search(board: chess.Board, depth: int, latency_target: float, queue_depth: int, workers: int) -> SearchBudget:
+    """
+    Pick depth and time limits for one Stockfish search. The latency target is
+    shared with the requests queued behind this one, and positions with only a
+    handful of sensible moves get less time.
+    """
+    time_limit = max(latency_target / load_factor(queue_depth, workers), MIN_SEARCH_TIME)
+    legal_moves = board.legal_moves.count()
+    if legal_moves <= 1:
+        # A forced move: a shallow search is enough to report the score
+        return SearchBudget(min(depth, 8), MIN_SEARCH_TIME, min(depth, 8))
+    if board.is_check() or legal_moves <= 5:
+        time_limit = max(time_limit / 2, MIN_SEARCH_TIME)
+    return SearchBudget(depth, time_limit, min(depth, MIN_STABLE_DEPTH))
+
+def leela_limit(base_time: float, queue_depth: int, workers: int) -> chess.engine.Limit:
+    """Shrink the Leela search time as the queue grows, down to MIN_SEARCH_TIME."""
+    return chess.engine.Limit(time=max(base_time / load_factor(queue_depth, workers), MIN_SEARCH_TIME))
+
+def _score(info: Dict[str, Any]) -> int:
+    return info["score"].relative.score(mate_score=100000)
+
+class SearchProgress:
+    """The deepest completed multipv lines of a running search, and whether it has become stable."""
+
+    def __init__(self, board: chess.Board, budget: SearchBudget, multipv: int):
+        self.budget = budget
+        self.started = time.monotonic()
+        self.line_count = min(multipv, board.legal_moves.count())
+        self.completed_depth = 0
+        self.lines: List[Dict[str, Any]] = []
+        # Stopped early because more depth would not change the answer
+        self.stable = False
+        self._stable = 0
+        self._previous: Optional[Tuple[chess.Move, int]] = None
+
+    def update(self, info: Dict[str, Any], multipv: List[Dict[str, Any]]) -> bool:
+        """Record one info dict from the engine; True once the search can be stopped."""
+        depth = info.get("depth", 0)
+        if "pv" not in info or "score" not in info or info.get("multipv", 1) != self.line_count or depth <= self.completed_depth:
+            return False
+        self.completed_depth = depth
+        self.lines = [dict(line) for line in multipv]
+        current = (self.lines[0]["pv"][0], _score(self.lines[0]))
+        if self._previous is not None and current[0] == self._previous[0] and abs(current[1] - self._previous[1]) <= self.budget.stable_margin:
+            self._stable += 1
+        else:
+            self._stable = 0
+        self._previous = current
+        if self.budget.min_depth <= depth < self.budget.max_depth and self._stable >= self.budget.stable_iterations:
+            logger.info(f"Stopping stable search at depth {depth} after {time.monotonic() - self.started:.2f}s")
+            self.stable = True
+            return True
+        return False
+
+    def satisfied_depth(self) -> int:
+        """
+        The depth the lines answer requests for: the budget's full depth when the
+        search stopped for stability, so the in-memory cache serves repeats of the
+        same request. Only the completed depth is ever persisted.
+        """
+        return self.budget.max_depth if self.stable else self.completed_depth
+
+    def result(self, multipv: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int, int]:
+        """The lines, the depth they were searched to, and the depth they satisfy."""
+        if not self.lines:
+            # The limit ran out before a single depth completed; take whatever the engine reported
+            self.lines = [dict(line) for line in multipv if "score" in line]
+            self.completed_depth = max((line.get("depth", 0) for line in self.lines), default=0)
+        return self.lines, self.completed_depth, self.satisfied_depth()
+
+# Called with the lines of each depth a search completes, and that depth
+DepthCallback = Callable[[List[Dict[str, Any]], int], None]
+
+def run_budgeted(engine: ChessEngine, board: chess.Board, budget: SearchBudget,
+                 multipv: int = 1, game: object = None, cancel: Optional[CancelToken] = None,
+                 on_depth: Optional[DepthCallback] = None) -> Tuple[List[Dict[str, Any]], int, int]:
+    """
+    Search until the budget runs out or the best move and score have been
+    stable for budget.stable_iterations depths. Returns the multipv lines, the
+    deepest fully completed depth, and the depth the lines satisfy: budget.max_depth
+    if the search stopped for stability. Cancelling stops the search early.
+    """
+    progress = SearchProgress(board, budget, multipv)
+    with engine.analysis(board, budget.limit(), multipv=multipv, game=game) as analysis:
+        with cancel.stopping(analysis.stop) if cancel is not None else nullcontext():
+            for info in analysis:
+                depth = progress.completed_depth
+                stop = progress.update(info, analysis.multipv)
+                if on_depth is not None and progress.completed_depth > depth:
+                    on_depth(progress.lines, progress.completed_depth)
+                if stop:
+                    break
+            if not progress.lines:
+                analysis.wait()
+        return progress.result(analysis.multipv)
+
+async def run_budgeted_async(engine: AsyncChessEngine, board: chess.Board, budget: SearchBudget,
+                             multipv: int = 1, game: object = None,
+                             on_depth: Optional[DepthCallback] = None) -> Tuple[List[Dict[str, Any]], int, int]:
+    """run_budgeted for an AsyncChessEngine."""
+    progress = SearchProgress(board, budget, multipv)
+    with await engine.analysis(board, budget.limit(), multipv=multipv, game=game) as analysis:
+        async for info in analysis:
+            depth = progress.completed_depth
+            stop = progress.update(info, analysis.multipv)
+            if on_depth is not None and progress.completed_depth > depth:
+                on_depth(progress.lines, progress.completed_depth)
+            if stop:
+                break
+        if not progress.lines:
+            await analysis.wait()
+        return progress.result(analysis.multipv)
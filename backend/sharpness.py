@@ -0,0 +1,129 @@
+import logging
+import os
+from typing import Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+def sharpnessLC0(wdl: list) -> float:
+    W = min(max(wdl[0]/1000, 0.0001), 0.9999)
+    L = min(max(wdl[2]/1000, 0.0001), 0.9999)
+    return (max(2/(np.log((1/W)-1) + np.log((1/L)-1)), 0))**2 * min(W, L) * 4
+
+def sharpness_lc0_batch(wdls) -> np.ndarray:
+    """
+    Vectorized sharpnessLC0 over an (N, 3) array of WDL triples.
+
+    Performs the same float64 operations in the same order as the scalar
+    function, so the results are bit-identical to calling it on every row.
+    """
+    wdls = np.asarray(wdls, dtype=np.float64).reshape(-1, 3)
+    W = np.minimum(np.maximum(wdls[:, 0]/1000, 0.0001), 0.9999)
+    L = np.minimum(np.maximum(wdls[:, 2]/1000, 0.0001), 0.9999)
+    # W == L == 0.5 divides by zero exactly like the scalar version and yields inf
+    with np.errstate(divide='ignore'):
+        # float_power goes through libm pow like the scalar **2; the array ** 2 fast path
+        # squares by multiplication, which differs in the last bit for some inputs
+        return np.float_power(np.maximum(2/(np.log((1/W)-1) + np.log((1/L)-1)), 0), 2) * np.minimum(W, L) * 4
+
+# Leela's UCI_ShowWDL output is integer permille, so every (W, L) it reports lies on this grid
+WDL_SCALE = 1000
+# Start of row W in the flat table; row W holds L = 0 .. WDL_SCALE - W
+_ROW_STARTS = np.concatenate(([0], np.cumsum(np.arange(WDL_SCALE + 1, 0, -1))))
+TABLE_SIZE = int(_ROW_STARTS[-1])
+# Sharpness is singular along D = 0 and kinked where W or L hit the clamp, so fractional WDLs
+# within this many permille of an edge are computed exactly; elsewhere the interpolation error is below 1%
+INTERPOLATION_MARGIN = 20
+
+def _grid():
+    """W and L of every table entry, in table order."""
+    w = np.repeat(np.arange(WDL_SCALE + 1), np.arange(WDL_SCALE + 1, 0, -1))
+    return w, np.arange(TABLE_SIZE) - _ROW_STARTS[w]
+
+class SharpnessTable:
+    """
+    sharpnessLC0 precomputed for every integer (W, L) with W + L <= 1000, stored
+    as a flat float64 triangle (4 MB).
+
+    Integer WDLs are a plain gather and match the scalar function bit for bit.
+    Fractional WDLs are interpolated bilinearly between the surrounding grid
+    points. Anything else, including WDLs near the edges of the triangle,
+    goes to sharpness_lc0_batch.
+    """
+
+    def __init__(self, values: np.ndarray):
+        if values.shape != (TABLE_SIZE,) or values.dtype != np.float64:
+            raise ValueError(f"Sharpness table must hold {TABLE_SIZE} float64 values, got {values.shape} {values.dtype}")
+        self.values = values
+        # Plain ints index faster than NumPy scalars in the single-WDL path
+        self._row_starts = [int(start) for start in _ROW_STARTS]
+
+    @classmethod
+    def build(cls) -> "SharpnessTable":
+        w, l = _grid()
+        with np.errstate(divide='ignore'):
+            return cls(sharpness_lc0_batch(np.stack([w, WDL_SCALE - w - l, l], axis=1)))
+
+    @classmethod
+    def load(cls, path: str) -> "SharpnessTable":
+        # Memory-mapped, so processes loading the same file share its pages
+        return cls(np.load(path, mmap_mode='r', allow_pickle=False))
+
+    def save(self, path: str):
+        # Written under another name first so a concurrent load never sees a partial file
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as f:
+            np.save(f, np.asarray(self.values))
+        os.replace(temporary, path)
+
+    @classmethod
+    def load_or_build(cls, path: Optional[str] = None) -> "SharpnessTable":
+        """Load the table from path, or build it and save it there if the file is missing or unusable."""
+        if path and os.path.exists(path):
+            try:
+                return cls.load(path)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Rebuilding sharpness table, could not load {path}: {str(e)}")
+        table = cls.build()
+        if path:
+            table.save(path)
+        return table
+
+    def sharpness(self, wdl) -> float:
+        """sharpnessLC0 for one WDL triple."""
+        w, l = float(wdl[0]), float(wdl[2])
+        if w.is_integer() and l.is_integer() and w >= 0 and l >= 0 and w + l <= WDL_SCALE:
+            return self.values[self._row_starts[int(w)] + int(l)]
+        return self.lookup([wdl])[0]
+
+    def lookup(self, wdls) -> np.ndarray:
+        """sharpnessLC0 over an (N, 3) array of WDL triples."""
+        wdls = np.asarray(wdls, dtype=np.float64).reshape(-1, 3)
+        w, l = wdls[:, 0], wdls[:, 2]
+        w0, l0 = np.floor(w), np.floor(l)
+        result = np.empty(len(wdls))
+
+        on_grid = (w == w0) & (l == l0) & (w >= 0) & (l >= 0) & (w + l <= WDL_SCALE)
+        result[on_grid] = self.values[_ROW_STARTS[w[on_grid].astype(np.intp)] + l[on_grid].astype(np.intp)]
+
+        # NaN compares false everywhere, so it ends up in neither mask and is computed exactly
+        interior = (~on_grid & (w0 >= INTERPOLATION_MARGIN) & (l0 >= INTERPOLATION_MARGIN)
+                    & (WDL_SCALE - w0 - l0 - 2 >= INTERPOLATION_MARGIN))
+        if interior.any():
+            result[interior] = self._interpolate(w[interior], l[interior])
+
+        exact = ~on_grid & ~interior
+        if exact.any():
+            with np.errstate(divide='ignore'):
+                result[exact] = sharpness_lc0_batch(wdls[exact])
+        return result
+
+    def _interpolate(self, w: np.ndarray, l: np.ndarray) -> np.ndarray:
+        w0, l0 = np.floor(w), np.floor(l)
+        fw, fl = w - w0, l - l0
+        row = _ROW_STARTS[w0.astype(np.intp)] + l0.astype(np.intp)
+        next_row = _ROW_STARTS[w0.astype(np.intp) + 1] + l0.astype(np.intp)
+        values = self.values
+        return ((1 - fw) * ((1 - fl) * values[row] + fl * values[row + 1])
+                + fw * ((1 - fl) * values[next_row] + fl * values[next_row + 1]))
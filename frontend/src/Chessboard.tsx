@@ -1,12 +1,13 @@
 import React, { useState, useRef, useEffect } from 'react';
 import { Chess } from 'chess.js';
 import { Chessboard as ReactChessboard } from 'react-chessboard';
-import axios from 'axios';
 
 interface BestLine {
   moves: string;
-  score: number;
-  sharpness: number;
+  score: number | null;
+  sharpness: number | null;
+  source?: 'book' | 'tablebase';
+  weight?: number;
 }
 
 const ChessGame: React.FC = () => {
@@ -20,6 +21,8 @@ const ChessGame: React.FC = () => {
   const [bestLines, setBestLines] = useState<BestLine[]>([]);
   const [isLoadingBestLines, setIsLoadingBestLines] = useState(false);
   const boardContainerRef = useRef<HTMLDivElement>(null);
+  // Identifies this board to the server, so a newer request cancels its stale ones
+  const clientId = useRef(Math.random().toString(36).slice(2));
 
   useEffect(() => {
     const updateDimensions = () => {
@@ -34,157 +37,77 @@ const ChessGame: React.FC = () => {
     return () => window.removeEventListener('resize', updateDimensions);
   }, []);
 
-  const evaluatePosition = async () => {
-    setIsEvaluating(true);
-    setEvaluation(null);
-    try {
-      const response = await axios.post('http://localhost:5000/evaluate', {
-        fen: game.fen(),
-        depth: 10
-      }, {
-        headers: {
-          'Content-Type': 'application/json'
-        }
-      });
-      if (response.status === 202) {
-        // Start polling for results
-        pollForEvaluation();
-      } else {
-        console.error('Unexpected response:', response);
-        setIsEvaluating(false);
-      }
-    } catch (error) {
-      console.error('Error evaluating position:', error);
-      if (axios.isAxiosError(error)) {
-        console.error('Axios error details:', error.response?.data);
-      }
-      setIsEvaluating(false);
-    }
-  };
+  const analysisStream = useRef<EventSource | null>(null);
 
-  const pollForEvaluation = async () => {
-    const pollInterval = setInterval(async () => {
-      try {
-        const response = await axios.get('http://localhost:5000/evaluation-result');
-        if (response.data.status === 'completed') {
-          setEvaluation(response.data.evaluation);
-          setIsEvaluating(false);
-          clearInterval(pollInterval);
-        }
-      } catch (error) {
-        console.error('Error polling for evaluation:', error);
-        setIsEvaluating(false);
-        clearInterval(pollInterval);
-      }
-    }, 1000); // Poll every second
-
-    // Stop polling after 30 seconds if no result
-    setTimeout(() => {
-      clearInterval(pollInterval);
-      setIsEvaluating(false);
-    }, 30000);
-  };
+  useEffect(() => () => analysisStream.current?.close(), []);
 
-  const calculateSharpness = async () => {
+  const streamAnalysis = (fen: string) => {
+    // A newer position replaces the running stream; the server stops its search
+    analysisStream.current?.close();
+    setIsEvaluating(true);
+    setEvaluation(null);
     setIsCalculatingSharpness(true);
     setSharpness(null);
-    try {
-      const response = await axios.post('http://localhost:5000/sharpness', {
-        fen: game.fen()
-      }, {
-        headers: {
-          'Content-Type': 'application/json'
-        }
-      });
-      if (response.status === 202) {
-        // Start polling for results
-        pollForSharpness();
-      } else {
-        console.error('Unexpected response:', response);
-        setIsCalculatingSharpness(false);
-      }
-    } catch (error) {
-      console.error('Error calculating sharpness:', error);
-      if (axios.isAxiosError(error)) {
-        console.error('Axios error details:', error.response?.data);
-      }
-      setIsCalculatingSharpness(false);
-    }
-  };
-
-  const pollForSharpness = async () => {
-    const pollInterval = setInterval(async () => {
-      try {
-        const response = await axios.get('http://localhost:5000/sharpness-result');
-        if (response.data.status === 'completed') {
-          setSharpness(response.data.sharpness);
-          setIsCalculatingSharpness(false);
-          clearInterval(pollInterval);
-        }
-      } catch (error) {
-        console.error('Error polling for sharpness:', error);
-        setIsCalculatingSharpness(false);
-        clearInterval(pollInterval);
-      }
-    }, 1000); // Poll every second
-
-    // Stop polling after 30 seconds if no result
-    setTimeout(() => {
-      clearInterval(pollInterval);
-      setIsCalculatingSharpness(false);
-    }, 30000);
-  };
-
-  const getBestLines = async () => {
     setIsLoadingBestLines(true);
     setBestLines([]);
-    try {
-      const response = await axios.post('http://localhost:5000/best-lines', {
-        current_fen: game.fen(),
-        number_of_lines: 3,
-        depth: 20
-      }, {
-        headers: {
-          'Content-Type': 'application/json'
-        }
-      });
-      if (response.status === 202) {
-        // Start polling for results
-        pollForBestLines();
-      } else {
-        console.error('Unexpected response:', response);
-        setIsLoadingBestLines(false);
-      }
-    } catch (error) {
-      console.error('Error getting best lines:', error);
-      if (axios.isAxiosError(error)) {
-        console.error('Axios error details:', error.response?.data);
-      }
-      setIsLoadingBestLines(false);
-    }
-  };
 
-  const pollForBestLines = async () => {
-    const pollInterval = setInterval(async () => {
-      try {
-        const response = await axios.get('http://localhost:5000/best-lines-result');
-        if (response.data.status === 'completed') {
-          setBestLines(response.data.best_lines);
-          setIsLoadingBestLines(false);
-          clearInterval(pollInterval);
-        }
-      } catch (error) {
-        console.error('Error polling for best lines:', error);
+    const params = new URLSearchParams({
+      fen,
+      depth: '20',
+      multipv: '3',
+      sharpness: 'true',
+      client_id: clientId.current
+    });
+    const source = new EventSource(`http://localhost:5000/analysis-stream?${params}`);
+    analysisStream.current = source;
+
+    const finish = () => {
+      source.close();
+      if (analysisStream.current === source) {
+        analysisStream.current = null;
+        setIsEvaluating(false);
+        setIsCalculatingSharpness(false);
         setIsLoadingBestLines(false);
-        clearInterval(pollInterval);
       }
-    }, 1000); // Poll every second
+    };
 
-    // Stop polling after 30 seconds if no result
-    setTimeout(() => {
-      clearInterval(pollInterval);
+    // Book or tablebase moves, which the search that may follow only evaluates
+    let knownLines = false;
+    source.addEventListener('best_lines', (event) => {
+      knownLines = true;
+      setBestLines(JSON.parse((event as MessageEvent).data).lines);
       setIsLoadingBestLines(false);
-    }, 30000);
+    });
+    // Answered from the tablebases or the analysis store, without lines
+    source.addEventListener('evaluation', (event) => {
+      setEvaluation(JSON.parse((event as MessageEvent).data).evaluation);
+      setIsEvaluating(false);
+    });
+    // Each completed depth replaces the lines shown so far
+    source.addEventListener('analysis', (event) => {
+      const data = JSON.parse((event as MessageEvent).data);
+      if (data.lines.length > 0) {
+        setEvaluation(data.lines[0].score);
+        setIsEvaluating(false);
+      }
+      if (!knownLines) {
+        setBestLines(data.lines.map((line: BestLine) => ({ moves: line.moves, score: line.score, sharpness: null })));
+        setIsLoadingBestLines(false);
+      }
+    });
+    source.addEventListener('sharpness', (event) => {
+      const data = JSON.parse((event as MessageEvent).data);
+      setSharpness(data.sharpness);
+      setIsCalculatingSharpness(false);
+      setBestLines((lines) => lines.map((line, index) => ({ ...line, sharpness: data.lines[index] ?? null })));
+    });
+    source.addEventListener('done', finish);
+    // Superseded by a newer stream from this board, which updates the display instead
+    source.addEventListener('superseded', () => source.close());
+    source.onerror = (error) => {
+      console.error('Error streaming analysis:', error);
+      finish();
+    };
   };
 
   function makeAMove(move: any) {
@@ -200,10 +123,8 @@ const ChessGame: React.FC = () => {
         setMessage(''); // Clear message if it's a valid move
       }
 
-      // Evaluate position, calculate sharpness, and get best lines after each move
-      evaluatePosition();
-      calculateSharpness();
-      getBestLines();
+      // Stream the evaluation, best lines and sharpness of the new position
+      streamAnalysis(gameCopy.fen());
       
       return result;
     } catch (error) {
@@ -271,8 +192,9 @@ const ChessGame: React.FC = () => {
             {bestLines.map((line, index) => (
               <li key={index}>
                 <strong>Line {index + 1}:</strong><br />
-                Sharpness: {line.sharpness.toFixed(4)}
-                Score: {line.score / 100} pawns<br />
+                {line.sharpness !== null && <>Sharpness: {line.sharpness.toFixed(4)} </>}
+                {line.score !== null && <>Score: {line.score / 100} pawns<br /></>}
+                {line.source === 'book' && line.weight !== undefined && <>Book move, played {(line.weight * 100).toFixed(0)}%<br /></>}
                 Moves: {line.moves}<br />
               </li>
             ))}
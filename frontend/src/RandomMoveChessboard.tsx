@@ -1,7 +1,6 @@
 import React, { useState, useRef, useEffect } from 'react';
 import { Chess } from 'chess.js';
 import { Chessboard } from 'react-chessboard';
-import axios from 'axios';
 
 const RandomMoveChessboard: React.FC = () => {
   const [game, setGame] = useState<Chess>(new Chess());
@@ -12,6 +11,8 @@ const RandomMoveChessboard: React.FC = () => {
   const [sharpness, setSharpness] = useState<number | null>(null);
   const [isCalculatingSharpness, setIsCalculatingSharpness] = useState(false);
   const boardContainerRef = useRef<HTMLDivElement>(null);
+  // Identifies this board to the server, so a newer request cancels its stale ones
+  const clientId = useRef(Math.random().toString(36).slice(2));
 
   useEffect(() => {
     const updateDimensions = () => {
@@ -26,112 +27,66 @@ const RandomMoveChessboard: React.FC = () => {
     return () => window.removeEventListener('resize', updateDimensions);
   }, []);
 
-  const evaluatePosition = async () => {
+  const analysisStream = useRef<EventSource | null>(null);
+
+  const streamAnalysis = (fen: string) => {
+    // A newer position replaces the running stream; the server stops its search
+    analysisStream.current?.close();
     setIsEvaluating(true);
     setEvaluation(null);
-    try {
-      const response = await axios.post('http://localhost:5000/evaluate', {
-        fen: game.fen(),
-        depth: 10
-      }, {
-        headers: {
-          'Content-Type': 'application/json'
-        }
-      });
-      if (response.status === 202) {
-        // Start polling for results
-        pollForEvaluation();
-      } else {
-        console.error('Unexpected response:', response);
-        setIsEvaluating(false);
-      }
-    } catch (error) {
-      console.error('Error evaluating position:', error);
-      if (axios.isAxiosError(error)) {
-        console.error('Axios error details:', error.response?.data);
-      }
-      setIsEvaluating(false);
-    }
-  };
-
-  const pollForEvaluation = async () => {
-    const pollInterval = setInterval(async () => {
-      try {
-        const response = await axios.get('http://localhost:5000/evaluation-result');
-        if (response.data.status === 'completed') {
-          setEvaluation(response.data.evaluation);
-          setIsEvaluating(false);
-          clearInterval(pollInterval);
-        }
-      } catch (error) {
-        console.error('Error polling for evaluation:', error);
-        setIsEvaluating(false);
-        clearInterval(pollInterval);
-      }
-    }, 1000); // Poll every second
-
-    // Stop polling after 30 seconds if no result
-    setTimeout(() => {
-      clearInterval(pollInterval);
-      setIsEvaluating(false);
-    }, 30000);
-  };
-
-  const calculateSharpness = async () => {
     setIsCalculatingSharpness(true);
     setSharpness(null);
-    try {
-      const response = await axios.post('http://localhost:5000/sharpness', {
-        fen: game.fen()
-      }, {
-        headers: {
-          'Content-Type': 'application/json'
-        }
-      });
-      if (response.status === 202) {
-        // Start polling for results
-        pollForSharpness();
-      } else {
-        console.error('Unexpected response:', response);
-        setIsCalculatingSharpness(false);
-      }
-    } catch (error) {
-      console.error('Error calculating sharpness:', error);
-      if (axios.isAxiosError(error)) {
-        console.error('Axios error details:', error.response?.data);
-      }
-      setIsCalculatingSharpness(false);
-    }
-  };
 
-  const pollForSharpness = async () => {
-    const pollInterval = setInterval(async () => {
-      try {
-        const response = await axios.get('http://localhost:5000/sharpness-result');
-        if (response.data.status === 'completed') {
-          setSharpness(response.data.sharpness);
-          setIsCalculatingSharpness(false);
-          clearInterval(pollInterval);
-        }
-      } catch (error) {
-        console.error('Error polling for sharpness:', error);
+    const params = new URLSearchParams({
+      fen,
+      depth: '10',
+      sharpness: 'true',
+      client_id: clientId.current
+    });
+    const source = new EventSource(`http://localhost:5000/analysis-stream?${params}`);
+    analysisStream.current = source;
+
+    const finish = () => {
+      source.close();
+      if (analysisStream.current === source) {
+        analysisStream.current = null;
+        setIsEvaluating(false);
         setIsCalculatingSharpness(false);
-        clearInterval(pollInterval);
       }
-    }, 1000); // Poll every second
+    };
 
-    // Stop polling after 30 seconds if no result
-    setTimeout(() => {
-      clearInterval(pollInterval);
+    // Answered from the tablebases or the analysis store, without a search
+    source.addEventListener('evaluation', (event) => {
+      setEvaluation(JSON.parse((event as MessageEvent).data).evaluation);
+      setIsEvaluating(false);
+    });
+    // Each completed depth replaces the evaluation shown so far
+    source.addEventListener('analysis', (event) => {
+      const data = JSON.parse((event as MessageEvent).data);
+      if (data.lines.length > 0) {
+        setEvaluation(data.lines[0].score);
+        setIsEvaluating(false);
+      }
+    });
+    source.addEventListener('sharpness', (event) => {
+      setSharpness(JSON.parse((event as MessageEvent).data).sharpness);
       setIsCalculatingSharpness(false);
-    }, 30000);
+    });
+    source.addEventListener('done', finish);
+    // Superseded by a newer stream from this board, which updates the display instead
+    source.addEventListener('superseded', () => source.close());
+    source.onerror = (error) => {
+      console.error('Error streaming analysis:', error);
+      finish();
+    };
   };
 
   useEffect(() => {
-    evaluatePosition();
-    calculateSharpness();
+    streamAnalysis(game.fen());
   }, [game]);
 
+  useEffect(() => () => analysisStream.current?.close(), []);
+
   function makeRandomMove(currentGame: Chess) {
     const possibleMoves = currentGame.moves();
 
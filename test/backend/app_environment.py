@@ -0,0 +1,25 @@
+"""
+Environment and helpers for tests that import main.py or asgi.py, which
+configure themselves when imported. Import this module first; the settings
+apply to the whole test run, as the apps share one analysis_service.
+"""
+import json
+import os
+import tempfile
+from typing import Any, List, Tuple
+
+FAKE_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_uci_engine.py')
+DATA_DIR = tempfile.mkdtemp(prefix="chess-api-test-")
+
+os.environ.update({"STOCKFISH_PATH": FAKE_ENGINE, "LEELA_PATH": FAKE_ENGINE,
+                   "ANALYSIS_STORE_PATH": os.path.join(DATA_DIR, "analysis_store.bin"),
+                   "SHARPNESS_TABLE_PATH": os.path.join(DATA_DIR, "sharpness.npy"),
+                   "PREFETCH_POSITIONS": "0"})
+
+def parse_events(body: str) -> List[Tuple[str, Any]]:
+    """The (event, data) pairs of a text/event-stream body."""
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
@@ -0,0 +1,223 @@
+"""
+Load benchmark for the request pipeline of backend/main.py.
+
+Runs the Flask app in-process with fake_uci_engine.py in place of Stockfish
+and lc0, drives /evaluate, /sharpness and /best-lines from concurrent
+clients, and reports throughput, p50/p95/p99 latency (submission to result)
+and the share of stale results, i.e. answers that belong to a different
+position than the one requested.
+
+    python test/backend/benchmark.py --clients 16 --requests 400 --depth-latency-ms 5
+    python test/backend/benchmark.py --legacy      # poll the old *-result endpoints instead of /jobs
+
+No Stockfish, GPU or running server is needed, so it can run in CI.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+import chess
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BACKEND = os.path.join(HERE, '..', '..', 'backend')
+FAKE_ENGINE = os.path.join(HERE, 'fake_uci_engine.py')
+
+sys.path.insert(0, HERE)
+sys.path.insert(0, BACKEND)
+
+from fake_uci_engine import expected_score, expected_wdl  # noqa: E402
+
+ENDPOINTS = ("evaluate", "sharpness", "best-lines")
+LEGACY_RESULT_PATHS = {"evaluate": "/evaluation-result", "sharpness": "/sharpness-result", "best-lines": "/best-lines-result"}
+
+def random_positions(count: int, seed: int) -> List[str]:
+    """Positions from seeded random playouts, so every run requests the same FENs."""
+    rng = random.Random(seed)
+    fens = []
+    while len(fens) < count:
+        board = chess.Board()
+        for _ in range(rng.randint(4, 40)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(rng.choice(moves))
+        if not board.is_game_over():
+            fens.append(board.fen())
+    return fens
+
+def request_body(endpoint: str, fen: str, args) -> Dict:
+    if endpoint == "evaluate":
+        return {"fen": fen, "depth": args.depth}
+    if endpoint == "sharpness":
+        return {"fen": fen}
+    return {"current_fen": fen, "number_of_lines": args.lines, "depth": args.depth}
+
+def is_stale(endpoint: str, fen: str, result: Dict, lines: int) -> bool:
+    """Whether result is not the fake engine's answer for fen."""
+    from sharpness import sharpnessLC0
+    board = chess.Board(fen)
+    if endpoint == "evaluate":
+        return result.get("evaluation") != expected_score(board)
+    if endpoint == "sharpness":
+        return result.get("sharpness") is None or abs(result["sharpness"] - sharpnessLC0(expected_wdl(board))) > 1e-9
+    best_lines = result.get("best_lines") or []
+    expected = [expected_score(board, line) for line in range(min(lines, board.legal_moves.count()))]
+    return [line["score"] for line in best_lines] != expected
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {endpoint: [] for endpoint in ENDPOINTS}
+        self.counts: Dict[str, Dict[str, int]] = {endpoint: {"completed": 0, "failed": 0, "rejected": 0, "stale": 0, "timeout": 0}
+                                                  for endpoint in ENDPOINTS}
+
+    def record(self, endpoint: str, outcome: str, latency: Optional[float] = None, stale: bool = False):
+        with self.lock:
+            self.counts[endpoint][outcome] += 1
+            if stale:
+                self.counts[endpoint]["stale"] += 1
+            if latency is not None:
+                self.latencies[endpoint].append(latency)
+
+def run_client(app, fens: List[str], endpoints: List[str], weights: List[float], remaining: List[int],
+               remaining_lock: threading.Lock, recorder: Recorder, rng: random.Random, args):
+    client = app.test_client()
+    while True:
+        with remaining_lock:
+            if remaining[0] == 0:
+                return
+            remaining[0] -= 1
+        endpoint = rng.choices(endpoints, weights)[0]
+        fen = rng.choice(fens)
+        started = time.perf_counter()
+        response = client.post(f"/{endpoint}", json=request_body(endpoint, fen, args))
+        if response.status_code == 503:
+            recorder.record(endpoint, "rejected")
+            continue
+        job_id = response.get_json()["job_id"]
+        deadline = started + args.timeout
+        while True:
+            if args.legacy:
+                # The old frontend polled without a job id and took whatever finished last
+                data = client.get(LEGACY_RESULT_PATHS[endpoint]).get_json()
+                status, result = data["status"], data
+            else:
+                data = client.get(f"/jobs/{job_id}").get_json()
+                status, result = data["status"], data.get("result")
+            if status == "completed":
+                recorder.record(endpoint, "completed", time.perf_counter() - started,
+                                stale=is_stale(endpoint, fen, result, args.lines))
+                break
+            if status == "failed":
+                recorder.record(endpoint, "failed", time.perf_counter() - started)
+                break
+            if time.perf_counter() > deadline:
+                recorder.record(endpoint, "timeout")
+                break
+            time.sleep(args.poll_ms / 1000)
+
+def summarise(counts: Dict[str, int], latencies: List[float], elapsed: float) -> Dict:
+    summary = dict(counts)
+    summary["throughput"] = counts["completed"] / elapsed if elapsed > 0 else 0.0
+    summary["stale_rate"] = counts["stale"] / counts["completed"] if counts["completed"] else 0.0
+    for percentile in (50, 95, 99):
+        summary[f"p{percentile}_ms"] = float(np.percentile(latencies, percentile) * 1000) if latencies else None
+    return summary
+
+def print_report(report: Dict):
+    print(f"{'endpoint':<12} {'done':>6} {'fail':>5} {'503':>5} {'t/o':>5} {'req/s':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'stale':>7}")
+    for name, summary in report["endpoints"].items():
+        latencies = [f"{summary[key]:8.1f}" if summary[key] is not None else f"{'-':>8}" for key in ("p50_ms", "p95_ms", "p99_ms")]
+        print(f"{name:<12} {summary['completed']:>6} {summary['failed']:>5} {summary['rejected']:>5} {summary['timeout']:>5} "
+              f"{summary['throughput']:8.1f} {' '.join(latencies)} {summary['stale_rate']:7.1%}")
+
+def run(args) -> Dict:
+    store_dir = tempfile.mkdtemp(prefix="benchmark-")
+    os.environ.update({
+        "STOCKFISH_PATH": FAKE_ENGINE,
+        "LEELA_PATH": FAKE_ENGINE,
+        "ANALYSIS_STORE_PATH": os.path.join(store_dir, "analysis_store.bin"),
+        "ANALYSIS_CACHE_SIZE": str(args.cache_size),
+        "FAKE_UCI_DEPTH_LATENCY_MS": str(args.depth_latency_ms),
+        "FAKE_UCI_START_LATENCY_MS": str(args.start_latency_ms),
+    })
+    if args.pool_size is not None:
+        os.environ["STOCKFISH_POOL_SIZE"] = str(args.pool_size)
+
+    # Imported only now, since main.py reads its configuration from the environment at import time
+    import logging
+    import main as backend
+    logging.getLogger().setLevel(logging.WARNING)
+    backend.initialize_engines()
+
+    endpoints, weights = [], []
+    for part in args.mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ENDPOINTS:
+            raise SystemExit(f"Unknown endpoint in --mix: {name}")
+        endpoints.append(name)
+        weights.append(float(weight or 1))
+
+    fens = random_positions(args.positions, args.seed)
+    recorder = Recorder()
+    remaining, remaining_lock = [args.requests], threading.Lock()
+    clients = [threading.Thread(target=run_client,
+                                args=(backend.app, fens, endpoints, weights, remaining, remaining_lock, recorder,
+                                      random.Random(args.seed + i), args))
+               for i in range(args.clients)]
+    started = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - started
+
+    report = {"elapsed_s": elapsed, "endpoints": {}}
+    for endpoint in endpoints:
+        report["endpoints"][endpoint] = summarise(recorder.counts[endpoint], recorder.latencies[endpoint], elapsed)
+    totals = {outcome: sum(recorder.counts[endpoint][outcome] for endpoint in endpoints)
+              for outcome in ("completed", "failed", "rejected", "stale", "timeout")}
+    report["endpoints"]["total"] = summarise(totals, [latency for endpoint in endpoints for latency in recorder.latencies[endpoint]],
+                                             elapsed)
+
+    backend.sf_pool.close()
+    backend.leela_pool.close()
+    backend.analysis_store.close()
+    return report
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark the analysis API against a fake UCI engine.")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="Requests across all clients")
+    parser.add_argument("--mix", default="evaluate=2,sharpness=1,best-lines=1", help="Endpoint weights")
+    parser.add_argument("--positions", type=int, default=50, help="Distinct positions; fewer means more repeats")
+    parser.add_argument("--depth", type=int, default=12)
+    parser.add_argument("--lines", type=int, default=3, help="number_of_lines for /best-lines")
+    parser.add_argument("--depth-latency-ms", type=int, default=2, help="Fake engine time per depth")
+    parser.add_argument("--start-latency-ms", type=int, default=0, help="Fake engine time before depth 1")
+    parser.add_argument("--pool-size", type=int, default=None, help="STOCKFISH_POOL_SIZE")
+    parser.add_argument("--cache-size", type=int, default=100000, help="ANALYSIS_CACHE_SIZE; 1 nearly disables it")
+    parser.add_argument("--poll-ms", type=float, default=10)
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds before a request counts as timed out")
+    parser.add_argument("--legacy", action="store_true", help="Poll the *-result endpoints without a job id")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the report as one JSON line")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print_report(report)
+        print(f"{args.requests} requests from {args.clients} clients in {report['elapsed_s']:.2f}s")
+
+if __name__ == "__main__":
+    sys.exit(main())
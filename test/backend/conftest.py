@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# The backend is a set of top-level modules rather than a package
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'backend')
+sys.path.insert(0, BACKEND)
+
+FAKE_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_uci_engine.py')
+
+def start_worker(engine_type="stockfish", engines=1, token=None):
+    """An engine_worker.py process on a free localhost port, and its address."""
+    command = [sys.executable, os.path.join(BACKEND, 'engine_worker.py'), '--engine-type', engine_type,
+               '--engine', FAKE_ENGINE, '--engines', str(engines), '--port', '0', '--option', 'FakeDepthLatency=1']
+    if token is not None:
+        command += ['--token', token]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    line = process.stdout.readline()
+    assert line.startswith("Listening on "), line
+    host, port = line.split()[-1].rsplit(":", 1)
+    return process, (host, int(port))
+
+@pytest.fixture
+def workers():
+    """Starts engine workers with start_worker's arguments, and kills them after the test."""
+    started = []
+
+    def start(engine_type="stockfish", engines=1, token=None):
+        process, address = start_worker(engine_type, engines, token)
+        started.append(process)
+        return process, address
+    yield start
+    for process in started:
+        process.kill()
+        process.wait()
@@ -0,0 +1,174 @@
+"""
+A fake UCI engine for benchmarks and tests, standing in for both Stockfish and lc0.
+
+Searches take a configurable time per depth, honour depth, nodes, movetime
+and infinite limits, and stop promptly on "stop". Scores, moves and WDL are
+a deterministic function of the position, so callers can check that every
+answer belongs to the position they asked about (see expected_score and
+expected_wdl).
+
+Behaviour is set with UCI options, or with environment variables for the
+defaults when the caller cannot pass options:
+
+    FakeDepthLatency  FAKE_UCI_DEPTH_LATENCY_MS  milliseconds per depth (default 5)
+    FakeStartLatency  FAKE_UCI_START_LATENCY_MS  milliseconds before depth 1 (default 0)
+    FakeMaxDepth      FAKE_UCI_MAX_DEPTH         depth at which unlimited searches end (default 64)
+    FakeNps           FAKE_UCI_NPS               reported nodes per second (default 1000000)
+    MultiPV, UCI_ShowWDL                         as in real engines
+"""
+import os
+import sys
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import chess
+import chess.engine
+import chess.polyglot
+
+def expected_score(board: chess.Board, line: int = 0) -> int:
+    """Centipawn score of the given multipv line, from the side to move's point of view."""
+    return chess.polyglot.zobrist_hash(board) % 201 - 100 - 10 * line
+
+def expected_wdl(board: chess.Board, line: int = 0) -> Tuple[int, int, int]:
+    wdl = chess.engine.Cp(expected_score(board, line)).wdl(model="sf", ply=30)
+    return wdl.wins, wdl.draws, wdl.losses
+
+def expected_moves(board: chess.Board) -> List[chess.Move]:
+    """The engine's candidate moves, best first."""
+    moves = sorted(board.legal_moves, key=lambda move: move.uci())
+    if not moves:
+        return []
+    offset = chess.polyglot.zobrist_hash(board) % len(moves)
+    return moves[offset:] + moves[:offset]
+
+OPTIONS = {
+    "MultiPV": ("spin", "1", "min 1 max 500"),
+    "UCI_ShowWDL": ("check", "false", ""),
+    "Threads": ("spin", "1", "min 1 max 1024"),
+    "Hash": ("spin", "16", "min 1 max 33554432"),
+    "WeightsFile": ("string", "<autodiscover>", ""),
+    "FakeDepthLatency": ("spin", os.environ.get("FAKE_UCI_DEPTH_LATENCY_MS", "5"), "min 0 max 100000"),
+    "FakeStartLatency": ("spin", os.environ.get("FAKE_UCI_START_LATENCY_MS", "0"), "min 0 max 100000"),
+    "FakeMaxDepth": ("spin", os.environ.get("FAKE_UCI_MAX_DEPTH", "64"), "min 1 max 245"),
+    "FakeNps": ("spin", os.environ.get("FAKE_UCI_NPS", "1000000"), "min 1 max 1000000000"),
+}
+
+class FakeEngine:
+    def __init__(self):
+        self.options = {name: default for name, (_, default, _) in OPTIONS.items()}
+        self.board = chess.Board()
+        self.output_lock = threading.Lock()
+        self.search_thread: Optional[threading.Thread] = None
+        self.stop_event = threading.Event()
+
+    def send(self, line: str):
+        with self.output_lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    def option(self, name: str) -> int:
+        return int(self.options[name])
+
+    def handle(self, line: str) -> bool:
+        parts = line.split()
+        if not parts:
+            return True
+        command = parts[0]
+        if command == "uci":
+            self.send("id name FakeEngine")
+            self.send("id author benchmark")
+            for name, (kind, default, extra) in OPTIONS.items():
+                self.send(f"option name {name} type {kind} default {default} {extra}".rstrip())
+            self.send("uciok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "setoption":
+            value_at = parts.index("value") if "value" in parts else len(parts)
+            name = " ".join(parts[parts.index("name") + 1:value_at])
+            if name in self.options:
+                self.options[name] = " ".join(parts[value_at + 1:])
+        elif command == "ucinewgame":
+            self.wait_for_search()
+            self.board = chess.Board()
+        elif command == "position":
+            self.wait_for_search()
+            self.board = self.parse_position(parts[1:])
+        elif command == "go":
+            self.wait_for_search()
+            self.stop_event.clear()
+            self.search_thread = threading.Thread(target=self.search, args=(self.board.copy(), parts[1:]), daemon=True)
+            self.search_thread.start()
+        elif command == "stop":
+            self.stop_event.set()
+            self.wait_for_search()
+        elif command == "quit":
+            self.stop_event.set()
+            self.wait_for_search()
+            return False
+        return True
+
+    def wait_for_search(self):
+        if self.search_thread is not None:
+            self.search_thread.join()
+            self.search_thread = None
+
+    @staticmethod
+    def parse_position(parts: List[str]) -> chess.Board:
+        if parts[0] == "startpos":
+            board, rest = chess.Board(), parts[1:]
+        else:
+            moves_at = parts.index("moves") if "moves" in parts else len(parts)
+            board, rest = chess.Board(" ".join(parts[1:moves_at])), parts[moves_at:]
+        for move in rest[1:] if rest and rest[0] == "moves" else []:
+            board.push_uci(move)
+        return board
+
+    def search(self, board: chess.Board, arguments: List[str]):
+        limits = {}
+        for name in ("depth", "nodes", "movetime"):
+            if name in arguments:
+                limits[name] = int(arguments[arguments.index(name) + 1])
+        max_depth = min(limits.get("depth", self.option("FakeMaxDepth")), self.option("FakeMaxDepth"))
+        depth_latency = self.option("FakeDepthLatency") / 1000
+        nps = self.option("FakeNps")
+        show_wdl = self.options["UCI_ShowWDL"].lower() == "true"
+        moves = expected_moves(board)
+        lines = min(self.option("MultiPV"), len(moves))
+        started = time.monotonic()
+
+        if not moves:
+            score = "mate 0" if board.is_check() else "cp 0"
+            self.send(f"info depth 0 score {score}")
+            self.send("bestmove (none)")
+            return
+
+        self.stop_event.wait(self.option("FakeStartLatency") / 1000)
+        for depth in range(1, max_depth + 1):
+            if self.stop_event.wait(depth_latency):
+                break
+            elapsed = time.monotonic() - started
+            nodes = max(int(nps * elapsed), depth)
+            for line in range(lines):
+                info = (f"info depth {depth} seldepth {depth} multipv {line + 1} score cp {expected_score(board, line)}")
+                if show_wdl:
+                    info += " wdl {} {} {}".format(*expected_wdl(board, line))
+                info += f" nodes {nodes} nps {nps} time {int(elapsed * 1000)} pv {moves[line].uci()}"
+                self.send(info)
+            if "nodes" in limits and nodes >= limits["nodes"]:
+                break
+            if "movetime" in limits and elapsed * 1000 >= limits["movetime"]:
+                break
+        if "infinite" in arguments:
+            # UCI engines never end an infinite search on their own
+            self.stop_event.wait()
+        self.send(f"bestmove {moves[0].uci()}")
+
+def main():
+    engine = FakeEngine()
+    for line in sys.stdin:
+        if not engine.handle(line):
+            break
+
+if __name__ == "__main__":
+    main()
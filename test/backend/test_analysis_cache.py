@@ -0,0 +1,63 @@
+import chess
+import chess.engine
+
+from analysis_cache import AnalysisCache
+
+def lines_for(board, depth, count=1):
+    """count multipv lines of a depth search, scored apart so they can be told from each other."""
+    moves = list(board.legal_moves)[:count]
+    return [{"score": chess.engine.PovScore(chess.engine.Cp(depth * 10 - i), board.turn), "pv": [move], "depth": depth}
+            for i, move in enumerate(moves)]
+
+def after(*sans):
+    board = chess.Board()
+    for san in sans:
+        board.push_san(san)
+    return board
+
+def test_least_recently_used_entry_is_evicted():
+    cache = AnalysisCache(max_entries=2)
+    first, second, third = after("e4"), after("d4"), after("c4")
+    cache.put(first, 10, lines_for(first, 10))
+    cache.put(second, 10, lines_for(second, 10))
+    # Reading the first position makes the second the least recently used
+    assert cache.get(first, 10) is not None
+    cache.put(third, 10, lines_for(third, 10))
+    assert len(cache) == 2
+    assert cache.get(second, 1) is None
+    assert cache.get(first, 10) is not None and cache.get(third, 10) is not None
+    # contains() does not refresh entries, so the first position goes next
+    assert cache.contains(first, 10)
+    cache.put(second, 10, lines_for(second, 10))
+    assert not cache.contains(first, 1) and cache.contains(third, 10)
+    assert cache.stats() == {"entries": 2, "hits": 3, "misses": 1}
+
+def test_deeper_entry_answers_shallower_lookups():
+    cache = AnalysisCache()
+    board = after("e4", "e5")
+    cache.put(board, 20, lines_for(board, 20, count=3))
+    assert [line["score"] for line in cache.get(board, 12, multipv=2)] == \
+        [line["score"] for line in lines_for(board, 20, count=2)]
+    # Not deep enough, or fewer lines than asked for
+    assert cache.get(board, 21) is None
+    assert cache.get(board, 20, multipv=4) is None
+
+    # A shallower search, or the same depth with fewer lines, does not replace it
+    cache.put(board, 8, lines_for(board, 8, count=5))
+    cache.put(board, 20, lines_for(board, 20, count=1))
+    assert cache.get(board, 1, multipv=3)[0]["depth"] == 20
+    cache.put(board, 24, lines_for(board, 24))
+    assert cache.get(board, 24)[0]["depth"] == 24 and cache.get(board, 24, multipv=2) is None
+
+def test_transpositions_share_an_entry():
+    italian = after("e4", "e5", "Nf3", "Nc6", "Bc4")
+    transposed = after("Nf3", "Nc6", "e4", "e5", "Bc4")
+    assert italian.move_stack != transposed.move_stack
+    assert AnalysisCache.key(italian) == AnalysisCache.key(transposed)
+
+    cache = AnalysisCache()
+    cache.put(italian, 16, lines_for(italian, 16))
+    assert cache.get(transposed, 16) == cache.get(italian, 16) and len(cache) == 1
+    # The same pieces with the other side to move is another position
+    other_side = chess.Board(transposed.fen().replace(" b ", " w "))
+    assert cache.get(other_side, 1) is None
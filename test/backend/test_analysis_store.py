@@ -0,0 +1,109 @@
+import random
+import time
+
+import chess
+import chess.engine
+import numpy as np
+
+from analysis_store import HAS_MATE, HAS_SCORE, HAS_WDL, HEADER_SIZE, MAGIC, RECORD_DTYPE, AnalysisStore
+
+def boards(count: int):
+    """Distinct positions reached by random play from the start."""
+    rng = random.Random(7)
+    found, board = {}, chess.Board()
+    while len(found) < count:
+        if board.is_game_over() or board.ply() > 40:
+            board = chess.Board()
+        board.push(rng.choice(list(board.legal_moves)))
+        found.setdefault(board.epd(), board.copy())
+    return list(found.values())
+
+def score(board: chess.Board, cp: int) -> chess.engine.PovScore:
+    return chess.engine.PovScore(chess.engine.Cp(cp), board.turn)
+
+def test_records_are_fixed_size_and_little_endian(tmp_path):
+    path = tmp_path / "store.bin"
+    store = AnalysisStore(str(path))
+    board = chess.Board()
+    store.put_score(board, score(board, 31), 18)
+    store.put_score(board, chess.engine.PovScore(chess.engine.Mate(-3), board.turn), 22)
+    store.put_wdl(board, (250, 600, 150), 0.42)
+    store.close()
+
+    data = path.read_bytes()
+    assert RECORD_DTYPE.itemsize == 32 and len(data) == HEADER_SIZE + 3 * 32
+    assert data[:4] == MAGIC and np.frombuffer(data[4:HEADER_SIZE], dtype="<u4").tolist() == [1, 32, 0]
+    records = np.frombuffer(data, dtype=RECORD_DTYPE, offset=HEADER_SIZE)
+    assert records["key"].tolist() == [AnalysisStore.key(board)] * 3
+    assert records[0]["flags"] == HAS_SCORE and records[0]["score"] == 31 and records[0]["depth"] == 18
+    assert records[1]["flags"] == HAS_SCORE | HAS_MATE and records[1]["mate"] == -3
+    assert records[2]["flags"] == HAS_WDL and records[2]["wdl"].tolist() == [250, 600, 150]
+    assert records[2]["sharpness"] == 0.42
+
+def test_reopened_and_shared_files_answer_the_same(tmp_path):
+    path = str(tmp_path / "store.bin")
+    board = chess.Board()
+    writer = AnalysisStore(path, flush_size=1)
+    reader = AnalysisStore(path, refresh_interval=0.0)
+    assert reader.get_score(board, 1) is None
+    writer.put_score(board, score(board, -12), 20)
+    # The reader picks up records another store appended to the file
+    assert reader.get_score(board, 20) == (score(board, -12), 20)
+    assert reader.get_score(board, 21) is None
+    writer.put_wdl(board, (1, 998, 1), 0.0)
+    writer.close()
+    reader.close()
+
+    reopened = AnalysisStore(path)
+    assert reopened.get_score(board, 20) == (score(board, -12), 20)
+    assert reopened.get_wdl(board) == ((1, 998, 1), 0.0)
+    assert len(reopened) == 2 and reopened.keys().tolist() == [AnalysisStore.key(board)]
+
+def test_index_keeps_the_deepest_score_and_latest_wdl_across_flushes(tmp_path):
+    path = str(tmp_path / "store.bin")
+    positions = boards(300)
+    rng = random.Random(11)
+    store = AnalysisStore(path, flush_size=50)
+    expected_scores, expected_wdls = {}, {}
+    for i in range(2000):
+        board = rng.choice(positions)
+        key = AnalysisStore.key(board)
+        if rng.random() < 0.7:
+            depth, cp = rng.randint(1, 30), rng.randint(-500, 500)
+            store.put_score(board, score(board, cp), depth)
+            # Later records win ties
+            if key not in expected_scores or expected_scores[key][1] <= depth:
+                expected_scores[key] = (cp, depth)
+        else:
+            wdl = (i % 1000, 1000 - i % 1000, 0)
+            store.put_wdl(board, wdl, i / 2000)
+            expected_wdls[key] = (wdl, i / 2000)
+    for store in (store, AnalysisStore(path, refresh_interval=0.0)):
+        store.flush()
+        for board in positions:
+            key = AnalysisStore.key(board)
+            stored = store.get_score(board, 1)
+            if key in expected_scores:
+                cp, depth = expected_scores[key]
+                assert stored == (score(board, cp), depth)
+            else:
+                assert stored is None
+            assert store.get_wdl(board) == expected_wdls.get(key)
+        assert sorted(store.keys().tolist()) == sorted(set(expected_scores) | set(expected_wdls))
+
+def test_background_flush_appends_without_blocking_puts(tmp_path):
+    path = str(tmp_path / "store.bin")
+    store = AnalysisStore(path, flush_size=10, background_flush=True)
+    reader = AnalysisStore(path, refresh_interval=0)
+    positions = boards(25)
+    for i, board in enumerate(positions):
+        store.put_score(board, score(board, i), 12)
+    # The flusher thread writes the full batches; the remainder stays pending until close
+    deadline = time.monotonic() + 5
+    while reader.get_score(positions[19], 12) is None:
+        assert time.monotonic() < deadline, "background flush did not reach the file"
+        time.sleep(0.01)
+    assert store.get_score(positions[24], 12)[0].relative.score() == 24
+    store.close()
+    assert reader.get_score(positions[24], 12)[0].relative.score() == 24
+    reader.close()
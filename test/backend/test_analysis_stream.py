@@ -0,0 +1,123 @@
+import chess
+import chess.engine
+import pytest
+
+from app_environment import parse_events
+import analysis_service
+import main
+from fake_uci_engine import expected_moves, expected_score
+from search_budget import SearchBudget
+
+ITALIAN = "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3"
+# Not searched by the other tests
+SICILIAN = "rnbqkbnr/pp1ppppp/8/2p5/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2"
+FRENCH = "rnbqkbnr/pppp1ppp/4p3/8/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2"
+CARO_KANN = "rnbqkbnr/pp1ppppp/2p5/8/4P3/8/PPPP1PPP/RNBQKBNR w KQkq - 0 2"
+
+@pytest.fixture(scope="module", autouse=True)
+def engines():
+    main.initialize_engines()
+    yield
+    # Engine threads are not daemons, so the pools must be closed for the test run to exit
+    main.sf_pool.close()
+    main.leela_pool.close()
+    # So the next module's initialize_engines starts new pools
+    main.sf_pool = main.leela_pool = None
+
+def test_stream_reports_every_depth_then_sharpness():
+    board = chess.Board(ITALIAN)
+    client = main.app.test_client()
+    response = client.get("/analysis-stream", query_string={"fen": ITALIAN, "depth": 6, "multipv": 3, "sharpness": "true"})
+    assert response.mimetype == "text/event-stream"
+    events = parse_events(response.get_data(as_text=True))
+    assert [event for event, _ in events][-2:] == ["sharpness", "done"]
+    # A shared search reports each depth it completes, though a busy waiter may only see the latest of several
+    depths = [data["depth"] for event, data in events if event == "analysis"]
+    assert len(depths) == len(events) - 2 and depths == sorted(set(depths)) and depths[-1] == 6
+    lines = events[-3][1]["lines"]
+    assert [line["score"] for line in lines] == [expected_score(board, i) for i in range(3)]
+    assert [line["pv"][0] for line in lines] == [move.uci() for move in expected_moves(board)[:3]]
+    assert lines[0]["moves"].startswith(board.variation_san(expected_moves(board)[:1]))
+    sharpness = events[-2][1]
+    assert sharpness["fen"] == ITALIAN and sharpness["sharpness"] >= 0 and len(sharpness["lines"]) == 3
+    assert events[-1][1] == {"fen": ITALIAN, "depth": 6}
+
+    # The finished search is cached, so repeating it is one event
+    response = client.get("/analysis-stream", query_string={"fen": ITALIAN, "depth": 6, "multipv": 3})
+    assert [event for event, _ in parse_events(response.get_data(as_text=True))] == ["analysis", "done"]
+
+def test_newer_stream_from_the_same_client_stops_the_older_one(monkeypatch):
+    # A budget the older search cannot finish within the test, rather than one it may stop early for stability
+    monkeypatch.setattr(main, "plan_search", lambda board, depth, *args: SearchBudget(depth, 30.0, depth))
+    client = main.app.test_client()
+    older = client.get("/analysis-stream", query_string={"fen": chess.STARTING_FEN, "depth": 60, "client_id": "board-1"},
+                       buffered=False)
+    chunks = iter(older.response)
+    assert next(chunks).decode().startswith("event: analysis")
+
+    newer = client.get("/analysis-stream", query_string={"fen": ITALIAN, "depth": 3, "client_id": "board-1"})
+    assert [event for event, _ in parse_events(newer.get_data(as_text=True))][-1] == "done"
+    events = parse_events("".join(chunk.decode() for chunk in chunks))
+    assert events[-1] == ("superseded", {"fen": chess.STARTING_FEN})
+    older.close()
+    # Nobody else was waiting for the older search, so it was stopped
+    assert len(main.search_coalescer) == 0
+
+def test_book_moves_are_streamed_before_the_evaluation(monkeypatch):
+    board = chess.Board(SICILIAN)
+    book = [board.san(move) for move in expected_moves(board)[:2]]
+    monkeypatch.setattr(main.fast_path, "best_lines", lambda position, number_of_lines: {
+        "source": "book", "best_lines": [{"moves": san, "score": None, "sharpness": None, "source": "book", "weight": weight}
+                                         for san, weight in zip(book, (0.75, 0.25))]})
+    client = main.app.test_client()
+    response = client.get("/analysis-stream", query_string={"fen": SICILIAN, "depth": 4, "multipv": 3, "sharpness": "true"})
+    events = parse_events(response.get_data(as_text=True))
+    assert events[0] == ("best_lines", {"fen": SICILIAN, "source": "book", "lines": [
+        {"moves": book[0], "score": None, "sharpness": None, "source": "book", "weight": 0.75},
+        {"moves": book[1], "score": None, "sharpness": None, "source": "book", "weight": 0.25}]})
+    # The book has no scores, so one line is searched for the evaluation
+    assert [event for event, _ in events[1:]] == ["analysis"] * (len(events) - 3) + ["sharpness", "done"]
+    assert [line["score"] for line in events[-3][1]["lines"]] == [expected_score(board)]
+    # Sharpness is scored for the book moves
+    assert len(events[-2][1]["lines"]) == 2
+
+def test_stored_evaluations_are_streamed_without_a_search():
+    board = chess.Board(FRENCH)
+    main.analysis_store.put_score(board, chess.engine.PovScore(chess.engine.Cp(42), board.turn), 12)
+    client = main.app.test_client()
+    response = client.get("/analysis-stream", query_string={"fen": FRENCH, "depth": 10})
+    assert parse_events(response.get_data(as_text=True)) == [
+        ("evaluation", {"fen": FRENCH, "depth": 12, "evaluation": 42, "source": "store"}),
+        ("done", {"fen": FRENCH, "depth": 12})]
+
+def test_streams_with_a_session_search_on_its_engine():
+    client = main.app.test_client()
+    response = client.get("/analysis-stream", query_string={"fen": CARO_KANN, "depth": 5, "multipv": 2,
+                                                            "session_id": "stream-1"})
+    events = parse_events(response.get_data(as_text=True))
+    assert events[-1] == ("done", {"fen": CARO_KANN, "depth": 5})
+    assert [event for event, _ in events[:-1]] == ["analysis"] * 5
+    assert "stream-1" in main.session_manager._sessions
+    assert main.session_manager.close_session("stream-1")
+
+def test_stream_rejects_missing_and_invalid_positions():
+    client = main.app.test_client()
+    assert client.get("/analysis-stream").status_code == 400
+    assert client.get("/analysis-stream", query_string={"fen": "not a position"}).status_code == 400
+
+def test_session_ids_are_ignored_when_sessions_are_off(monkeypatch):
+    # As with a single Stockfish engine, which sessions may never pin
+    monkeypatch.setattr(main, "session_manager", None)
+    board = chess.Board(ITALIAN)
+    lines, depth, _ = main.search_lines(board, 4, session_id="board-9")
+    assert depth == 4 and lines[0]["score"].relative.score() == expected_score(board)
+
+def test_sharpness_batches_are_capped(monkeypatch):
+    monkeypatch.setattr(analysis_service, "sharpness_batch_max", 2)
+    client = main.app.test_client()
+    response = client.post("/sharpness-batch", json={"wdls": [[300, 500, 200]] * 3})
+    assert response.status_code == 413
+    assert client.post("/sharpness-batch", json={"fens": [ITALIAN] * 3}).status_code == 413
+    response = client.post("/sharpness-batch", json={"wdls": [[300, 500, 200]] * 2})
+    assert response.status_code == 200 and len(response.get_json()["sharpness"]) == 2
+    assert client.post("/sharpness-batch", json={"wdls": [[300, 500, float("nan")]]}).status_code == 400
@@ -0,0 +1,122 @@
+import asyncio
+import threading
+
+import chess
+import pytest
+
+pytest.importorskip("quart")
+
+from app_environment import parse_events  # noqa: E402
+import asgi  # noqa: E402
+from analysis_store import AnalysisStore  # noqa: E402
+from fake_uci_engine import expected_moves, expected_score  # noqa: E402
+from search_budget import SearchBudget  # noqa: E402
+
+# Not searched by the Flask tests, which share the analysis cache
+RUY_LOPEZ = "r1bqkbnr/pppp1ppp/2n5/1B2p3/4P3/5N2/PPPP1PPP/RNBQK2R b KQkq - 3 3"
+SCOTCH = "r1bqkbnr/pppp1ppp/2n5/4p3/3PP3/5N2/PPP2PPP/RNBQKB1R b KQkq - 0 3"
+
+async def job_result(client, response):
+    assert response.status_code == 202
+    job_id = (await response.get_json())["job_id"]
+    for _ in range(500):
+        job = await (await client.get(f"/jobs/{job_id}")).get_json()
+        if job["status"] not in ("queued", "in_progress"):
+            return job
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+def test_api_on_asyncio_engines():
+    board = chess.Board(RUY_LOPEZ)
+
+    async def run():
+        async with asgi.app.test_app() as app:
+            client = app.test_client()
+            job = await job_result(client, await client.post("/evaluate", json={"fen": RUY_LOPEZ, "depth": 6}))
+            assert job["result"] == {"evaluation": expected_score(board)}
+            legacy = await (await client.get("/evaluation-result")).get_json()
+            assert legacy["evaluation"] == expected_score(board)
+
+            job = await job_result(client, await client.post("/best-lines", json={
+                "current_fen": RUY_LOPEZ, "number_of_lines": 2, "depth": 6, "session_id": "game-1"}))
+            lines = job["result"]["best_lines"]
+            assert lines[0]["moves"].startswith(board.variation_san(expected_moves(board)[:1]))
+            assert all(0 <= line["sharpness"] for line in lines)
+
+            job = await job_result(client, await client.post("/sharpness-batch", json={"fens": [RUY_LOPEZ, chess.STARTING_FEN]}))
+            assert len(job["result"]["sharpness"]) == 2
+            response = await client.post("/sharpness-batch", json={"wdls": [[500, 400]]})
+            assert response.status_code == 400
+            # NaN would come back as invalid JSON, and a negative WDL is not a probability
+            for wdl in ([float("nan"), 500, 500], [float("inf"), 0, 0], [-100, 600, 500]):
+                response = await client.post("/sharpness-batch", json={"wdls": [[300, 500, 200], wdl]})
+                assert response.status_code == 400
+
+            # Deeper than the best lines search above, so it is not answered from the cache
+            response = await client.get("/analysis-stream", query_string={"fen": RUY_LOPEZ, "depth": 8, "multipv": 2})
+            events = parse_events(await response.get_data(as_text=True))
+            assert [event for event, _ in events] == ["analysis"] * 8 + ["done"]
+            assert [data["depth"] for _, data in events] == [1, 2, 3, 4, 5, 6, 7, 8, 8]
+            assert [line["score"] for line in events[7][1]["lines"]] == [expected_score(board, 0), expected_score(board, 1)]
+            # The completed search is served from the cache the next time, here with Leela's sharpness
+            response = await client.get("/analysis-stream", query_string={"fen": RUY_LOPEZ, "depth": 8, "multipv": 2,
+                                                                          "sharpness": "true"})
+            events = parse_events(await response.get_data(as_text=True))
+            assert [event for event, _ in events] == ["analysis", "sharpness", "done"]
+            assert events[1][1]["sharpness"] >= 0 and len(events[1][1]["lines"]) == 2
+
+            assert (await client.delete("/sessions/game-1")).status_code == 200
+            assert (await client.delete("/sessions/game-1")).status_code == 404
+            assert (await client.post("/evaluate", json={})).status_code == 400
+            assert "http_request_duration_seconds" in await (await client.get("/metrics")).get_data(as_text=True)
+        # Searches are flushed to the file off the event loop, by shutdown at the latest
+        reopened = AnalysisStore(asgi.analysis_store.path)
+        assert reopened.get_score(board, 8)[0].relative.score() == expected_score(board)
+        reopened.close()
+    asyncio.run(run())
+
+def test_store_and_fast_path_lookups_run_off_the_event_loop(monkeypatch):
+    lookup_threads = []
+
+    def recording(lookup):
+        def record(*args):
+            lookup_threads.append(threading.current_thread())
+            return lookup(*args)
+        return record
+    monkeypatch.setattr(asgi.fast_path, "evaluate", recording(asgi.fast_path.evaluate))
+    monkeypatch.setattr(asgi.analysis_store, "get_wdl", recording(asgi.analysis_store.get_wdl))
+
+    async def run():
+        async with asgi.app.test_app() as app:
+            response = await app.test_client().post("/evaluate", json={"fen": "8/8/8/8/8/2k5/8/K1Q5 w - - 0 1", "depth": 1})
+            assert response.status_code in (200, 202)
+            await asgi.known_sharpnesses([chess.Board()])
+        return threading.current_thread()
+    loop_thread = asyncio.run(run())
+    assert len(lookup_threads) == 2 and loop_thread not in lookup_threads
+
+def test_stream_sends_book_moves_and_a_superseded_event(monkeypatch):
+    board = chess.Board(SCOTCH)
+    book = board.san(expected_moves(board)[0])
+    monkeypatch.setattr(asgi.fast_path, "best_lines", lambda position, number_of_lines: {
+        "source": "book", "best_lines": [{"moves": book, "score": None, "sharpness": None, "source": "book", "weight": 1.0}]})
+
+    async def run():
+        async with asgi.app.test_app() as app:
+            client = app.test_client()
+            response = await client.get("/analysis-stream", query_string={"fen": SCOTCH, "depth": 4, "multipv": 2})
+            events = parse_events(await response.get_data(as_text=True))
+            assert events[0] == ("best_lines", {"fen": SCOTCH, "source": "book", "lines": [
+                {"moves": book, "score": None, "sharpness": None, "source": "book", "weight": 1.0}]})
+            assert [event for event, _ in events[1:]] == ["analysis"] * 4 + ["done"]
+            assert [line["score"] for line in events[4][1]["lines"]] == [expected_score(board)]
+
+            # A stream for another position from the same client cancels the search of this one
+            monkeypatch.setattr(asgi, "plan_search", lambda position, depth, *args: SearchBudget(depth, 30.0, depth))
+            older = asyncio.create_task(client.get("/analysis-stream", query_string={
+                "fen": chess.STARTING_FEN, "depth": 60, "client_id": "board-1"}))
+            await asyncio.sleep(0.2)
+            await client.get("/analysis-stream", query_string={"fen": SCOTCH, "depth": 4, "client_id": "board-1"})
+            events = parse_events(await (await older).get_data(as_text=True))
+            assert events[-1] == ("superseded", {"fen": chess.STARTING_FEN})
+    asyncio.run(run())
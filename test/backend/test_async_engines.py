@@ -0,0 +1,115 @@
+import asyncio
+import os
+
+import chess
+import pytest
+
+from async_engines import AsyncEnginePool
+from engine_sessions import AsyncSessionManager
+from fake_uci_engine import expected_moves, expected_score, expected_wdl
+from jobs import CANCELLED, COMPLETED, AsyncJobScheduler, JobStore, QueueFullError
+from search_budget import SearchBudget, run_budgeted_async
+
+FAKE_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_uci_engine.py')
+ITALIAN = chess.Board("r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3")
+
+async def wait_finished(job, timeout=5):
+    async def poll():
+        while not job.is_finished():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+def test_pool_serves_searches_and_replaces_crashed_engines():
+    async def run():
+        pool = AsyncEnginePool("leela", FAKE_ENGINE, {"UCI_ShowWDL": "true", "FakeDepthLatency": "1"}, size=2)
+        await pool.start()
+        try:
+            boards = [chess.Board(), ITALIAN]
+            async with pool.checkout() as engine:
+                infos = await engine.analyse_wdls(boards)
+            assert [tuple(info["wdl"].relative) for info in infos] == [expected_wdl(board) for board in boards]
+
+            async with pool.checkout() as engine:
+                lines, depth, _ = await run_budgeted_async(engine, ITALIAN, SearchBudget(6, 5.0, 6), multipv=2)
+            assert depth == 6 and [line["score"].relative.score() for line in lines] == \
+                [expected_score(ITALIAN, 0), expected_score(ITALIAN, 1)]
+
+            # Both engines taken: a third request waits for one, up to its timeout
+            first, second = await pool.acquire(), await pool.acquire()
+            with pytest.raises(TimeoutError):
+                await pool.acquire(timeout=0.05)
+            await pool.release(first, healthy=False)
+            await pool.release(second)
+            # The suspect engine is respawned by the next checkout that gets its slot
+            engines = [await pool.acquire(), await pool.acquire()]
+            assert first not in engines and None not in engines
+            for engine in engines:
+                await pool.release(engine)
+        finally:
+            await pool.close()
+    asyncio.run(run())
+
+def test_sessions_ponder_and_give_their_engine_back():
+    async def run():
+        pool = AsyncEnginePool("stockfish", FAKE_ENGINE, {"FakeDepthLatency": "2"}, size=1)
+        await pool.start()
+        sessions = AsyncSessionManager(pool, max_sessions=1, idle_timeout=0.2)
+        try:
+            lines, depth, _ = await sessions.analyse("game-1", ITALIAN.fen(), SearchBudget(4, 5.0, 4))
+            assert depth == 4 and lines[0]["pv"][0] == expected_moves(ITALIAN)[0]
+            # The session keeps the only engine and searches the expected reply in the background
+            session = sessions._sessions["game-1"]
+            assert session._ponder is not None and pool._idle.empty()
+
+            await asyncio.sleep(0.3)
+            board = ITALIAN.copy()
+            board.push(lines[0]["pv"][0])
+            lines, depth, _ = await sessions.analyse("game-1", board.fen(), SearchBudget(8, 5.0, 8))
+            assert depth >= 8 and lines[0]["score"].relative.score() == expected_score(board)
+
+            # A second game takes over the engine once the least recently used session is closed
+            await sessions.analyse("game-2", chess.Board().fen(), SearchBudget(3, 5.0, 3))
+            assert session.closed and session._ponder is None and len(sessions) == 1
+
+            # Idle sessions are reaped and their engine goes back to the pool
+            await asyncio.sleep(1.5)
+            assert len(sessions) == 0 and pool._idle.qsize() == 1
+            assert not await sessions.close_session("game-2")
+        finally:
+            await sessions.close()
+            await pool.close()
+    asyncio.run(run())
+
+def test_scheduler_cancels_superseded_jobs_and_bounds_its_queue():
+    async def run():
+        started = asyncio.Event()
+        stopped = []
+
+        async def search(fen, delay=5.0):
+            started.set()
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                stopped.append(fen)
+                raise
+            return {"fen": fen}
+
+        scheduler = AsyncJobScheduler(JobStore(), workers=1, max_queued=1)
+        scheduler.register("evaluate", search)
+        try:
+            running = scheduler.submit("evaluate", supersede=("board-1", "evaluate"), fen="a")
+            await asyncio.wait_for(started.wait(), 5)
+            queued = scheduler.submit("evaluate", supersede=("board-2", "evaluate"), fen="b", delay=0)
+            with pytest.raises(QueueFullError):
+                scheduler.submit("evaluate", fen="c")
+
+            scheduler.supersede(("board-1", "evaluate"), {"fen": "d"})
+            await wait_finished(running)
+            assert running.status == CANCELLED and stopped == ["a"]
+            await wait_finished(queued)
+            assert queued.status == COMPLETED and queued.result == {"fen": "b"}
+            with pytest.raises(ValueError):
+                scheduler.submit("unknown")
+        finally:
+            await scheduler.close()
+    asyncio.run(run())
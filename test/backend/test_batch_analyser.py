@@ -0,0 +1,89 @@
+import json
+import multiprocessing
+import os
+
+import chess
+import chess.polyglot
+import pytest
+
+from analysis_store import AnalysisStore
+from batch_analyser import BatchAnalyser, init_worker
+from fake_uci_engine import expected_score, expected_wdl
+from sharpness import SharpnessTable
+
+FAKE_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_uci_engine.py')
+
+GAMES = [
+    "1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 *",
+    "1. d4 d5 2. c4 e6 3. Nc3 Nf6 *",
+    "1. e4 c5 2. Nf3 d6 3. d4 cxd4 *",
+    "1. c4 e5 2. g3 Nf6 3. Bg2 d5 *",
+]
+
+class RecordingPool:
+    """Passes tasks to a real pool, remembering them, and fails after a number of chunks like an interrupted run."""
+
+    def __init__(self, pool, fail_after=None):
+        self.pool = pool
+        self.fail_after = fail_after
+        self.fens = []
+        self.chunks = 0
+
+    def imap_unordered(self, function, tasks, chunksize=1):
+        if self.fail_after is not None and self.chunks >= self.fail_after:
+            raise RuntimeError("interrupted")
+        self.chunks += 1
+        self.fens.extend(fen for fen, _, _ in tasks)
+        return self.pool.imap_unordered(function, tasks, chunksize=chunksize)
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = multiprocessing.get_context("spawn").Pool(
+        processes=2, initializer=init_worker,
+        initargs=(FAKE_ENGINE, {"FakeDepthLatency": "1"}, FAKE_ENGINE, {"UCI_ShowWDL": "true", "FakeDepthLatency": "1"}))
+    yield pool
+    pool.close()
+    pool.join()
+
+def positions(pgn_games):
+    """Every distinct position of the games."""
+    keys = {}
+    for game in pgn_games:
+        board = chess.Board()
+        keys[chess.polyglot.zobrist_hash(board)] = board.copy()
+        for san in [token for token in game.split() if not token[0].isdigit() and token != "*"]:
+            board.push_san(san)
+            keys[chess.polyglot.zobrist_hash(board)] = board.copy()
+    return keys
+
+def test_resumed_run_skips_finished_work(tmp_path, pool):
+    games = tmp_path / "games.pgn"
+    games.write_text("\n\n".join(GAMES) + "\n")
+    output = str(tmp_path / "store.bin")
+    table = SharpnessTable.build()
+
+    # Interrupted after the first chunk, which holds the first two games
+    interrupted = RecordingPool(pool, fail_after=1)
+    with pytest.raises(RuntimeError):
+        BatchAnalyser([str(games)], output, interrupted, depth=3, leela_nodes=1, chunk_size=10, sharpness_table=table).run()
+    with open(output + ".checkpoint.json", encoding="utf-8") as f:
+        assert json.load(f)["items_done"] == 2
+
+    resumed = RecordingPool(pool)
+    BatchAnalyser([str(games)], output, resumed, depth=3, leela_nodes=1, chunk_size=10, sharpness_table=table).run()
+    expected = positions(GAMES)
+    analysed = [chess.polyglot.zobrist_hash(chess.Board(fen)) for fen in interrupted.fens + resumed.fens]
+    # Each position was searched exactly once across both runs, transpositions included
+    assert sorted(analysed) == sorted(expected) and len(resumed.fens) < len(expected)
+
+    store = AnalysisStore(output)
+    for board in expected.values():
+        score, depth = store.get_score(board, 3)
+        assert depth == 3 and score.relative.score() == expected_score(board)
+        assert store.get_wdl(board)[0] == expected_wdl(board)
+    store.close()
+
+    # A finished corpus has nothing left to analyse
+    again = RecordingPool(pool)
+    BatchAnalyser([str(games)], output, again, depth=3, leela_nodes=1, chunk_size=10, sharpness_table=table).run()
+    assert again.fens == []
@@ -0,0 +1,47 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import chess
+import chess.engine
+
+from chess_engines import engine_command
+from fake_uci_engine import expected_score, expected_wdl
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKE_ENGINE = os.path.join(HERE, 'fake_uci_engine.py')
+
+def test_fake_engine_reports_deterministic_multipv_and_wdl():
+    engine = chess.engine.SimpleEngine.popen_uci(engine_command(FAKE_ENGINE))
+    try:
+        engine.configure({"UCI_ShowWDL": "true", "FakeDepthLatency": "1"})
+        board = chess.Board("r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3")
+        infos = engine.analyse(board, chess.engine.Limit(depth=6), multipv=3)
+        assert [info["score"].relative.score() for info in infos] == [expected_score(board, line) for line in range(3)]
+        assert tuple(infos[0]["wdl"].relative) == expected_wdl(board)
+        assert infos[0]["depth"] == 6
+    finally:
+        engine.quit()
+
+def test_fake_engine_stops_infinite_search():
+    engine = chess.engine.SimpleEngine.popen_uci(engine_command(FAKE_ENGINE))
+    try:
+        with engine.analysis(chess.Board()) as analysis:
+            analysis.get()
+            started = time.monotonic()
+            analysis.stop()
+            analysis.wait()
+        assert time.monotonic() - started < 1.0
+    finally:
+        engine.quit()
+
+def test_benchmark_runs_without_failures_or_stale_results():
+    completed = subprocess.run([sys.executable, os.path.join(HERE, 'benchmark.py'), '--requests', '40', '--clients', '6',
+                                '--depth', '8', '--json'], capture_output=True, text=True, timeout=120)
+    assert completed.returncode == 0, completed.stderr
+    total = json.loads(completed.stdout.splitlines()[-1])["endpoints"]["total"]
+    assert total["completed"] == 40, total
+    assert total["stale"] == 0, total
+    assert total["p99_ms"] is not None
@@ -0,0 +1,56 @@
+import chess
+import pytest
+
+import app_environment  # noqa: F401
+import main
+from fake_uci_engine import expected_moves, expected_wdl
+from sharpness import sharpnessLC0
+
+# Not searched by the other tests, so no candidate is known to the analysis store yet
+QUEENS_GAMBIT = chess.Board("rnbqkb1r/pppp1ppp/4pn2/8/2PP4/8/PP2PPPP/RNBQKBNR w KQkq - 0 3")
+
+@pytest.fixture(scope="module", autouse=True)
+def engines():
+    main.initialize_engines()
+    yield
+    # Engine threads are not daemons, so the pools must be closed for the test run to exit
+    main.sf_pool.close()
+    main.leela_pool.close()
+    # So the next module's initialize_engines starts new pools
+    main.sf_pool = main.leela_pool = None
+
+class RecordingExecutor:
+    """Runs work on the real candidate executor, remembering the batches mapped over it."""
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.batches = []
+
+    def submit(self, *args, **kwargs):
+        return self.executor.submit(*args, **kwargs)
+
+    def map(self, function, batches):
+        batches = list(batches)
+        self.batches.extend(batches)
+        return self.executor.map(function, batches)
+
+def test_root_wdls_score_covered_candidates_and_the_rest_fan_out(monkeypatch):
+    executor = RecordingExecutor(main.candidate_executor)
+    monkeypatch.setattr(main, "candidate_executor", executor)
+    board = QUEENS_GAMBIT.copy()
+    moves = expected_moves(board)[:4]
+    # Leela's root search covers the first two candidates only
+    root_wdls = executor.submit(main.leela_root_wdls, board, 2)
+    sharpnesses = main.score_candidates(board, moves, root_wdls)
+
+    children = main.child_boards(board, moves)
+    for i in range(2):
+        # The root side's WDL for the move, turned around for the side to move after it
+        wins, draws, losses = expected_wdl(board, i)
+        assert sharpnesses[i] == pytest.approx(float(sharpnessLC0((losses, draws, wins))))
+    for i in range(2, 4):
+        assert sharpnesses[i] == pytest.approx(float(sharpnessLC0(expected_wdl(children[i]))))
+    # Only the two candidates the root search missed were searched on their own
+    assert sum(len(batch) for batch in executor.batches) == 2
+    # Every candidate is now known without a search
+    assert [main.known_sharpness(child) for child in children] == pytest.approx(sharpnesses)
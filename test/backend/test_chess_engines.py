@@ -0,0 +1,83 @@
+import os
+import signal
+import threading
+
+import chess
+import chess.engine
+import pytest
+
+from chess_engines import EnginePool, LeelaEngine, needs_refinement
+from metrics import ENGINE_CRASHES
+from fake_uci_engine import expected_wdl
+
+FAKE_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_uci_engine.py')
+
+def test_wdl_batch_is_one_node_search_per_position():
+    engine = LeelaEngine(FAKE_ENGINE, {"UCI_ShowWDL": "true", "FakeDepthLatency": "1", "FakeNps": "1000"})
+    try:
+        boards = [chess.Board(), chess.Board("r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3"),
+                  chess.Board("8/8/8/8/8/2k5/8/K1Q5 w - - 0 1")]
+        infos = engine.analyse_wdls(boards)
+        assert [tuple(info["wdl"].relative) for info in infos] == [expected_wdl(board) for board in boards]
+        assert all(info["depth"] == 1 for info in infos)
+    finally:
+        engine.quit()
+
+def test_only_positions_with_chances_for_both_sides_are_refined():
+    def info(wins, draws, losses):
+        return {"wdl": chess.engine.PovWdl(chess.engine.Wdl(wins, draws, losses), chess.WHITE)}
+    assert needs_refinement(info(300, 450, 250), nodes=1, refine_nodes=400)
+    assert not needs_refinement(info(300, 450, 250), nodes=1, refine_nodes=0)
+    assert not needs_refinement(info(900, 80, 20), nodes=1, refine_nodes=400)
+    assert not needs_refinement({}, nodes=1, refine_nodes=400)
+
+def test_waiting_request_preempts_low_priority_holder():
+    pool = EnginePool("stockfish", FAKE_ENGINE, {}, size=1)
+    preempted = threading.Event()
+    try:
+        with pool.checkout_preemptible(preempted.set) as engine:
+            assert engine is not None
+            # Nothing is idle any more, so other low-priority work gets nothing rather than waiting
+            with pool.checkout_preemptible(lambda: None) as other:
+                assert other is None
+            waiter = threading.Thread(target=lambda: pool.release(pool.acquire(timeout=5)))
+            waiter.start()
+            assert preempted.wait(5)
+        waiter.join(5)
+        assert not waiter.is_alive()
+    finally:
+        pool.close()
+
+def kill(engine):
+    os.kill(engine.engine.transport.get_pid(), signal.SIGKILL)
+    engine.engine.returncode.result(5)
+
+def test_dead_engines_are_replaced():
+    pool = EnginePool("stockfish", FAKE_ENGINE, {"FakeDepthLatency": "1"}, size=1, health_check_interval=3600)
+    crashes = ENGINE_CRASHES.labels("stockfish").get()
+    try:
+        # An error about the request leaves the engine in the pool
+        with pytest.raises(ValueError):
+            with pool.checkout() as engine:
+                raise ValueError("invalid FEN")
+        with pool.checkout() as same:
+            assert same is engine
+
+        # A search on a dead engine fails, and the next checkout gets a new process
+        kill(engine)
+        with pytest.raises(chess.engine.EngineTerminatedError):
+            with pool.checkout() as dead:
+                dead.analyse(chess.Board(), chess.engine.Limit(depth=2))
+        with pool.checkout() as replaced:
+            assert replaced is not engine
+            assert replaced.analyse(chess.Board(), chess.engine.Limit(depth=2))["depth"] == 2
+
+        # An engine that dies while idle is replaced by the health check
+        kill(replaced)
+        pool.health_check()
+        with pool.checkout() as checked:
+            assert checked is not replaced
+            assert checked.analyse(chess.Board(), chess.engine.Limit(depth=2))["depth"] == 2
+        assert ENGINE_CRASHES.labels("stockfish").get() == crashes + 2
+    finally:
+        pool.close()
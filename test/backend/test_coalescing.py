@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+
+import chess
+import pytest
+
+from cancellation import CancelToken, Cancelled
+from chess_engines import ChessEngine
+from coalescing import SearchCoalescer, SharedCalls, run_in_flight
+from fake_uci_engine import expected_moves
+from search_budget import SearchBudget
+
+FAKE_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_uci_engine.py')
+
+@pytest.fixture
+def engine():
+    engine = ChessEngine(FAKE_ENGINE, {"FakeDepthLatency": "20"})
+    yield engine
+    engine.quit()
+
+def budget(depth: int, time_limit: float = 30.0) -> SearchBudget:
+    # A minimum depth at the maximum turns off stopping for stability
+    return SearchBudget(depth, time_limit, depth)
+
+def wait_until(predicate, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+def start_request(coalescer, key, search_budget, run, results):
+    """Run a coalesced request on its own thread, appending its result or error to results."""
+    def request():
+        try:
+            results.append(coalescer.search(key, search_budget, run))
+        except Exception as e:
+            results.append(e)
+    thread = threading.Thread(target=request)
+    thread.start()
+    return thread
+
+def test_deeper_request_attaches_and_extends_the_running_search(engine):
+    coalescer = SearchCoalescer()
+    board = chess.Board()
+    runs = []
+
+    def run(search):
+        runs.append(search)
+        return run_in_flight(engine, board, search)
+    shallow_results, deep_results = [], []
+    shallow = start_request(coalescer, "key", budget(4), run, shallow_results)
+    while not runs:
+        time.sleep(0.005)
+    deep = start_request(coalescer, "key", budget(10), run, deep_results)
+    shallow.join(5)
+    deep.join(5)
+
+    # One engine search answered both, each as soon as it reached the depth asked for
+    assert len(runs) == 1 and runs[0].followers == 1 and runs[0].budget.max_depth == 10
+    shallow_lines, shallow_depth, _ = shallow_results[0]
+    deep_lines, deep_depth, _ = deep_results[0]
+    assert 4 <= shallow_depth < 10 and deep_depth == 10
+    assert shallow_lines[0]["pv"][0] == deep_lines[0]["pv"][0] == expected_moves(board)[0]
+    # The search thread forgets the key once the engine has stopped
+    wait_until(lambda: len(coalescer) == 0 and runs[0].finished)
+
+    # A request that is already covered returns at once; a finished search is not joined again
+    assert not runs[0].attach(budget(4))
+    assert coalescer.search("key", budget(3), run)[1] == 3 and len(runs) == 2
+    wait_until(lambda: len(coalescer) == 0)
+
+def test_leader_failure_reaches_every_waiter():
+    coalescer = SearchCoalescer()
+    release = threading.Event()
+    runs = []
+
+    def run(search):
+        runs.append(search)
+        release.wait(5)
+        raise RuntimeError("engine crashed")
+    results = []
+    threads = [start_request(coalescer, "key", budget(5), run, results)]
+    while not runs:
+        time.sleep(0.005)
+    threads.append(start_request(coalescer, "key", budget(8), run, results))
+    wait_until(lambda: runs[0].followers == 1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(results) == 2 and all(isinstance(result, RuntimeError) for result in results)
+    assert len(runs) == 1 and len(coalescer) == 0 and runs[0].waiting == 0
+
+def test_shared_calls_run_once_per_key_and_share_errors():
+    calls = SharedCalls()
+    release = threading.Event()
+    ran = []
+
+    def work():
+        ran.append(True)
+        release.wait(5)
+        if len(ran) > 1:
+            raise ValueError("no network")
+        return 0.42
+    for expected_runs, expected in ((1, 0.42), (2, ValueError)):
+        results = []
+
+        def caller():
+            try:
+                results.append(calls.call(("sharpness", 1), work))
+            except ValueError as e:
+                results.append(e)
+        threads = [threading.Thread(target=caller) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        wait_until(lambda: len(ran) == expected_runs)
+        # Give the other callers time to find the running call
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        release.clear()
+        if expected is ValueError:
+            assert len(results) == 4 and all(isinstance(result, ValueError) for result in results)
+        else:
+            assert results == [expected] * 4
+        # The finished call is forgotten, so the next round runs the function again
+        assert calls._calls == {}
+    assert len(ran) == 2
+
+def test_search_stops_once_its_last_waiter_is_cancelled(engine):
+    coalescer = SearchCoalescer()
+    board = chess.Board()
+    runs = []
+
+    def run(search):
+        runs.append(search)
+        return run_in_flight(engine, board, search)
+    results = []
+    shallow = threading.Thread(target=lambda: results.append(coalescer.search("key", budget(5), run)))
+    shallow.start()
+    while not runs:
+        time.sleep(0.005)
+    # The deeper request attaches and extends the search, then outlives the request that started it
+    cancel = CancelToken()
+    cancelled = []
+
+    def deep_request():
+        try:
+            coalescer.search("key", budget(60), run, cancel)
+        except Cancelled:
+            cancelled.append(True)
+    deep = threading.Thread(target=deep_request)
+    deep.start()
+    shallow.join(5)
+    assert results[0][1] >= 5 and runs[0].followers == 1
+    assert runs[0].waiting == 1 and not runs[0].finished
+
+    started = time.monotonic()
+    cancel.cancel()
+    deep.join(5)
+    while len(coalescer):
+        assert time.monotonic() - started < 1, "the abandoned search kept running"
+        time.sleep(0.005)
+    assert cancelled == [True] and len(runs) == 1 and runs[0].waiting == 0 and runs[0].completed_depth < 60
+
+def test_time_budget_starts_when_the_engine_does(engine):
+    coalescer = SearchCoalescer(max_searches=1)
+    board = chess.Board()
+    release = threading.Event()
+    runs = []
+
+    def blocking_run(search):
+        runs.append(search)
+        release.wait(5)
+        return [], 0, 0
+
+    def run(search):
+        runs.append(search)
+        return run_in_flight(engine, board, search)
+    results = []
+    threads = [start_request(coalescer, "first", budget(5), blocking_run, results)]
+    wait_until(lambda: len(runs) == 1)
+    # Only one search thread, so the second search waits for it with its clock stopped
+    threads.append(start_request(coalescer, "second", budget(60, time_limit=0.3), run, results))
+    time.sleep(0.5)
+    released = time.monotonic()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(coalescer._threads) == 1 and len(runs) == 2
+    assert runs[1].started >= released and runs[1].deadline == pytest.approx(runs[1].started + 0.3)
+    # A budget counted from the request would have expired before the engine started
+    assert results[-1][1] >= 5
@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+
+import chess
+import pytest
+
+from cancellation import Cancelled, CancelToken
+from chess_engines import EnginePool
+from engine_sessions import SessionManager
+from fake_uci_engine import expected_moves, expected_score
+from search_budget import SearchBudget
+
+FAKE_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_uci_engine.py')
+ITALIAN = chess.Board("r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3")
+
+@pytest.fixture
+def open_sessions():
+    """Session managers over a pool of one engine; the sessions left open and the pools are closed afterwards."""
+    managers = []
+
+    def open_sessions(depth_latency=2, **kwargs):
+        pool = EnginePool("stockfish", FAKE_ENGINE, {"FakeDepthLatency": str(depth_latency)}, size=1)
+        managers.append(SessionManager(pool, max_sessions=1, **kwargs))
+        return managers[-1], pool
+    yield open_sessions
+    for sessions in managers:
+        for session_id in list(sessions._sessions):
+            sessions.close_session(session_id)
+        sessions.pool.close()
+
+def test_sessions_ponder_the_expected_reply(open_sessions):
+    sessions, pool = open_sessions()
+    lines, depth, _ = sessions.analyse("game-1", ITALIAN.fen(), SearchBudget(4, 5.0, 4))
+    assert depth == 4 and lines[0]["pv"][0] == expected_moves(ITALIAN)[0]
+    # The session keeps the only engine and searches the position after the best move in the background
+    session = sessions._sessions["game-1"]
+    assert session._ponder is not None and pool._idle.empty()
+
+    time.sleep(0.3)
+    board = ITALIAN.copy()
+    board.push(lines[0]["pv"][0])
+    lines, depth, _ = sessions.analyse("game-1", board.fen(), SearchBudget(8, 5.0, 8))
+    # Answered from the background search, which went past the requested depth, on the same move stack
+    assert depth > 8 and lines[0]["score"].relative.score() == expected_score(board)
+    assert session.board.move_stack == [expected_moves(ITALIAN)[0]]
+
+    # Another position stops the background search and searches it from scratch
+    lines, depth, _ = sessions.analyse("game-1", chess.Board().fen(), SearchBudget(3, 5.0, 3), multipv=2)
+    assert depth == 3 and len(lines) == 2 and session.board.move_stack == []
+
+    assert sessions.close_session("game-1")
+    assert session.closed and session._ponder is None and pool._idle.qsize() == 1
+    assert not sessions.close_session("game-1")
+
+def test_least_recently_used_session_gives_its_engine_to_a_new_one(open_sessions):
+    sessions, _ = open_sessions()
+    sessions.analyse("game-1", ITALIAN.fen(), SearchBudget(3, 5.0, 3))
+    first = sessions._sessions["game-1"]
+    sessions.analyse("game-2", chess.Board().fen(), SearchBudget(3, 5.0, 3))
+    assert first.closed and first._ponder is None
+    assert list(sessions._sessions) == ["game-2"] and sessions._sessions["game-2"].engine is first.engine
+
+def test_idle_sessions_are_closed_and_release_their_engine(open_sessions):
+    sessions, pool = open_sessions(idle_timeout=0.2)
+    sessions.analyse("game-1", ITALIAN.fen(), SearchBudget(3, 5.0, 3))
+    session = sessions._sessions["game-1"]
+    assert len(sessions) == 1 and pool._idle.empty()
+
+    # The reaper checks every second at most
+    deadline = time.monotonic() + 5
+    while len(sessions) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert len(sessions) == 0 and session.closed and session._ponder is None
+    engine = pool.acquire(timeout=1)
+    assert engine is session.engine
+    pool.release(engine)
+
+def test_cancelled_search_keeps_the_session_and_its_engine(open_sessions):
+    # Slow enough that the search is still running when it is cancelled
+    sessions, _ = open_sessions(depth_latency=20)
+    cancel = CancelToken()
+    outcome = []
+
+    def search():
+        try:
+            sessions.analyse("game-1", ITALIAN.fen(), SearchBudget(60, 30.0, 60), cancel=cancel)
+        except Cancelled:
+            outcome.append("cancelled")
+    searcher = threading.Thread(target=search)
+    searcher.start()
+    time.sleep(0.2)
+    cancel.cancel()
+    searcher.join(5)
+    assert outcome == ["cancelled"]
+
+    # The engine was stopped rather than discarded, and serves the session's next request
+    session = sessions._sessions["game-1"]
+    assert not session.closed
+    lines, depth, _ = sessions.analyse("game-1", ITALIAN.fen(), SearchBudget(3, 5.0, 3))
+    assert depth == 3 and sessions._sessions["game-1"] is session
@@ -0,0 +1,50 @@
+import struct
+
+import chess
+import chess.polyglot
+
+from fast_path import FastPathResolver, TABLEBASE_WIN_SCORE, tablebase_score, tablebase_wdl
+from sharpness import sharpnessLC0
+
+def write_book(path, entries):
+    """A Polyglot book with (board, move, weight) entries, sorted by key as the format requires."""
+    records = sorted((chess.polyglot.zobrist_hash(board), move.to_square | move.from_square << 6, weight)
+                     for board, move, weight in entries)
+    with open(path, "wb") as f:
+        for key, raw_move, weight in records:
+            f.write(struct.pack(">QHHI", key, raw_move, weight, 0))
+
+def test_book_lines_are_ordered_by_weight(tmp_path):
+    board = chess.Board()
+    write_book(tmp_path / "book.bin", [(board, chess.Move.from_uci("d2d4"), 30),
+                                       (board, chess.Move.from_uci("e2e4"), 60),
+                                       (board, chess.Move.from_uci("g1f3"), 10)])
+    resolver = FastPathResolver(book_path=str(tmp_path / "book.bin"))
+    try:
+        result = resolver.best_lines(board, 2)
+        assert result["source"] == "book"
+        assert [line["moves"] for line in result["best_lines"]] == ["e4", "d4"]
+        assert [line["weight"] for line in result["best_lines"]] == [0.6, 0.3]
+        assert all(line["score"] is None and line["sharpness"] is None for line in result["best_lines"])
+        # Books carry no evaluation, and positions outside the book are left to the engines
+        assert resolver.evaluate(board) is None
+        board.push_san("e4")
+        assert resolver.best_lines(board, 2) is None
+    finally:
+        resolver.close()
+
+def test_without_sources_nothing_is_resolved():
+    resolver = FastPathResolver()
+    board = chess.Board("8/8/8/8/8/2k5/8/K1Q5 w - - 0 1")
+    assert resolver.evaluate(board) is None
+    assert resolver.sharpness(board) is None
+    assert resolver.best_lines(board, 3) is None
+
+def test_tablebase_results():
+    assert tablebase_score(2, 5) == TABLEBASE_WIN_SCORE - 5
+    assert tablebase_score(-2, -5) == -(TABLEBASE_WIN_SCORE - 5)
+    for cursed in (-1, 0, 1):
+        assert tablebase_score(cursed, 80) == 0
+    assert sharpnessLC0(tablebase_wdl(2)) == sharpnessLC0([1000, 0, 0])
+    assert tablebase_wdl(-2) == (0, 0, 1000)
+    assert tablebase_wdl(1) == (0, 1000, 0)
@@ -0,0 +1,54 @@
+import os
+import signal
+
+import chess
+import chess.engine
+import pytest
+
+import game_analysis
+from fake_uci_engine import expected_moves, expected_score, expected_wdl
+from game_analysis import GameAnalysisPool, analyse_position, init_worker, shutdown_worker
+from sharpness import SharpnessTable, sharpnessLC0
+
+FAKE_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_uci_engine.py')
+PGN = "1. e4 e5 2. Nf3 Nc6 3. Bb5 *"
+
+def test_game_is_scored_move_by_move():
+    pool = GameAnalysisPool(2, FAKE_ENGINE, {"FakeDepthLatency": "1"}, FAKE_ENGINE, {"UCI_ShowWDL": "true"},
+                            SharpnessTable.build())
+    try:
+        plies = list(pool.analyse_game(PGN, depth=4, leela_nodes=1))
+    finally:
+        pool.close()
+
+    board = chess.Board()
+    assert [ply["move"] for ply in plies] == ["e4", "e5", "Nf3", "Nc6", "Bb5"]
+    for ply in plies:
+        before = board.copy()
+        board.push_san(ply["move"])
+        # The best score before the move against what is left for the mover after it
+        cp_loss = max(expected_score(before) + expected_score(board), 0)
+        assert ply["ply"] == len(board.move_stack)
+        assert ply["evaluation"] == (expected_score(board) if board.turn == chess.WHITE else -expected_score(board))
+        assert ply["best_move"] == before.san(expected_moves(before)[0])
+        assert ply["cp_loss"] == cp_loss and ply["classification"] == game_analysis.classify(cp_loss)
+        assert ply["sharpness"] == float(sharpnessLC0(expected_wdl(board)))
+
+def test_crashed_worker_engines_are_replaced():
+    # The worker's engines, started in this process instead of a pool worker
+    init_worker(FAKE_ENGINE, {"FakeDepthLatency": "1"}, None, {})
+    try:
+        stockfish_pool, leela_pool = game_analysis.worker_engines()
+        assert leela_pool is None
+        engine = stockfish_pool.acquire()
+        os.kill(engine.engine.transport.get_pid(), signal.SIGKILL)
+        engine.engine.returncode.result(5)
+        stockfish_pool.release(engine)
+
+        task = {"index": 0, "fen": chess.STARTING_FEN, "depth": 3, "leela_nodes": 1}
+        # The position being searched when the engine died fails, and the next one gets a new engine
+        with pytest.raises(chess.engine.EngineTerminatedError):
+            analyse_position(task)
+        assert analyse_position(task)["score"] == expected_score(chess.Board())
+    finally:
+        shutdown_worker()
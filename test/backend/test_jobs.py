@@ -0,0 +1,132 @@
+import threading
+import time
+
+import pytest
+
+from cancellation import CancelToken, Cancelled
+from jobs import CANCELLED, COMPLETED, FAILED, JobScheduler, JobStore
+from metrics import JOBS_CANCELLED
+
+def wait_finished(job, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not job.is_finished():
+        assert time.monotonic() < deadline, f"{job.kind} job still {job.status}"
+        time.sleep(0.01)
+
+def test_newer_request_stops_the_running_search():
+    started = threading.Event()
+
+    def search(fen, cancel):
+        started.set()
+        stopped = threading.Event()
+        with cancel.stopping(stopped.set):
+            stopped.wait(5)
+        cancel.check()
+        return {"fen": fen}
+
+    scheduler = JobScheduler(JobStore(), workers=1)
+    scheduler.register("evaluate", search, cancellable=True)
+    running = scheduler.submit("evaluate", supersede=("board-1", "evaluate"), fen="a")
+    assert started.wait(5)
+    started.clear()
+    newest = scheduler.submit("evaluate", supersede=("board-1", "evaluate"), fen="b")
+    wait_finished(running)
+    assert running.status == CANCELLED
+    assert running.to_dict()["error"] == "Superseded by a newer request"
+    # The newest request gets the worker as soon as the old search stops
+    assert started.wait(5)
+    scheduler.supersede(("board-1", "evaluate"), {"fen": "c"})
+    wait_finished(newest)
+
+def test_superseded_queued_job_never_runs():
+    release = threading.Event()
+    scheduler = JobScheduler(JobStore(), workers=1)
+    scheduler.register("evaluate", lambda fen: release.wait(5) and {"fen": fen})
+    blocker = scheduler.submit("evaluate", supersede=("board-2", "evaluate"), fen="x")
+    queued = scheduler.submit("evaluate", supersede=("board-1", "evaluate"), fen="a")
+    newest = scheduler.submit("evaluate", supersede=("board-1", "evaluate"), fen="b")
+    release.set()
+    for job in (blocker, queued, newest):
+        wait_finished(job)
+    assert queued.status == CANCELLED and queued.started_at is None
+    assert blocker.status == COMPLETED and newest.status == COMPLETED
+
+def test_repeated_and_unrelated_requests_are_not_cancelled():
+    release = threading.Event()
+    scheduler = JobScheduler(JobStore(), workers=3)
+    scheduler.register("evaluate", lambda fen: release.wait(5) and {"fen": fen})
+    first = scheduler.submit("evaluate", supersede=("board-1", "evaluate"), fen="a")
+    repeat = scheduler.submit("evaluate", supersede=("board-1", "evaluate"), fen="a")
+    other_client = scheduler.submit("evaluate", supersede=("board-2", "evaluate"), fen="b")
+    release.set()
+    for job in (first, repeat, other_client):
+        wait_finished(job)
+        assert job.status == COMPLETED
+
+def test_running_jobs_that_cannot_stop_are_left_to_finish():
+    started = threading.Event()
+    release = threading.Event()
+
+    def sharpness(fen):
+        started.set()
+        release.wait(5)
+        if fen == "broken":
+            raise ValueError("Invalid FEN")
+        return {"fen": fen}
+
+    scheduler = JobScheduler(JobStore(), workers=1)
+    scheduler.register("sharpness", sharpness)
+    cancelled_running = JOBS_CANCELLED.labels("sharpness", "running").get()
+    cancelled_queued = JOBS_CANCELLED.labels("sharpness", "queued").get()
+    running = scheduler.submit("sharpness", supersede=("board-1", "sharpness"), fen="a")
+    assert started.wait(5)
+    queued = scheduler.submit("sharpness", supersede=("board-1", "sharpness"), fen="broken")
+    newest = scheduler.submit("sharpness", supersede=("board-1", "sharpness"), fen="c")
+    release.set()
+    for job in (running, queued, newest):
+        wait_finished(job)
+    # The running job could not be stopped, so it is neither cancelled nor counted; the queued one never ran
+    assert running.status == COMPLETED and not running.cancel_token.cancelled
+    assert queued.status == CANCELLED and queued.started_at is None
+    assert newest.status == COMPLETED
+    assert JOBS_CANCELLED.labels("sharpness", "running").get() == cancelled_running
+    assert JOBS_CANCELLED.labels("sharpness", "queued").get() == cancelled_queued + 1
+
+    # A running job that fails after a newer request arrived reports its own error
+    started.clear()
+    release.clear()
+    failing = scheduler.submit("sharpness", supersede=("board-2", "sharpness"), fen="broken")
+    assert started.wait(5)
+    scheduler.supersede(("board-2", "sharpness"), {"fen": "d"})
+    release.set()
+    wait_finished(failing)
+    assert failing.status == FAILED and failing.to_dict()["error"] == "Invalid FEN"
+
+def test_stopping_after_cancel_stops_at_once():
+    token = CancelToken()
+    assert token.cancel() and not token.cancel()
+    stopped = []
+    with token.stopping(lambda: stopped.append(True)):
+        pass
+    assert stopped == [True]
+    with pytest.raises(Cancelled):
+        token.check()
+
+def test_store_evicts_finished_jobs_in_the_order_they_finished():
+    release = threading.Event()
+    store = JobStore(max_jobs=3, ttl=60)
+    scheduler = JobScheduler(store, workers=2)
+    scheduler.register("evaluate", lambda fen, wait: (not wait or release.wait(5)) and {"fen": fen})
+    slow = scheduler.submit("evaluate", fen="a", wait=True)
+    fast = scheduler.submit("evaluate", fen="b", wait=False)
+    wait_finished(fast)
+    answered = store.record("evaluate", {"fen": "c"}, fen="c")
+    # Full: the job that finished first makes room, the running one is kept
+    newest = store.record("evaluate", {"fen": "d"}, fen="d")
+    assert store.get(fast.id) is None and store.get(slow.id) is slow and len(store) == 3
+    release.set()
+    wait_finished(slow)
+
+    store.ttl = 0
+    time.sleep(0.01)
+    assert store.get(answered.id) is None and store.get(newest.id) is None and len(store) == 0
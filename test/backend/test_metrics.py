@@ -0,0 +1,41 @@
+import pytest
+
+from metrics import Counter, Gauge, Histogram, Registry
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = Histogram("search_seconds", "Search time.", ("engine",), buckets=(0.1, 1.0), registry=registry)
+    for value in (0.05, 0.1, 0.5, 5.0):
+        histogram.labels("stockfish").observe(value)
+    lines = registry.exposition().splitlines()
+    assert 'search_seconds_bucket{engine="stockfish",le="0.1"} 2' in lines
+    assert 'search_seconds_bucket{engine="stockfish",le="1.0"} 3' in lines
+    assert 'search_seconds_bucket{engine="stockfish",le="+Inf"} 4' in lines
+    assert 'search_seconds_count{engine="stockfish"} 4' in lines
+    assert 'search_seconds_sum{engine="stockfish"} 5.65' in lines
+
+def test_counter_and_gauge_exposition():
+    registry = Registry()
+    counter = Counter("crashes_total", "Crashes.", ("engine",), registry=registry)
+    counter.labels("leela").inc()
+    counter.labels("leela").inc(2)
+    gauge = Gauge("queue_depth", "Queue depth.", registry=registry)
+    gauge.set_function(lambda: 7)
+    text = registry.exposition()
+    assert "# TYPE crashes_total counter\n" in text
+    assert 'crashes_total{engine="leela"} 3.0\n' in text
+    assert "queue_depth 7.0\n" in text
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    Counter("requests_total", "Requests.", ("endpoint",), registry=registry).labels('/a"b\\').inc()
+    assert 'requests_total{endpoint="/a\\"b\\\\"} 1.0' in registry.exposition()
+
+def test_counters_only_increase_and_labels_are_checked():
+    counter = Counter("errors_total", "Errors.", ("kind",), registry=None)
+    with pytest.raises(ValueError):
+        counter.labels("a").inc(-1)
+    with pytest.raises(ValueError):
+        counter.labels("a", "b")
+    with pytest.raises(ValueError):
+        counter.inc()
@@ -0,0 +1,85 @@
+import os
+import time
+
+import chess
+import pytest
+
+from analysis_cache import AnalysisCache
+from chess_engines import EnginePool
+from fake_uci_engine import expected_moves, expected_score
+from metrics import PREFETCH_SEARCHES
+from prefetch import Prefetcher
+
+FAKE_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_uci_engine.py')
+ITALIAN = chess.Board("r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3")
+
+@pytest.fixture
+def prefetching():
+    """A prefetcher over a pool of one engine; both are closed afterwards."""
+    started = []
+
+    def start(depth_latency=1):
+        pool = EnginePool("stockfish", FAKE_ENGINE, {"FakeDepthLatency": str(depth_latency)}, size=1)
+        prefetcher = Prefetcher(pool, AnalysisCache(), max_positions=4)
+        started.append((prefetcher, pool))
+        return prefetcher, pool
+    yield start
+    for prefetcher, pool in started:
+        prefetcher.close()
+        pool.close()
+
+def best_line(board):
+    """The line the engine would answer with: its best move and the expected reply."""
+    move = expected_moves(board)[0]
+    child = board.copy()
+    child.push(move)
+    return {"pv": [move, expected_moves(child)[0]]}, child
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return condition()
+
+def test_likely_next_positions_are_searched_into_the_cache(prefetching):
+    prefetcher, _ = prefetching()
+    line, child = best_line(ITALIAN)
+    reply = child.copy()
+    reply.push(line["pv"][1])
+    prefetcher.schedule(ITALIAN, [line], depth=4)
+
+    assert wait_for(lambda: prefetcher.cache.contains(child, 4) and prefetcher.cache.contains(reply, 4))
+    assert prefetcher.cache.get(child, 4)[0]["score"].relative.score() == expected_score(child)
+    # A hit on a prefetched entry is counted once
+    assert prefetcher.was_prefetched(child) and not prefetcher.was_prefetched(child)
+    assert not prefetcher.was_prefetched(ITALIAN)
+
+def test_a_waiting_request_preempts_the_speculative_search(prefetching):
+    # Slow enough that the speculative search is still running when the request arrives
+    prefetcher, pool = prefetching(depth_latency=50)
+    preempted = PREFETCH_SEARCHES.labels("preempted").get()
+    line, child = best_line(ITALIAN)
+    prefetcher.schedule(ITALIAN, [line], depth=60)
+    assert wait_for(lambda: pool._idle.empty())
+
+    started = time.monotonic()
+    engine = pool.acquire(timeout=5)
+    assert time.monotonic() - started < 2
+    # Counted just after the engine is handed over
+    assert wait_for(lambda: PREFETCH_SEARCHES.labels("preempted").get() == preempted + 1)
+    # Only the depths it finished reach the cache
+    assert not prefetcher.cache.contains(child, 60)
+    pool.release(engine)
+
+def test_nothing_is_prefetched_while_the_pool_is_busy(prefetching):
+    prefetcher, pool = prefetching()
+    completed = PREFETCH_SEARCHES.labels("completed").get()
+    engine = pool.acquire(timeout=5)
+    line, child = best_line(ITALIAN)
+    prefetcher.schedule(ITALIAN, [line], depth=4)
+    time.sleep(0.3)
+    assert len(prefetcher.cache) == 0 and PREFETCH_SEARCHES.labels("completed").get() == completed
+
+    # Once the engine is back, the pending positions are searched
+    pool.release(engine)
+    assert wait_for(lambda: prefetcher.cache.contains(child, 4))
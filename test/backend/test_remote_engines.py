@@ -0,0 +1,176 @@
+import os
+import socket
+import threading
+import time
+
+import chess
+import chess.engine
+import pytest
+
+import remote_engines
+from chess_engines import EnginePool, create_engine
+from engine_worker import EngineWorker
+from fake_uci_engine import expected_wdl
+from remote_engines import (RemoteChessEngine, RemoteLeelaEngine, WorkerCluster, WorkerUnavailableError, encode_board,
+                            probe_worker, recv_frame, send_frame)
+
+FAKE_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_uci_engine.py')
+
+def silent_worker(replies):
+    """
+    A listening socket that answers each connection's first frame with the next of replies,
+    then says nothing. Returns its address and a function that closes it.
+    """
+    listener = socket.create_server(("127.0.0.1", 0))
+    # Held open without an answer to anything else
+    connections = []
+
+    def serve():
+        for reply in replies:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return
+            connections.append(sock)
+            recv_frame(sock)
+            send_frame(sock, reply)
+
+    def close():
+        listener.close()
+        for sock in connections:
+            sock.close()
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[:2], close
+
+def test_searches_are_spread_by_capacity_and_fail_over(workers):
+    small, small_address = workers(engines=1)
+    _, large_address = workers(engines=3)
+    cluster = WorkerCluster("stockfish")
+    cluster.add(small_address)
+    cluster.add(large_address)
+    assert sorted(worker["capacity"] for worker in cluster.status()) == [1, 3]
+
+    # The least loaded worker for its capacity gets each new search
+    engine = RemoteChessEngine(cluster)
+    handles = [engine.analysis(chess.Board()) for _ in range(4)]
+    assert sorted(worker["in_flight"] for worker in cluster.status()) == [1, 3]
+    for handle in handles:
+        with handle:
+            handle.stop()
+
+    board = chess.Board("r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3")
+    info = engine.analyse(board, chess.engine.Limit(depth=6))
+    assert info["depth"] == 6 and info["pv"][0] in board.legal_moves
+    lines = engine.analyse_with_multipv(board, chess.engine.Limit(depth=4), multipv=3)
+    assert len(lines) == 3 and len({line["pv"][0] for line in lines}) == 3
+
+    small.kill()
+    small.wait()
+    for _ in range(4):
+        assert engine.analyse(board, chess.engine.Limit(depth=4))["depth"] == 4
+    assert not next(worker for worker in cluster.status() if worker["capacity"] == 1)["up"]
+    cluster.close()
+
+def test_analysis_streams_until_stopped(workers):
+    _, address = workers()
+    engine = create_engine("stockfish", f"tcp://{address[0]}:{address[1]}", {})
+    depths = []
+    with engine.analysis(chess.Board(), multipv=2) as analysis:
+        for info in analysis:
+            if "pv" in info:
+                depths.append(info["depth"])
+            if len(depths) == 10:
+                analysis.stop()
+    assert depths[:3] == [1, 1, 2]
+    assert len(analysis.multipv) == 2 and analysis.best.move in chess.Board().legal_moves
+    # The connection is free for the next request once the stopped search has ended
+    assert engine.analyse(chess.Board(), chess.engine.Limit(depth=3))["depth"] == 3
+    engine.cluster.close()
+
+def test_leela_batches_and_unreachable_workers(workers):
+    _, address = workers("leela")
+    cluster = WorkerCluster("leela")
+    cluster.add(address)
+    engine = RemoteLeelaEngine(cluster)
+    boards = [chess.Board(), chess.Board("8/8/8/8/8/2k5/8/K1Q5 w - - 0 1")]
+    assert [tuple(info["wdl"].relative) for info in engine.analyse_wdls(boards)] == [expected_wdl(board) for board in boards]
+
+    empty = WorkerCluster("stockfish")
+    empty.add(("127.0.0.1", 1))
+    with pytest.raises(WorkerUnavailableError):
+        RemoteChessEngine(empty).analyse(chess.Board(), chess.engine.Limit(depth=1))
+    cluster.close()
+
+def test_workers_with_a_token_refuse_connections_without_it(workers, monkeypatch):
+    _, address = workers(token="s3cret")
+    with pytest.raises(ConnectionRefusedError):
+        probe_worker(f"{address[0]}:{address[1]}")
+    monkeypatch.setattr(remote_engines, "WORKER_TOKEN", "wrong")
+    with pytest.raises(ConnectionRefusedError):
+        probe_worker(f"{address[0]}:{address[1]}")
+
+    monkeypatch.setattr(remote_engines, "WORKER_TOKEN", "s3cret")
+    assert probe_worker(f"{address[0]}:{address[1]}")["capacity"] == 1
+    cluster = WorkerCluster("stockfish")
+    cluster.add(address)
+    assert RemoteChessEngine(cluster).analyse(chess.Board(), chess.engine.Limit(depth=3))["depth"] == 3
+    cluster.close()
+
+def test_malformed_requests_get_an_error_frame(workers):
+    _, address = workers()
+    sock = socket.create_connection(address, timeout=5)
+    # Nothing is served before the hello
+    send_frame(sock, {"op": "analyse", "board": encode_board(chess.Board()), "limit": {"depth": 1}})
+    assert "error" in recv_frame(sock) and recv_frame(sock) is None
+    sock.close()
+
+    sock = socket.create_connection(address, timeout=5)
+    send_frame(sock, {"op": "hello"})
+    assert recv_frame(sock)["engine"] == "stockfish"
+    for request in ([1, 2], {"op": "analysis"}, {"op": "analysis", "board": {"fen": 1}, "limit": None},
+                    {"op": "analysis", "board": encode_board(chess.Board()), "limit": {"plies": 3}},
+                    {"op": "analyse", "board": encode_board(chess.Board())}):
+        send_frame(sock, request)
+        assert "error" in recv_frame(sock)
+    # The connection is still good for a well-formed request
+    send_frame(sock, {"op": "analyse", "board": encode_board(chess.Board()), "limit": {"depth": 2}})
+    assert recv_frame(sock)["info"]["depth"] == 2
+    sock.close()
+
+def test_clients_that_go_away_leave_the_engine_in_the_pool():
+    pool = EnginePool("stockfish", FAKE_ENGINE, {"FakeDepthLatency": "5"}, size=1)
+    engine = pool._idle.queue[0]
+    server = EngineWorker(("127.0.0.1", 0), pool)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        sock = socket.create_connection(server.server_address, timeout=5)
+        send_frame(sock, {"op": "hello"})
+        recv_frame(sock)
+        send_frame(sock, {"op": "analysis", "board": encode_board(chess.Board()), "limit": None})
+        assert recv_frame(sock)["event"] == "started"
+        assert recv_frame(sock)["event"] == "info"
+        sock.close()
+
+        deadline = time.monotonic() + 5
+        while pool._idle.empty() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        # The same engine, stopped rather than replaced
+        assert pool.acquire(timeout=1) is engine
+        pool.release(engine)
+    finally:
+        server.shutdown()
+        server.server_close()
+        pool.close()
+
+def test_workers_that_stop_answering_time_out(monkeypatch):
+    monkeypatch.setattr(remote_engines, "REPLY_MARGIN", 0.2)
+    address, close = silent_worker([{"engine": "stockfish", "capacity": 1}])
+    cluster = WorkerCluster("stockfish")
+    cluster.add(address)
+    started = time.monotonic()
+    with pytest.raises(WorkerUnavailableError):
+        RemoteChessEngine(cluster).analyse(chess.Board(), chess.engine.Limit(time=0.1))
+    assert time.monotonic() - started < 3
+    assert not cluster.status()[0]["up"]
+    cluster.close()
+    close()
@@ -0,0 +1,37 @@
+import os
+
+import chess
+
+from analysis_cache import AnalysisCache
+from analysis_store import AnalysisStore
+from chess_engines import ChessEngine
+from coalescing import SearchCoalescer, run_in_flight
+from search_budget import plan_search, run_budgeted
+
+FAKE_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_uci_engine.py')
+
+def test_stable_search_answers_for_the_requested_depth(tmp_path):
+    engine = ChessEngine(FAKE_ENGINE, {"FakeDepthLatency": "1"})
+    cache = AnalysisCache()
+    store = AnalysisStore(str(tmp_path / "store.bin"))
+    board = chess.Board("r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3")
+    try:
+        # The fake engine's best move and score never change, so the search stops at the stability floor
+        # The lines may be a depth past the floor, as the engine keeps searching while they are read
+        lines, depth, satisfied_depth = run_budgeted(engine, board, plan_search(board, 20, 5.0, 0, 1), multipv=2)
+        assert 10 <= depth < 20 and lines[0]["depth"] >= depth and satisfied_depth == 20
+        # Repeats of the request are served from memory, but only the depth searched is persisted
+        cache.put(board, satisfied_depth, lines)
+        store.put_score(board, lines[0]["score"], depth)
+        for _ in range(3):
+            assert cache.get(board, 20, multipv=2) is not None
+        assert cache.stats()["hits"] == 3 and cache.stats()["misses"] == 0
+        assert store.get_score(board, 20) is None and store.get_score(board, depth)[1] == depth
+
+        # Shared searches report the same depths to every request waiting for them
+        lines, depth, satisfied_depth = SearchCoalescer().search(("key", 1), plan_search(board, 20, 5.0, 0, 1),
+                                                                 lambda search: run_in_flight(engine, board, search))
+        assert 10 <= depth < 20 and satisfied_depth == 20
+    finally:
+        engine.quit()
+        store.close()
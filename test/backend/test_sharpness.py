@@ -0,0 +1,51 @@
+import numpy as np
+
+from sharpness import SharpnessTable, sharpnessLC0, sharpness_lc0_batch
+
+def test_batch_matches_scalar_on_integer_wdl_grid():
+    wdls = np.array([(w, 1000 - w - l, l) for w in range(0, 1001, 7) for l in range(0, 1001 - w, 3)])
+    with np.errstate(divide='ignore'):
+        expected = np.array([sharpnessLC0(wdl) for wdl in wdls])
+    result = sharpness_lc0_batch(wdls)
+    assert np.array_equal(result.view(np.uint64), expected.view(np.uint64)), "Batch sharpness is not bit-identical to the scalar function"
+
+def test_batch_matches_scalar_on_fractional_and_out_of_range_wdl():
+    wdls = np.random.default_rng(0).uniform(-50, 1050, size=(5000, 3))
+    with np.errstate(divide='ignore'):
+        expected = np.array([sharpnessLC0(wdl) for wdl in wdls])
+    result = sharpness_lc0_batch(wdls)
+    assert np.array_equal(result.view(np.uint64), expected.view(np.uint64)), "Batch sharpness is not bit-identical to the scalar function"
+
+def test_batch_accepts_single_triple():
+    assert sharpness_lc0_batch([300, 500, 200]).shape == (1,)
+
+def test_table_matches_scalar_on_integer_wdl_grid():
+    table = SharpnessTable.build()
+    wdls = np.array([(w, 1000 - w - l, l) for w in range(0, 1001, 3) for l in range(0, 1001 - w, 2)])
+    with np.errstate(divide='ignore'):
+        expected = np.array([sharpnessLC0(wdl) for wdl in wdls])
+    result = table.lookup(wdls)
+    assert np.array_equal(result.view(np.uint64), expected.view(np.uint64)), "Table sharpness is not bit-identical to the scalar function"
+    assert all(table.sharpness(wdl) == value for wdl, value in zip(wdls[::97], expected[::97]) if np.isfinite(value))
+
+def test_table_interpolates_fractional_wdl_and_computes_the_rest():
+    table = SharpnessTable.build()
+    wdls = np.random.default_rng(0).uniform(-50, 1050, size=(20000, 3))
+    with np.errstate(divide='ignore'):
+        expected = np.array([sharpnessLC0(wdl) for wdl in wdls])
+    result = table.lookup(wdls)
+    finite = np.isfinite(expected)
+    assert np.array_equal(np.isfinite(result), finite)
+    assert np.all(np.abs(result[finite] - expected[finite]) <= 0.01 * expected[finite])
+    # Outside the W + L <= 1000 triangle there is nothing to interpolate, so the values are exact
+    outside = (wdls[:, 0] < 0) | (wdls[:, 2] < 0) | (wdls[:, 0] + wdls[:, 2] > 1000)
+    assert np.array_equal(result[outside], expected[outside])
+
+def test_table_save_and_load(tmp_path):
+    path = str(tmp_path / "sharpness_table.npy")
+    built = SharpnessTable.load_or_build(path)
+    loaded = SharpnessTable.load_or_build(path)
+    assert np.array_equal(np.asarray(loaded.values), built.values)
+    with open(path, "wb") as f:
+        f.write(b"not a table")
+    assert np.array_equal(SharpnessTable.load_or_build(path).values, built.values)
@@ -0,0 +1,81 @@
+import chess
+import pytest
+
+import app_environment  # noqa: F401
+import main
+import remote_engines
+from chess_engines import EnginePool
+from engine_sessions import SessionManager
+from search_budget import SearchBudget
+from test_remote_engines import silent_worker
+
+@pytest.fixture(autouse=True)
+def clusters(monkeypatch):
+    # Registered workers would otherwise outlive the processes of each test
+    monkeypatch.setattr(remote_engines, "_clusters", {})
+
+def register(address):
+    return main.app.test_client().post("/workers", json={"address": address})
+
+def test_only_configured_hosts_can_register(monkeypatch):
+    # The engine paths are local, so by default no host is allowed
+    assert main.worker_hosts == []
+    assert register("127.0.0.1:9000").status_code == 403
+
+    monkeypatch.setattr(main, "worker_hosts", ["127.0.0.1"])
+    # The caller is allowed, but the worker it names is not
+    assert register("10.11.12.13:9000").status_code == 403
+    assert register("not an address").status_code == 400
+    assert remote_engines.cluster_for("stockfish").workers() == []
+
+def test_workers_are_checked_before_they_are_added(monkeypatch, workers):
+    monkeypatch.setattr(main, "worker_hosts", ["localhost"])
+    _, (host, port) = workers("leela")
+    # Leela engines are local here, so the worker is refused without being added
+    response = register(f"{host}:{port}")
+    assert response.status_code == 409
+    assert remote_engines.cluster_for("leela").workers() == []
+
+def test_workers_with_a_malformed_handshake_are_refused(monkeypatch):
+    monkeypatch.setattr(main, "worker_hosts", ["127.0.0.1"])
+    (host, port), close = silent_worker([{"engines": "stockfish"}, {"engine": "stockfish", "capacity": "many"},
+                                            {"engine": "komodo", "capacity": 1}])
+    for _ in range(3):
+        assert register(f"{host}:{port}").status_code == 502
+    assert remote_engines.cluster_for("stockfish").workers() == []
+    close()
+
+def test_remote_pools_grow_to_their_workers_capacity(monkeypatch, workers):
+    _, (host, port) = workers(engines=1)
+    engine_path = f"tcp://{host}:{port}"
+    pool = EnginePool("stockfish", engine_path, {}, size=1)
+    monkeypatch.setattr(main, "stockfish_path", engine_path)
+    monkeypatch.setattr(main, "worker_hosts", [host])
+    monkeypatch.setattr(main, "sf_pool", pool)
+    monkeypatch.setattr(main, "leela_pool", None)
+    try:
+        _, (host, port) = workers(engines=2)
+        response = register(f"{host}:{port}")
+        assert response.status_code == 200 and response.get_json()["capacity"] == 2
+        assert pool.size == 3 and main.job_scheduler.workers >= 3
+        engines = [pool.acquire(timeout=5) for _ in range(3)]
+        assert None not in engines
+        for engine in engines:
+            pool.release(engine)
+    finally:
+        pool.close()
+
+def test_sessions_do_not_ponder_on_remote_engines(workers):
+    _, (host, port) = workers()
+    pool = EnginePool("stockfish", f"tcp://{host}:{port}", {}, size=1)
+    sessions = SessionManager(pool, max_sessions=1)
+    try:
+        lines, depth, _ = sessions.analyse("game-1", chess.Board().fen(), SearchBudget(4, 5.0, 4))
+        assert depth == 4 and lines[0]["pv"]
+        # Pondering would keep a search running on the worker for as long as the session lives
+        session = sessions._sessions["game-1"]
+        assert session._ponder is None
+        assert remote_engines.cluster_for("stockfish").status()[0]["in_flight"] == 0
+    finally:
+        sessions.close_session("game-1")
+        pool.close()